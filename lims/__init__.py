@@ -62,6 +62,7 @@ def register():
         analysis.CalculatedTypificationReadOnly,
         sample.PackagingType,
         analysis.AnalysisIncluded,
+        analysis.AnalysisIncludedClosure,
         analysis.AnalysisDevice,
         certification.CertificationType,
         certification.TechnicalScope,
@@ -247,6 +248,7 @@ def register():
         planification.LabProfessionalMethodRequalificationSupervisor,
         planification.LabProfessionalMethodRequalificationControl,
         planification.BlindSample,
+        analysis.AnalysisPendingService,
         planification.RelateTechniciansStart,
         planification.RelateTechniciansResult,
         planification.RelateTechniciansDetail1,
@@ -3,24 +3,73 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import logging
-import operator
 import json
 from datetime import datetime, date
 from decimal import Decimal
 from sql import Literal
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
 
 from trytond.model import Workflow, ModelView, ModelSQL, DeactivableMixin, \
     fields, Unique
+from trytond.model.fields import SQL_OPERATORS
 from trytond.wizard import Wizard, StateTransition, StateView, StateAction, \
     Button
 from trytond.report import Report
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.tools import grouped_slice
 from trytond.pyson import PYSONEncoder, Eval, Equal, Bool, Not, Or, And
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
 
+class PendingServiceDataManager(object):
+    '''
+    Collect the services whose pending state may have changed during a
+    transaction and update them at once before the transaction is committed
+    '''
+
+    def __init__(self):
+        self.service_ids = set()
+
+    def __eq__(self, other):
+        if not isinstance(other, PendingServiceDataManager):
+            return NotImplemented
+        return True
+
+    def process(self):
+        AnalysisPendingService = Pool().get('lims.analysis.pending_service')
+        while self.service_ids:
+            service_ids = list(self.service_ids)
+            self.service_ids.clear()
+            AnalysisPendingService.update_services(service_ids)
+
+    def _clear(self):
+        self.service_ids.clear()
+
+    def abort(self, trans):
+        self._clear()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        # Processed once every data manager has begun, as they can modify
+        # services too
+        self.process()
+
+    def tpc_finish(self, trans):
+        self._clear()
+
+    def tpc_abort(self, trans):
+        self._clear()
+
+
 class Typification(ModelSQL, ModelView):
     'Typification'
     __name__ = 'lims.typification'
@@ -105,6 +154,8 @@ class Typification(ModelSQL, ModelView):
         depends=['laboratory_domain'])
     laboratory_domain = fields.Function(fields.Many2Many('lims.laboratory',
         None, None, 'Laboratory domain'), 'on_change_with_laboratory_domain')
+    _valid_typification_cache = Cache('lims.typification.valid',
+        size_limit=10240, context=False)
 
     @classmethod
     def __setup__(cls):
@@ -334,6 +385,7 @@ class Typification(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
+        cls._valid_typification_cache.clear()
         typifications = super().create(vlist)
         active_typifications = [t for t in typifications if t.valid]
         cls.create_typification_calculated(active_typifications)
@@ -397,6 +449,7 @@ class Typification(ModelSQL, ModelView):
 
     @classmethod
     def delete(cls, typifications):
+        cls._valid_typification_cache.clear()
         cls.delete_typification_calculated(typifications)
         super().delete(typifications)
 
@@ -431,6 +484,7 @@ class Typification(ModelSQL, ModelView):
 
     @classmethod
     def write(cls, *args):
+        cls._valid_typification_cache.clear()
         super().write(*args)
         actions = iter(args)
         for typifications, vals in zip(actions, actions):
@@ -509,17 +563,44 @@ class Typification(ModelSQL, ModelView):
 
     @classmethod
     def get_valid_typification(cls, product_type, matrix, analysis, method):
+        key = (product_type, matrix, analysis, method)
+        return cls.get_valid_typifications([key])[key]
+
+    @classmethod
+    def get_valid_typifications(cls, keys):
+        '''
+        Return a dict with the valid typification (or None) of each
+        (product_type, matrix, analysis, method) key
+        '''
         cursor = Transaction().connection.cursor()
-        cursor.execute('SELECT id '
-            'FROM "' + cls._table + '" '
-            'WHERE product_type = %s '
-                'AND matrix = %s '
-                'AND analysis = %s '
-                'AND method = %s '
-                'AND valid',
-            (product_type, matrix, analysis, method))
-        res = cursor.fetchone()
-        return res and cls(res[0]) or None
+
+        res = {}
+        to_fetch = set()
+        for key in keys:
+            typification_id = cls._valid_typification_cache.get(key, -1)
+            if typification_id == -1:
+                to_fetch.add(key)
+            else:
+                res[key] = typification_id
+
+        if to_fetch:
+            found = {}
+            for sub_keys in grouped_slice(list(to_fetch)):
+                cursor.execute('SELECT product_type, matrix, analysis, '
+                        'method, id '
+                    'FROM "' + cls._table + '" '
+                    'WHERE (product_type, matrix, analysis, method) IN %s '
+                        'AND valid',
+                    (tuple(sub_keys),))
+                for x in cursor.fetchall():
+                    found.setdefault(tuple(x[:4]), x[4])
+            for key in to_fetch:
+                typification_id = found.get(key)
+                cls._valid_typification_cache.set(key, typification_id)
+                res[key] = typification_id
+
+        return dict((key, cls(typification_id) if typification_id else None)
+            for key, typification_id in res.items())
 
 
 class TypificationAditional(ModelSQL):
@@ -1099,76 +1180,110 @@ class Analysis(Workflow, ModelSQL, ModelView):
     def get_included_analysis(cls, analysis_id):
         cursor = Transaction().connection.cursor()
         pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
+        AnalysisIncludedClosure = pool.get('lims.analysis.included.closure')
 
-        childs = []
-        cursor.execute('SELECT included_analysis '
-            'FROM "' + AnalysisIncluded._table + '" '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis_ids = [x[0] for x in cursor.fetchall()]
-        for analysis_id in included_analysis_ids:
-            if analysis_id not in childs:
-                childs.append(analysis_id)
-                childs.extend(cls.get_included_analysis(analysis_id))
-        return childs
+        cursor.execute('SELECT descendant '
+            'FROM "' + AnalysisIncludedClosure._table + '" '
+            'WHERE ancestor = %s '
+            'ORDER BY descendant', (analysis_id,))
+        return [x[0] for x in cursor.fetchall()]
 
     @classmethod
     def get_included_analysis_analysis(cls, analysis_id):
+        return cls.get_included_analysis_analysis_multi(
+            [analysis_id])[analysis_id]
+
+    @classmethod
+    def get_included_analysis_analysis_multi(cls, analysis_ids):
+        '''
+        Return a dict with the list of analysis of type 'analysis' included
+        (at any level) in each one of analysis_ids
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
+        AnalysisIncludedClosure = pool.get('lims.analysis.included.closure')
         Analysis = pool.get('lims.analysis')
 
-        childs = []
-        cursor.execute('SELECT ia.included_analysis, a.type '
-            'FROM "' + AnalysisIncluded._table + '" ia '
+        res = dict((a_id, []) for a_id in analysis_ids)
+        if not analysis_ids:
+            return res
+        cursor.execute('SELECT c.ancestor, c.descendant '
+            'FROM "' + AnalysisIncludedClosure._table + '" c '
                 'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = ia.included_analysis '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis = cursor.fetchall()
-        for analysis in included_analysis:
-            if analysis[1] == 'analysis' and analysis[0] not in childs:
-                childs.append(analysis[0])
-            childs.extend(cls.get_included_analysis_analysis(analysis[0]))
-        return childs
+                'ON a.id = c.descendant '
+            'WHERE c.ancestor IN (' +
+                ', '.join(str(int(a)) for a in analysis_ids) + ') '
+                'AND a.type = \'analysis\' '
+            'ORDER BY c.ancestor, c.descendant')
+        for ancestor, descendant in cursor.fetchall():
+            res[ancestor].append(descendant)
+        return res
 
     @classmethod
     def get_included_analysis_method(cls, analysis_id):
         cursor = Transaction().connection.cursor()
         pool = Pool()
         AnalysisIncluded = pool.get('lims.analysis.included')
+        AnalysisIncludedClosure = pool.get('lims.analysis.included.closure')
 
         childs = []
-        cursor.execute('SELECT included_analysis, method '
-            'FROM "' + AnalysisIncluded._table + '" '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis = cursor.fetchall()
-        for analysis in included_analysis:
-            if analysis not in childs:
+        cursor.execute('SELECT ia.included_analysis, ia.method '
+            'FROM "' + AnalysisIncluded._table + '" ia '
+            'WHERE ia.analysis = %s '
+                'OR ia.analysis IN ('
+                    'SELECT descendant '
+                    'FROM "' + AnalysisIncludedClosure._table + '" '
+                    'WHERE ancestor = %s) '
+            'ORDER BY ia.id', (analysis_id, analysis_id))
+        existing = set()
+        for analysis in cursor.fetchall():
+            if analysis not in existing:
+                existing.add(analysis)
                 childs.append(analysis)
-            childs.extend(cls.get_included_analysis_method(analysis[0]))
         return childs
 
     @classmethod
     def get_parents_analysis(cls, analysis_id):
+        return cls.get_parents_analysis_multi([analysis_id])[analysis_id]
+
+    @classmethod
+    def get_parents_analysis_multi(cls, analysis_ids):
+        '''
+        Return a dict with the list of sets and groups that include (at any
+        level) each one of analysis_ids. The walk up the tree stops at
+        inactive sets and groups, so the ancestors of an inactive set or
+        group are not returned unless they are reached through active ones
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
         AnalysisIncluded = pool.get('lims.analysis.included')
         Analysis = pool.get('lims.analysis')
 
-        parents = []
-        cursor.execute('SELECT ia.analysis '
-            'FROM "' + AnalysisIncluded._table + '" ia '
-                'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = ia.analysis '
-            'WHERE ia.included_analysis = %s '
-                'AND a.state = \'active\'', (analysis_id,))
-        parents_analysis_ids = [x[0] for x in cursor.fetchall()]
-        for analysis_id in parents_analysis_ids:
-            if analysis_id not in parents:
-                parents.append(analysis_id)
-                parents.extend(cls.get_parents_analysis(analysis_id))
-        return parents
+        res = dict((a_id, []) for a_id in analysis_ids)
+        if not analysis_ids:
+            return res
+        cursor.execute('WITH RECURSIVE parents(descendant, ancestor) AS ('
+                'SELECT ia.included_analysis, ia.analysis '
+                'FROM "' + AnalysisIncluded._table + '" ia '
+                    'INNER JOIN "' + Analysis._table + '" a '
+                    'ON a.id = ia.analysis '
+                'WHERE ia.included_analysis IN (' +
+                    ', '.join(str(int(a)) for a in analysis_ids) + ') '
+                    'AND a.state = \'active\' '
+                'UNION '
+                'SELECT p.descendant, ia.analysis '
+                'FROM parents p '
+                    'INNER JOIN "' + AnalysisIncluded._table + '" ia '
+                    'ON ia.included_analysis = p.ancestor '
+                    'INNER JOIN "' + Analysis._table + '" a '
+                    'ON a.id = ia.analysis '
+                'WHERE a.state = \'active\''
+            ') '
+            'SELECT descendant, ancestor FROM parents '
+            'ORDER BY descendant, ancestor')
+        for descendant, ancestor in cursor.fetchall():
+            res[descendant].append(ancestor)
+        return res
 
     def get_rec_name(self, name):
         if self.code:
@@ -1213,6 +1328,9 @@ class Analysis(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def write(cls, *args):
+        pool = Pool()
+        EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
+        AnalysisPendingService = pool.get('lims.analysis.pending_service')
         actions = iter(args)
         for analysis, vals in zip(actions, actions):
             if vals.get('description'):
@@ -1220,6 +1338,15 @@ class Analysis(Workflow, ModelSQL, ModelView):
                     cls.check_duplicate_description(vals.get('type', a.type),
                         vals['description'], a.id)
         super().write(*args)
+        actions = iter(args)
+        for analysis, vals in zip(actions, actions):
+            if 'behavior' in vals:
+                details = EntryDetailAnalysis.search([
+                    ('analysis', 'in', [a.id for a in analysis]),
+                    ('state', 'in', ['draft', 'unplanned']),
+                    ])
+                AnalysisPendingService.delay_update_services(
+                    [d.service.id for d in details])
 
     @classmethod
     @ModelView.button_action('lims.wiz_lims_relate_analysis')
@@ -1491,6 +1618,14 @@ class Analysis(Workflow, ModelSQL, ModelView):
                 return True
         return False
 
+    @classmethod
+    def delete(cls, analysis):
+        AnalysisIncludedClosure = Pool().get('lims.analysis.included.closure')
+        analysis_ids = [a.id for a in analysis]
+        parents = AnalysisIncludedClosure.get_ancestors(analysis_ids)
+        super().delete(analysis)
+        AnalysisIncludedClosure.update_closure(parents - set(analysis_ids))
+
     @classmethod
     def copy(cls, records, default=None):
         if default is None:
@@ -1527,6 +1662,8 @@ class Analysis(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def search_pending_fractions(cls, name, domain=None):
+        pool = Pool()
+        AnalysisPendingService = pool.get('lims.analysis.pending_service')
         context = Transaction().context
 
         date_from = context.get('date_from') or str(date.min)
@@ -1535,118 +1672,55 @@ class Analysis(Workflow, ModelSQL, ModelView):
         if not (date_from and date_to) or not calculate:
             return []
 
-        new_context = {}
-        new_context['date_from'] = date_from
-        new_context['date_to'] = date_to
-        with Transaction().set_context(new_context):
-            pending_fractions = iter(cls.analysis_pending_fractions().items())
-
-        processed_lines = []
-        for analysis, pending in pending_fractions:
-            processed_lines.append({
-                'analysis': analysis,
-                'pending_fractions': pending,
-                })
-
-        record_ids = [line['analysis'] for line in processed_lines
-            if cls._search_pending_fractions_eval_domain(line, domain)]
-        return [('id', 'in', record_ids)]
+        _, operator_, value = domain
+        Operator = SQL_OPERATORS[operator_]
+        analysis = cls.__table__()
+        pending = AnalysisPendingService.__table__()
+        pending_fractions = pending.select(pending.analysis,
+            Count(Literal('*')).as_('quantity'),
+            where=((pending.confirmation_date >= date_from) &
+                (pending.confirmation_date <= date_to)),
+            group_by=pending.analysis)
+        query = analysis.join(pending_fractions, 'LEFT',
+            condition=pending_fractions.analysis == analysis.id).select(
+            analysis.id,
+            where=Operator(Coalesce(pending_fractions.quantity, 0), value))
+        return [('id', 'in', query)]
 
     @classmethod
-    def analysis_pending_fractions(cls, analysis_ids=None):
+    def analysis_pending_fractions(cls, analysis_ids=None,
+            laboratory_id=None):
         cursor = Transaction().connection.cursor()
         context = Transaction().context
         pool = Pool()
-        NotebookLine = pool.get('lims.notebook.line')
-        PlanificationServiceDetail = pool.get(
-            'lims.planification.service_detail')
-        PlanificationDetail = pool.get('lims.planification.detail')
-        Planification = pool.get('lims.planification')
-        EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
-        Analysis = pool.get('lims.analysis')
-        Service = pool.get('lims.service')
-        Fraction = pool.get('lims.fraction')
+        AnalysisPendingService = pool.get('lims.analysis.pending_service')
 
         date_from = context.get('date_from') or str(date.min)
         date_to = context.get('date_to') or str(date.max)
 
-        dates_where = ''
-        dates_where += ('AND srv.confirmation_date::date >= \'%s\'::date ' %
-            date_from)
-        dates_where += ('AND srv.confirmation_date::date <= \'%s\'::date ' %
-            date_to)
-
-        cursor.execute('SELECT DISTINCT(nl.service) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + PlanificationServiceDetail._table +
-                '" psd ON psd.notebook_line = nl.id '
-                'INNER JOIN "' + PlanificationDetail._table + '" pd '
-                'ON psd.detail = pd.id '
-                'INNER JOIN "' + Planification._table + '" p '
-                'ON pd.planification = p.id '
-            'WHERE p.state = \'preplanned\'')
-        planned_services = [s[0] for s in cursor.fetchall()]
-        planned_services_ids = ', '.join(
-            str(s) for s in [0] + planned_services)
-        preplanned_clause = 'AND srv.id NOT IN (%s) ' % planned_services_ids
-
-        cursor.execute('SELECT DISTINCT(d.service) '
-            'FROM "' + EntryDetailAnalysis._table + '" d '
-                'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = d.analysis '
-            'WHERE d.plannable = TRUE '
-                'AND d.state IN (\'draft\', \'unplanned\') '
-                'AND a.behavior != \'internal_relation\'')
-        not_planned_services = [s[0] for s in cursor.fetchall()]
-        not_planned_services_ids = ', '.join(
-            str(s) for s in [0] + not_planned_services)
-        not_planned_services_clause = ('AND id IN (%s) ' %
-            not_planned_services_ids)
+        params = [date_from, date_to]
+        analysis_clause = ''
+        if analysis_ids:
+            analysis_clause = 'AND analysis = ANY(%s) '
+            params.append(list(analysis_ids))
+        laboratory_clause = ''
+        if laboratory_id:
+            laboratory_clause = 'AND laboratory = %s '
+            params.append(laboratory_id)
+        cursor.execute('SELECT analysis, COUNT(*) '
+            'FROM "' + AnalysisPendingService._table + '" '
+            'WHERE confirmation_date >= %s::date '
+                'AND confirmation_date <= %s::date ' +
+                analysis_clause + laboratory_clause +
+            'GROUP BY analysis', params)
+        pending = dict(cursor.fetchall())
 
         if analysis_ids:
             all_analysis_ids = analysis_ids
         else:
             cursor.execute('SELECT id FROM "' + cls._table + '"')
             all_analysis_ids = [a[0] for a in cursor.fetchall()]
-
-        res = {}
-        for analysis_id in all_analysis_ids:
-            count = 0
-            cursor.execute('SELECT srv.id '
-                'FROM "' + Service._table + '" srv '
-                    'INNER JOIN "' + Fraction._table + '" frc '
-                    'ON frc.id = srv.fraction '
-                'WHERE srv.analysis = %s '
-                    'AND frc.confirmed = TRUE ' +
-                    dates_where + preplanned_clause,
-                (analysis_id,))
-            pending_services = [s[0] for s in cursor.fetchall()]
-            if pending_services:
-                pending_services_ids = ', '.join(str(s) for s in
-                    pending_services)
-                cursor.execute('SELECT COUNT(*) '
-                    'FROM "' + Service._table + '" '
-                    'WHERE id IN (' + pending_services_ids + ') ' +
-                        not_planned_services_clause)
-                count = cursor.fetchone()[0]
-            res[analysis_id] = count
-        return res
-
-    @staticmethod
-    def _search_pending_fractions_eval_domain(line, domain):
-        operator_funcs = {
-            '=': operator.eq,
-            '>=': operator.ge,
-            '>': operator.gt,
-            '<=': operator.le,
-            '<': operator.lt,
-            '!=': operator.ne,
-            'in': lambda v, l: v in l,
-            'not in': lambda v, l: v not in l,
-            }
-        field, op, operand = domain
-        value = line.get(field)
-        return operator_funcs[op](value, operand)
+        return {a: pending.get(a, 0) for a in all_analysis_ids}
 
 
 class AnalysisIncluded(ModelSQL, ModelView):
@@ -1757,10 +1831,27 @@ class AnalysisIncluded(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
+        AnalysisIncludedClosure = Pool().get('lims.analysis.included.closure')
         included_analysis = super().create(vlist)
+        AnalysisIncludedClosure.update_closure(
+            [i.analysis.id for i in included_analysis])
         cls.create_typification_calculated(included_analysis)
         return included_analysis
 
+    @classmethod
+    def write(cls, *args):
+        AnalysisIncludedClosure = Pool().get('lims.analysis.included.closure')
+        analysis_ids = set()
+        actions = iter(args)
+        for included_analysis, vals in zip(actions, actions):
+            if 'analysis' in vals or 'included_analysis' in vals:
+                analysis_ids.update(i.analysis.id for i in included_analysis)
+                if vals.get('analysis'):
+                    analysis_ids.add(vals['analysis'])
+        super().write(*args)
+        if analysis_ids:
+            AnalysisIncludedClosure.update_closure(analysis_ids)
+
     @classmethod
     def create_typification_calculated(cls, included_analysis):
         cursor = Transaction().connection.cursor()
@@ -1855,8 +1946,11 @@ class AnalysisIncluded(ModelSQL, ModelView):
 
     @classmethod
     def delete(cls, included_analysis):
+        AnalysisIncludedClosure = Pool().get('lims.analysis.included.closure')
         cls.delete_typification_calculated(included_analysis)
+        analysis_ids = [i.analysis.id for i in included_analysis]
         super().delete(included_analysis)
+        AnalysisIncludedClosure.update_closure(analysis_ids)
 
     @classmethod
     def delete_typification_calculated(cls, included_analysis):
@@ -1967,6 +2061,201 @@ class AnalysisIncluded(ModelSQL, ModelView):
             ]
 
 
+class AnalysisIncludedClosure(ModelSQL):
+    'Included Analysis Closure'
+    __name__ = 'lims.analysis.included.closure'
+
+    ancestor = fields.Many2One('lims.analysis', 'Set/Group', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    descendant = fields.Many2One('lims.analysis', 'Included analysis',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('ancestor_descendant_uniq', Unique(t, t.ancestor, t.descendant),
+                'lims.msg_analysis_included_closure_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        super().__register__(module_name)
+        cursor.execute('SELECT COUNT(*) FROM "' + cls._table + '"')
+        if not cursor.fetchone()[0]:
+            cls.update_closure()
+
+    @classmethod
+    def get_ancestors(cls, analysis_ids):
+        cursor = Transaction().connection.cursor()
+        if not analysis_ids:
+            return set()
+        cursor.execute('SELECT DISTINCT(ancestor) '
+            'FROM "' + cls._table + '" '
+            'WHERE descendant IN (' +
+                ', '.join(str(int(a)) for a in analysis_ids) + ')')
+        return set(x[0] for x in cursor.fetchall())
+
+    @classmethod
+    def update_closure(cls, analysis_ids=None):
+        '''
+        Rebuild the closure rows of analysis_ids and of all the sets and
+        groups that include them. The whole closure is rebuilt when
+        analysis_ids is None.
+        '''
+        cursor = Transaction().connection.cursor()
+        AnalysisIncluded = Pool().get('lims.analysis.included')
+
+        if analysis_ids is None:
+            cursor.execute('DELETE FROM "' + cls._table + '"')
+            roots_clause = ''
+        else:
+            analysis_ids = set(analysis_ids)
+            if not analysis_ids:
+                return
+            analysis_ids |= cls.get_ancestors(analysis_ids)
+            ids = ', '.join(str(int(a)) for a in analysis_ids)
+            cursor.execute('DELETE FROM "' + cls._table + '" '
+                'WHERE ancestor IN (' + ids + ')')
+            roots_clause = 'WHERE analysis IN (' + ids + ') '
+
+        cursor.execute('INSERT INTO "' + cls._table + '" '
+                '(create_uid, create_date, ancestor, descendant) '
+            'WITH RECURSIVE tree(ancestor, descendant) AS ('
+                'SELECT analysis, included_analysis '
+                'FROM "' + AnalysisIncluded._table + '" ' +
+                roots_clause +
+                'UNION '
+                'SELECT t.ancestor, ia.included_analysis '
+                'FROM tree t '
+                    'INNER JOIN "' + AnalysisIncluded._table + '" ia '
+                    'ON ia.analysis = t.descendant'
+            ') '
+            'SELECT %s, %s, ancestor, descendant FROM tree',
+            (Transaction().user, datetime.now()))
+
+
+class AnalysisPendingService(ModelSQL):
+    'Analysis Pending Service'
+    __name__ = 'lims.analysis.pending_service'
+
+    service = fields.Many2One('lims.service', 'Service', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    analysis = fields.Many2One('lims.analysis', 'Analysis', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    laboratory = fields.Many2One('lims.laboratory', 'Laboratory',
+        select=True, readonly=True)
+    confirmation_date = fields.Date('Confirmation date', select=True,
+        readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        super().__register__(module_name)
+        cursor.execute('SELECT COUNT(*) FROM "' + cls._table + '"')
+        if not cursor.fetchone()[0]:
+            cls.update_services()
+
+    @classmethod
+    def delay_update_services(cls, service_ids):
+        '''
+        Update the pending state of the services once, when the current
+        transaction is committed
+        '''
+        if not service_ids:
+            return
+        datamanager = Transaction().join(PendingServiceDataManager())
+        datamanager.service_ids.update(service_ids)
+
+    @classmethod
+    def update_services(cls, service_ids=None):
+        '''
+        Store the services that are pending planning: services of confirmed
+        fractions, not pre-planned, with analysis to plan. All the services
+        are updated when service_ids is None.
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Service = pool.get('lims.service')
+        Fraction = pool.get('lims.fraction')
+        EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
+        Analysis = pool.get('lims.analysis')
+        NotebookLine = pool.get('lims.notebook.line')
+        PlanificationServiceDetail = pool.get(
+            'lims.planification.service_detail')
+        PlanificationDetail = pool.get('lims.planification.detail')
+        Planification = pool.get('lims.planification')
+
+        if service_ids is None:
+            cursor.execute('DELETE FROM "' + cls._table + '"')
+            services_clause = ''
+            params = [Transaction().user, datetime.now()]
+        else:
+            service_ids = list(set(service_ids))
+            if not service_ids:
+                return
+            cursor.execute('DELETE FROM "' + cls._table + '" '
+                'WHERE service = ANY(%s)', (service_ids,))
+            services_clause = 'AND srv.id = ANY(%s) '
+            params = [Transaction().user, datetime.now(), service_ids]
+
+        cursor.execute('INSERT INTO "' + cls._table + '" '
+                '(create_uid, create_date, service, analysis, laboratory, '
+                'confirmation_date) '
+            'SELECT %s, %s, srv.id, srv.analysis, srv.laboratory, '
+                'srv.confirmation_date '
+            'FROM "' + Service._table + '" srv '
+                'INNER JOIN "' + Fraction._table + '" frc '
+                'ON frc.id = srv.fraction '
+            'WHERE frc.confirmed = TRUE '
+                'AND srv.confirmation_date IS NOT NULL ' +
+                services_clause +
+                'AND EXISTS (SELECT 1 '
+                    'FROM "' + EntryDetailAnalysis._table + '" d '
+                        'INNER JOIN "' + Analysis._table + '" a '
+                        'ON a.id = d.analysis '
+                    'WHERE d.service = srv.id '
+                        'AND d.plannable = TRUE '
+                        'AND d.state IN (\'draft\', \'unplanned\') '
+                        'AND a.behavior != \'internal_relation\') '
+                'AND NOT EXISTS (SELECT 1 '
+                    'FROM "' + NotebookLine._table + '" nl '
+                        'INNER JOIN "' + PlanificationServiceDetail._table +
+                        '" psd ON psd.notebook_line = nl.id '
+                        'INNER JOIN "' + PlanificationDetail._table + '" pd '
+                        'ON psd.detail = pd.id '
+                        'INNER JOIN "' + Planification._table + '" p '
+                        'ON pd.planification = p.id '
+                    'WHERE nl.service = srv.id '
+                        'AND p.state = \'preplanned\')', params)
+
+    @classmethod
+    def delay_update_planifications(cls, planification_ids):
+        '''
+        Update the pending state of the services planned in the
+        planifications when the current transaction is committed
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        NotebookLine = pool.get('lims.notebook.line')
+        PlanificationServiceDetail = pool.get(
+            'lims.planification.service_detail')
+        PlanificationDetail = pool.get('lims.planification.detail')
+
+        if not planification_ids:
+            return
+        cursor.execute('SELECT DISTINCT(nl.service) '
+            'FROM "' + NotebookLine._table + '" nl '
+                'INNER JOIN "' + PlanificationServiceDetail._table +
+                '" psd ON psd.notebook_line = nl.id '
+                'INNER JOIN "' + PlanificationDetail._table + '" pd '
+                'ON psd.detail = pd.id '
+            'WHERE pd.planification = ANY(%s)', (list(planification_ids),))
+        cls.delay_update_services([x[0] for x in cursor.fetchall()])
+
+
 class AnalysisLaboratory(ModelSQL, ModelView):
     'Analysis - Laboratory'
     __name__ = 'lims.analysis-laboratory'
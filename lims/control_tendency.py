@@ -2,9 +2,15 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import hashlib
+import numpy as np
 import pandas as pd
+from datetime import datetime, timedelta
+from functools import partial
 from io import BytesIO
 from math import sqrt
+from numpy.lib.stride_tricks import sliding_window_view
+from threading import Lock
 import matplotlib.pyplot as plt
 
 from trytond.model import ModelView, ModelSQL, fields
@@ -16,6 +22,69 @@ from trytond.transaction import Transaction
 from trytond.report import Report
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.cache import LRUDict
+
+_plots = LRUDict(32)
+_plots_lock = Lock()
+
+
+def get_plot_image(key, render):
+    '''
+    Return the image of a plot, calling render only when no image has
+    been rendered yet for the same data points and options
+    '''
+    digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+    with _plots_lock:
+        image = _plots.get(digest)
+    if image is None:
+        image = render()
+        with _plots_lock:
+            _plots[digest] = image
+    return image
+
+
+def get_mobile_ranges(results):
+    '''
+    Return the mobile range of each result of an array of results
+    '''
+    previous = np.concatenate(([0.0], results[:-1]))
+    return np.where(previous != 0, np.abs(results - previous), 0.0)
+
+
+def get_sum(values):
+    '''
+    Return the sum of an array of values added in order, the pairwise
+    summation of numpy may differ in the last digits and change the
+    rounding of the statistics
+    '''
+    if not len(values):
+        return 0.0
+    return float(np.cumsum(values)[-1])
+
+
+def get_statistics(results):
+    '''
+    Return the mean, the standard deviation (with Bessel's correction) and
+    the mobile ranges of an array of results
+    '''
+    count = len(results)
+    mr = get_mobile_ranges(results)
+    if count > 2:
+        mr_avg_abs_diff = round(get_sum(mr) / (count - 1), 2)
+    else:
+        mr_avg_abs_diff = get_sum(mr)
+    mean = round(get_sum(results) / count, 2)
+    if count > 1:
+        deviation = round(sqrt(
+            get_sum((results - mean) ** 2) / (count - 1)), 2)
+    else:
+        deviation = 0.00
+    return {
+        'mean': mean,
+        'deviation': deviation,
+        'mr': mr.tolist(),
+        'mr_avg_abs_diff': mr_avg_abs_diff,
+        }
 
 
 class RangeType(ModelSQL, ModelView):
@@ -729,132 +798,117 @@ class MeansDeviationsCalc(Wizard):
         return res
 
     def transition_search(self):
-        cursor = Transaction().connection.cursor()
         pool = Pool()
         ControlResultLine = pool.get('lims.control.result_line')
+
+        records = {}
+        for row in self._get_lines_results():
+            (line_id, end_date, result, product_type_id, matrix_id,
+                fraction_type_id, analysis_id, concentration_level_id,
+                fraction_id, device_id) = row
+            try:
+                result = float(result or None)
+            except (TypeError, ValueError):
+                continue
+
+            key = (product_type_id, matrix_id, analysis_id,
+                concentration_level_id)
+            if key not in records:
+                records[key] = {
+                    'product_type': product_type_id,
+                    'matrix': matrix_id,
+                    'fraction_type': fraction_type_id,
+                    'analysis': analysis_id,
+                    'concentration_level': concentration_level_id,
+                    'details': [],
+                    'results': [],
+                    }
+            records[key]['details'].append({
+                'date': end_date,
+                'fraction': fraction_id,
+                'device': device_id,
+                'result': result,
+                })
+            records[key]['results'].append(result)
+
+        if not records:
+            return 'empty'
+
+        to_create = []
+        for record in records.values():
+            statistics = get_statistics(np.array(record['results']))
+            for detail, mr in zip(record['details'], statistics['mr']):
+                detail['mr'] = mr
+            to_create.append({
+                'session_id': self._session_id,
+                'product_type': record['product_type'],
+                'matrix': record['matrix'],
+                'fraction_type': record['fraction_type'],
+                'analysis': record['analysis'],
+                'concentration_level': record['concentration_level'],
+                'mean': statistics['mean'],
+                'deviation': statistics['deviation'],
+                'mr_avg_abs_diff': statistics['mr_avg_abs_diff'],
+                'details': [('create', record['details'])],
+                })
+        self.result.lines = ControlResultLine.create(to_create)
+        return 'result'
+
+    def _get_lines_results(self):
+        '''
+        Return the results of the period ordered by date, with the keys
+        needed to group them, in a single query
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        NotebookLine = pool.get('lims.notebook.line')
+        Notebook = pool.get('lims.notebook')
+        Fraction = pool.get('lims.fraction')
+        Sample = pool.get('lims.sample')
+        Analysis = pool.get('lims.analysis')
         AnalysisFamilyCertificant = pool.get(
             'lims.analysis.family.certificant')
-        NotebookLine = pool.get('lims.notebook.line')
 
-        clause = [
-            ('laboratory', '=', self.start.laboratory.id),
-            ('end_date', '>=', self.start.date_from),
-            ('end_date', '<=', self.start.date_to),
-            ('notebook.fraction.type', '=', self.start.fraction_type.id),
-            ('analysis.behavior', '=', 'normal'),
-            ('result', 'not in', [None, '']),
-            ('annulled', '=', False),
-            ]
+        sql_select = ('SELECT nl.id, nl.end_date, nl.result, '
+                's.product_type, s.matrix, f.type, nl.analysis, '
+                'nl.concentration_level, n.fraction, nl.device ')
+        sql_from = (
+            'FROM "' + NotebookLine._table + '" nl '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.id = nl.notebook '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = n.fraction '
+                'INNER JOIN "' + Sample._table + '" s '
+                'ON s.id = f.sample '
+                'INNER JOIN "' + Analysis._table + '" a '
+                'ON a.id = nl.analysis ')
+        sql_where = ('WHERE nl.laboratory = %s '
+                'AND nl.end_date >= %s '
+                'AND nl.end_date <= %s '
+                'AND f.type = %s '
+                'AND a.behavior = \'normal\' '
+                'AND nl.result IS NOT NULL '
+                'AND nl.result != \'\' '
+                'AND nl.annulled = FALSE ')
+        sql_params = [self.start.laboratory.id, self.start.date_from,
+            self.start.date_to, self.start.fraction_type.id]
         if self.start.product_type:
-            clause.append(('notebook.product_type', '=',
-                self.start.product_type.id))
+            sql_where += 'AND s.product_type = %s '
+            sql_params.append(self.start.product_type.id)
         if self.start.matrix:
-            clause.append(('notebook.matrix', '=', self.start.matrix.id))
-        check_family = False
+            sql_where += 'AND s.matrix = %s '
+            sql_params.append(self.start.matrix.id)
         if self.start.family:
-            check_family = True
-            families = []
-            cursor.execute('SELECT product_type, matrix '
+            sql_where += ('AND (s.product_type, s.matrix) IN ('
+                'SELECT product_type, matrix '
                 'FROM "' + AnalysisFamilyCertificant._table + '" '
-                'WHERE family = %s',
-                (self.start.family.id,))
-            res = cursor.fetchall()
-            if res:
-                families = [(x[0], x[1]) for x in res]
+                'WHERE family = %s) ')
+            sql_params.append(self.start.family.id)
+        sql_order = 'ORDER BY nl.end_date ASC, nl.id ASC'
 
-        lines = NotebookLine.search(clause,
-            order=[('end_date', 'ASC'), ('id', 'ASC')])
-        if lines:
-            records = {}
-            for line in lines:
-                try:
-                    result = float(line.result or None)
-                except (TypeError, ValueError):
-                    continue
-
-                if check_family:
-                    family_key = (line.notebook.product_type.id,
-                        line.notebook.matrix.id)
-                    if family_key not in families:
-                        continue
-
-                product_type_id = line.notebook.product_type.id
-                matrix_id = line.notebook.matrix.id
-                fraction_type_id = line.notebook.fraction_type.id
-                analysis_id = line.analysis.id
-                concentration_level_id = (line.concentration_level.id if
-                    line.concentration_level else None)
-
-                key = (product_type_id, matrix_id, analysis_id,
-                    concentration_level_id)
-                if key not in records:
-                    records[key] = {
-                        'product_type': product_type_id,
-                        'matrix': matrix_id,
-                        'fraction_type': fraction_type_id,
-                        'analysis': analysis_id,
-                        'concentration_level': concentration_level_id,
-                        'details': {},
-                        'mr_last_result': None,
-                        }
-                mr = (records[key]['mr_last_result'] and
-                    abs(result - records[key]['mr_last_result']) or 0.0)
-                records[key]['mr_last_result'] = result
-                records[key]['details'][line.id] = {
-                    'date': line.end_date,
-                    'fraction': line.notebook.fraction.id,
-                    'device': line.device.id if line.device else None,
-                    'result': result,
-                    'mr': mr,
-                    }
-            if records:
-                to_create = []
-                for record in records.values():
-                    details = [d for d in record['details'].values()]
-                    to_create.append({
-                        'session_id': self._session_id,
-                        'product_type': record['product_type'],
-                        'matrix': record['matrix'],
-                        'fraction_type': record['fraction_type'],
-                        'analysis': record['analysis'],
-                        'concentration_level': record['concentration_level'],
-                        'details': [('create', details)],
-                        })
-                if to_create:
-                    res_lines = ControlResultLine.create(to_create)
-
-                    to_save = []
-                    for line in res_lines:
-                        count = 0
-                        total = 0.00
-                        mr_abs_diff = 0.00
-                        for detail in line.details:
-                            count += 1
-                            total += detail.result
-                            mr_abs_diff += detail.mr
-                        if count > 2:
-                            mr_avg_abs_diff = round(
-                                mr_abs_diff / (count - 1), 2)
-                        else:
-                            mr_avg_abs_diff = mr_abs_diff
-                        mean = round(total / count, 2)
-                        total = 0.00
-                        for detail in line.details:
-                            total += (detail.result - mean) ** 2
-                        # Se toma correcion poblacional Bessel n-1
-                        if count > 1:
-                            deviation = round(sqrt(total / (count - 1)), 2)
-                        else:
-                            deviation = 0.00
-                        line.mean = mean
-                        line.deviation = deviation
-                        line.mr_avg_abs_diff = mr_avg_abs_diff
-                        to_save.append(line)
-                    ControlResultLine.save(to_save)
-
-                    self.result.lines = res_lines
-                    return 'result'
-        return 'empty'
+        cursor.execute(sql_select + sql_from + sql_where + sql_order,
+            sql_params)
+        return cursor.fetchall()
 
     def default_result(self, fields):
         lines = [l.id for l in self.result.lines]
@@ -1053,9 +1107,6 @@ class TendenciesAnalysis(Wizard):
         ControlTendencyDetail = pool.get('lims.control.tendency.detail')
         AnalysisFamilyCertificant = pool.get(
             'lims.analysis.family.certificant')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        tendency_result = []
 
         clause = [
             ('fraction_type', '=', self.start.fraction_type.id),
@@ -1066,128 +1117,154 @@ class TendenciesAnalysis(Wizard):
             clause.append(('matrix', '=', self.start.matrix.id))
 
         tendencies = ControlTendency.search(clause)
-        if tendencies:
-            check_family = False
-            if self.start.family:
-                check_family = True
-                families = []
-                cursor.execute('SELECT product_type, matrix '
-                    'FROM "' + AnalysisFamilyCertificant._table + '" '
-                    'WHERE family = %s',
-                    (self.start.family.id,))
-                res = cursor.fetchall()
-                if res:
-                    families = [(x[0], x[1]) for x in res]
-
-            for tendency in tendencies:
-                if check_family:
-                    family_key = (tendency.product_type.id, tendency.matrix.id)
-                    if family_key not in families:
+        if not tendencies:
+            return 'end'
+
+        if self.start.family:
+            cursor.execute('SELECT product_type, matrix '
+                'FROM "' + AnalysisFamilyCertificant._table + '" '
+                'WHERE family = %s',
+                (self.start.family.id,))
+            families = set((x[0], x[1]) for x in cursor.fetchall())
+            tendencies = [t for t in tendencies
+                if (t.product_type.id, t.matrix.id) in families]
+
+        old_details = ControlTendencyDetail.search([
+            ('tendency', 'in', [t.id for t in tendencies]),
+            ])
+        if old_details:
+            ControlTendencyDetail.delete(old_details)
+
+        tendency_result = []
+        to_create = []
+        to_write = []
+        for tendency in tendencies:
+            rows, prev_rows = self._get_tendency_results(tendency)
+
+            counts = dict((r, 0) for r in ('1', '2', '3', '4'))
+            if rows:
+                # Qty of previous results required
+                prev_rows = prev_rows[:max(8 - len(rows), 0)]
+                prev_results = []
+                for row in prev_rows:
+                    try:
+                        prev_results.append(float(row[2] or None))
+                    except (TypeError, ValueError):
                         continue
 
-                old_details = ControlTendencyDetail.search([
-                    ('tendency', '=', tendency.id),
-                    ])
-                if old_details:
-                    ControlTendencyDetail.delete(old_details)
-
-                concentration_level_id = (tendency.concentration_level.id if
-                    tendency.concentration_level else None)
-                clause = [
-                    ('laboratory', '=', self.start.laboratory.id),
-                    ('notebook.fraction.type', '=', tendency.fraction_type.id),
-                    ('notebook.product_type', '=', tendency.product_type.id),
-                    ('notebook.matrix', '=', tendency.matrix.id),
-                    ('analysis', '=', tendency.analysis.id),
-                    ('concentration_level', '=', concentration_level_id),
-                    ('result', 'not in', [None, '']),
-                    ('annulled', '=', False),
-                    ]
-
-                rule_1_count = 0
-                rule_2_count = 0
-                rule_3_count = 0
-                rule_4_count = 0
-                lines = NotebookLine.search(clause + [
-                        ('end_date', '>=', self.start.date_from),
-                        ('end_date', '<=', self.start.date_to),
-                        ], order=[('end_date', 'ASC'), ('id', 'ASC')])
-                if lines:
-                    results = []
-                    prevs = 8 - len(lines)  # Qty of previous results required
-                    if prevs > 0:
-                        prev_lines = NotebookLine.search(clause + [
-                                ('end_date', '<', self.start.date_from),
-                                ], order=[('end_date', 'ASC'), ('id', 'ASC')],
-                                limit=prevs)
-                        if prev_lines:
-                            for line in prev_lines:
-                                try:
-                                    result = float(line.result if
-                                        line.result else None)
-                                except(TypeError, ValueError):
-                                    continue
-                                results.append(result)
-
-                    mr_last_result = None
-                    to_create = []
-                    for line in lines:
-                        try:
-                            result = float(line.result if
-                                line.result else None)
-                        except(TypeError, ValueError):
-                            continue
-                        mr = (mr_last_result and
-                              abs(result - mr_last_result) or 0.0)
-                        mr_last_result = result
-                        results.append(result)
-                        rules = self.get_rules(results, tendency)
-                        rules_to_create = []
-                        for r in rules:
-                            if r == '':
-                                continue
-                            rules_to_create.append({'rule': r})
-                            if r == '1':
-                                rule_1_count += 1
-                            elif r == '2':
-                                rule_2_count += 1
-                            elif r == '3':
-                                rule_3_count += 1
-                            elif r == '4':
-                                rule_4_count += 1
-
-                        record = {
-                            'notebook_line': line.id,
-                            'tendency': tendency.id,
-                            'date': line.end_date,
-                            'fraction': line.notebook.fraction.id,
-                            'device': line.device.id if line.device else None,
-                            'result': result,
-                            'rule': rules[0],
-                            'mr': mr,
-                            }
-                        if rules_to_create:
-                            record['rules'] = [('create', rules_to_create)]
-                        to_create.append(record)
-
-                    ControlTendencyDetail.create(to_create)
-                    tendency_result.append(tendency)
-
-                ControlTendency.write([tendency], {
-                    'rule_1_count': rule_1_count,
-                    'rule_2_count': rule_2_count,
-                    'rule_3_count': rule_3_count,
-                    'rule_4_count': rule_4_count,
-                    })
+                details = []
+                for line_id, end_date, result, fraction_id, device_id in rows:
+                    try:
+                        result = float(result or None)
+                    except (TypeError, ValueError):
+                        continue
+                    details.append({
+                        'notebook_line': line_id,
+                        'tendency': tendency.id,
+                        'date': end_date,
+                        'fraction': fraction_id,
+                        'device': device_id,
+                        'result': result,
+                        })
 
-            if tendency_result:
-                self.result.tendencies = tendency_result
-                return 'open'
+                results = np.array(prev_results +
+                    [d['result'] for d in details])
+                mrs = get_mobile_ranges(results[len(prev_results):]).tolist()
+                results_rules = self.get_rules(results, tendency)[
+                    len(prev_results):]
+                for detail, mr, rules in zip(details, mrs, results_rules):
+                    detail['rule'] = rules[0]
+                    detail['mr'] = mr
+                    rules = [r for r in rules if r != '']
+                    if rules:
+                        detail['rules'] = [('create',
+                            [{'rule': r} for r in rules])]
+                    for r in rules:
+                        counts[r] += 1
+                to_create.extend(details)
+                tendency_result.append(tendency)
+
+            to_write.extend(([tendency], {
+                'rule_1_count': counts['1'],
+                'rule_2_count': counts['2'],
+                'rule_3_count': counts['3'],
+                'rule_4_count': counts['4'],
+                }))
+
+        if to_create:
+            ControlTendencyDetail.create(to_create)
+        if to_write:
+            ControlTendency.write(*to_write)
+
+        if tendency_result:
+            self.result.tendencies = tendency_result
+            return 'open'
         return 'end'
 
-    def get_rules(self, results, tendency):
+    def _get_tendency_results(self, tendency):
+        '''
+        Return the results of the tendency in the period and the previous
+        ones, ordered by date, in a single query
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        NotebookLine = pool.get('lims.notebook.line')
+        Notebook = pool.get('lims.notebook')
+        Fraction = pool.get('lims.fraction')
+        Sample = pool.get('lims.sample')
+
+        sql_where = ('WHERE nl.laboratory = %s '
+                'AND f.type = %s '
+                'AND s.product_type = %s '
+                'AND s.matrix = %s '
+                'AND nl.analysis = %s '
+                'AND nl.result IS NOT NULL '
+                'AND nl.result != \'\' '
+                'AND nl.annulled = FALSE '
+                'AND nl.end_date <= %s ')
+        sql_params = [self.start.date_from, self.start.date_from,
+            self.start.laboratory.id, tendency.fraction_type.id,
+            tendency.product_type.id, tendency.matrix.id,
+            tendency.analysis.id, self.start.date_to]
+        if tendency.concentration_level:
+            sql_where += 'AND nl.concentration_level = %s '
+            sql_params.append(tendency.concentration_level.id)
+        else:
+            sql_where += 'AND nl.concentration_level IS NULL '
+
+        # Only the first 8 previous results can be required
+        cursor.execute('SELECT id, end_date, result, fraction, device, prev '
+            'FROM ('
+                'SELECT nl.id, nl.end_date, nl.result, n.fraction, '
+                    'nl.device, nl.end_date < %s AS prev, '
+                    'ROW_NUMBER() OVER (PARTITION BY nl.end_date < %s '
+                    'ORDER BY nl.end_date ASC, nl.id ASC) AS number '
+                'FROM "' + NotebookLine._table + '" nl '
+                    'INNER JOIN "' + Notebook._table + '" n '
+                    'ON n.id = nl.notebook '
+                    'INNER JOIN "' + Fraction._table + '" f '
+                    'ON f.id = n.fraction '
+                    'INNER JOIN "' + Sample._table + '" s '
+                    'ON s.id = f.sample ' +
+                sql_where +
+            ') l '
+            'WHERE NOT prev OR number <= 8 '
+            'ORDER BY end_date ASC, id ASC',
+            sql_params)
+        rows, prev_rows = [], []
+        for row in cursor.fetchall():
+            if row[-1]:
+                prev_rows.append(row[:-1])
+            else:
+                rows.append(row[:-1])
+        return rows, prev_rows
 
-        rules = []
+    def get_rules(self, results, tendency):
+        '''
+        Return the rules broken by each one of the results, checking every
+        rule over the whole array at once
+        '''
+        checks = []
 
         # Check rule 4
         # 1 value above or below the mean +/- 3 SD
@@ -1195,9 +1272,8 @@ class TendenciesAnalysis(Wizard):
         lower_parameter = tendency.mean - tendency.three_sd_adj
         occurrences = 1
         total = 1
-        if self._check_rule(results, upper_parameter, lower_parameter,
-                occurrences, total):
-            rules.append('4')
+        checks.append(('4', self._check_rule(results, upper_parameter,
+            lower_parameter, occurrences, total)))
 
         # Check rule 3
         # 2 of 3 consecutive values above or below the mean +/- 2 SD
@@ -1205,9 +1281,8 @@ class TendenciesAnalysis(Wizard):
         lower_parameter = tendency.mean - tendency.two_sd_adj
         occurrences = 2
         total = 3
-        if self._check_rule(results, upper_parameter, lower_parameter,
-                occurrences, total):
-            rules.append('3')
+        checks.append(('3', self._check_rule(results, upper_parameter,
+            lower_parameter, occurrences, total)))
 
         # Check rule 2
         # 4 of 5 consecutive values above or below the mean +/- 1 SD
@@ -1215,9 +1290,8 @@ class TendenciesAnalysis(Wizard):
         lower_parameter = tendency.mean - tendency.one_sd_adj
         occurrences = 4
         total = 5
-        if self._check_rule(results, upper_parameter, lower_parameter,
-                occurrences, total):
-            rules.append('2')
+        checks.append(('2', self._check_rule(results, upper_parameter,
+            lower_parameter, occurrences, total)))
 
         # Check rule 1
         # 8 consecutive values above or below the mean
@@ -1225,52 +1299,36 @@ class TendenciesAnalysis(Wizard):
         lower_parameter = tendency.mean
         occurrences = 8
         total = 8
-        if self._check_rule(results, upper_parameter, lower_parameter,
-                occurrences, total):
-            rules.append('1')
+        checks.append(('1', self._check_rule(results, upper_parameter,
+            lower_parameter, occurrences, total)))
 
-        if not rules:
-            rules.append('')
-
-        return rules
+        results_rules = []
+        for i in range(len(results)):
+            rules = [rule for rule, check in checks if check[i]]
+            if not rules:
+                rules.append('')
+            results_rules.append(rules)
+        return results_rules
 
     def _check_rule(self, results, upper_parameter, lower_parameter,
             occurrences, total):
-
+        '''
+        Return for each result if, among the last total results up to it,
+        there are occurrences consecutive values above the upper parameter
+        or below the lower parameter
+        '''
+        checks = np.zeros(len(results), dtype=bool)
         if len(results) < total:
-            return False
-
-        total_counter = 0
-        upper_counter = 0
-        lower_counter = 0
-        for result in reversed(results):
-
-            total_counter += 1
-            if result > upper_parameter:
-                upper_counter += 1
-                if total_counter == total:
-                    if (upper_counter >= occurrences or
-                            lower_counter >= occurrences):
-                        return True
-                    return False
-                lower_counter = 0
-            elif result < lower_parameter:
-                lower_counter += 1
-                if total_counter == total:
-                    if (lower_counter >= occurrences or
-                            upper_counter >= occurrences):
-                        return True
-                    return False
-                upper_counter = 0
-            else:
-                if total_counter == total:
-                    if (upper_counter >= occurrences or
-                            lower_counter >= occurrences):
-                        return True
-                    return False
-                upper_counter = 0
-                lower_counter = 0
-        return False
+            return checks
+
+        for outside in (results > upper_parameter,
+                results < lower_parameter):
+            # runs[i]: the occurrences results from i are outside
+            runs = np.convolve(outside.astype(int),
+                np.ones(occurrences, dtype=int), 'valid') == occurrences
+            checks[total - 1:] |= sliding_window_view(runs,
+                total - occurrences + 1).any(axis=1)
+        return checks
 
     def do_open(self, action):
         action['pyson_domain'] = PYSONEncoder().encode([
@@ -1377,6 +1435,11 @@ class ControlChartReport(Report):
         for r in sorted(list(records.values()), key=lambda x: x['order']):
             cols.append(r['name'])
             ds[r['name']] = [r['recs'][col] for col in index]
+        key = (cls.__name__, index, [(c, ds[c]) for c in cols])
+        return get_plot_image(key, partial(cls._render_plot, index, cols, ds))
+
+    @classmethod
+    def _render_plot(cls, index, cols, ds):
         df = pd.DataFrame(ds, index=index)
         df = df.reindex(cols, axis=1)
 
@@ -1409,6 +1472,7 @@ class ControlChartReport(Report):
 
             ax.legend(loc='center left', bbox_to_anchor=(1.0, 0.5))
             ax.get_figure().savefig(output, bbox_inches='tight', dpi=300)
+            plt.close(ax.get_figure())
             image = output.getvalue()
             output.close()
             return image
@@ -1600,7 +1664,6 @@ class TrendChart(ModelSQL, ModelView):
         pool = Pool()
         TrendChartData = pool.get('lims.trend.chart.data')
 
-        index = []
         cols, cols_y2 = {}, {}
         ds, ds2 = {}, {}
 
@@ -1616,20 +1679,27 @@ class TrendChart(ModelSQL, ModelView):
             ds2[cols_y2[name]] = []
             i += 1
 
-        records = TrendChartData.search([
+        records = TrendChartData.search_read([
             ('session_id', '=', session_id),
-            ])
-        for r in records:
-            index.append(r.x_axis)
-            for a_name, a_description in cols.items():
-                val = getattr(r, a_name, None)
-                ds[a_description].append(float(val)
-                    if val is not None else None)
-            for a_name, a_description in cols_y2.items():
-                val = getattr(r, a_name, None)
-                ds2[a_description].append(float(val)
-                    if val is not None else None)
-
+            ], fields_names=['x_axis'] + list(cols) + list(cols_y2))
+        index = [r['x_axis'] for r in records]
+        for a_name, a_description in cols.items():
+            ds[a_description] = [float(r[a_name])
+                if r[a_name] is not None else None for r in records]
+        for a_name, a_description in cols_y2.items():
+            ds2[a_description] = [float(r[a_name])
+                if r[a_name] is not None else None for r in records]
+
+        key = (self.__name__, index,
+            [(c, ds[c]) for c in cols.values()],
+            [(c, ds2[c]) for c in cols_y2.values()],
+            self.x_axis_string,
+            self.uom and self.uom.symbol,
+            self.uom_y2 and self.uom_y2.symbol)
+        return get_plot_image(key, partial(self._render_plot, index,
+            cols, ds, cols_y2, ds2))
+
+    def _render_plot(self, index, cols, ds, cols_y2, ds2):
         df = pd.DataFrame(ds, index=index)
         df = df.reindex(cols.values(), axis=1)
         df = df.interpolate()
@@ -1657,6 +1727,7 @@ class TrendChart(ModelSQL, ModelView):
                         pass
 
                 ax.get_figure().savefig(output, bbox_inches='tight', dpi=300)
+                plt.close(ax.get_figure())
                 image = output.getvalue()
                 output.close()
             return image
@@ -1673,6 +1744,7 @@ class TrendChart(ModelSQL, ModelView):
 
                     ax.get_figure().savefig(output, bbox_inches='tight',
                         dpi=300)
+                    plt.close(ax.get_figure())
                     image = output.getvalue()
                     output.close()
                     return image
@@ -1683,11 +1755,21 @@ class TrendChart(ModelSQL, ModelView):
 
     @classmethod
     def clean(cls):
+        '''
+        Delete the inactive charts and the data of the sessions that have
+        not been refreshed for a day, keeping the data of open charts
+        '''
+        cursor = Transaction().connection.cursor()
         TrendChartData = Pool().get('lims.trend.chart.data')
         to_delete = cls.search([('active', '=', False)])
         cls.delete(to_delete)
-        to_delete = TrendChartData.search([])
-        TrendChartData.delete(to_delete)
+        cursor.execute('DELETE FROM "' + TrendChartData._table + '" '
+            'WHERE session_id IN ('
+                'SELECT session_id '
+                'FROM "' + TrendChartData._table + '" '
+                'GROUP BY session_id '
+                'HAVING MAX(create_date) < %s)',
+            (datetime.now() - timedelta(days=1),))
 
 
 class TrendChartAnalysis(ModelSQL, ModelView):
@@ -1131,11 +1131,14 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
+        AnalysisPendingService = Pool().get('lims.analysis.pending_service')
         vlist = [x.copy() for x in vlist]
         for values in vlist:
             values['plannable'] = cls._get_plannable(values)
         details = super().create(vlist)
         cls._set_referable(details)
+        AnalysisPendingService.delay_update_services(
+            [d.service.id for d in details])
         return details
 
     @classmethod
@@ -1161,19 +1164,17 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
 
     @classmethod
     def delete(cls, details):
+        AnalysisPendingService = Pool().get('lims.analysis.pending_service')
         if Transaction().user != 0:
             cls.check_delete(details)
+        service_ids = [d.service.id for d in details]
         super().delete(details)
+        AnalysisPendingService.delay_update_services(service_ids)
 
     @classmethod
     def create_notebook_lines(cls, details, fraction):
-        cursor = Transaction().connection.cursor()
         pool = Pool()
         Typification = pool.get('lims.typification')
-        Method = pool.get('lims.lab.method')
-        WaitingTime = pool.get('lims.lab.method.results_waiting')
-        AnalysisLaboratory = pool.get('lims.analysis-laboratory')
-        ProductType = pool.get('lims.product.type')
         Notebook = pool.get('lims.notebook')
         NotebookLine = pool.get('lims.notebook.line')
         Config = pool.get('lims.configuration')
@@ -1182,11 +1183,17 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
         with Transaction().set_user(0):
             notebook, = Notebook.search([('fraction', '=', fraction.id)])
 
+        keys = dict((d.id, (fraction.product_type.id, fraction.matrix.id,
+            d.analysis.id, d.method.id)) for d in details)
+        typifications = Typification.get_valid_typifications(
+            set(keys.values()))
+        waiting_times = cls._get_results_estimated_waiting(details)
+        departments = cls._get_departments(details, fraction)
+
         lines_to_create = []
+        lines_keys = []
         for detail in details:
-            t = Typification.get_valid_typification(
-                fraction.product_type.id, fraction.matrix.id,
-                detail.analysis.id, detail.method.id)
+            t = typifications[keys[detail.id]]
 
             if t:
                 repetitions = t.default_repetitions
@@ -1217,40 +1224,6 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
                 scientific_notation = False
                 report = False
 
-            results_estimated_waiting = None
-            cursor.execute('SELECT results_estimated_waiting '
-                'FROM "' + WaitingTime._table + '" '
-                'WHERE method = %s '
-                    'AND party = %s',
-                (detail.method.id, detail.party.id))
-            res = cursor.fetchone()
-            if res:
-                results_estimated_waiting = res[0]
-            else:
-                cursor.execute('SELECT results_estimated_waiting '
-                    'FROM "' + Method._table + '" '
-                    'WHERE id = %s', (detail.method.id,))
-                res = cursor.fetchone()
-                if res:
-                    results_estimated_waiting = res[0]
-
-            department = None
-            cursor.execute('SELECT department '
-                'FROM "' + AnalysisLaboratory._table + '" '
-                'WHERE analysis = %s '
-                    'AND laboratory = %s',
-                    (detail.analysis.id, detail.laboratory.id))
-            res = cursor.fetchone()
-            if res and res[0]:
-                department = res[0]
-            else:
-                cursor.execute('SELECT department '
-                    'FROM "' + ProductType._table + '" '
-                    'WHERE id = %s', (fraction.product_type.id,))
-                res = cursor.fetchone()
-                if res and res[0]:
-                    department = res[0]
-
             for i in range(0, repetitions + 1):
                 notebook_line = {
                     'notebook': notebook.id,
@@ -1275,28 +1248,34 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
                     'significant_digits': significant_digits,
                     'scientific_notation': scientific_notation,
                     'report': report,
-                    'results_estimated_waiting': results_estimated_waiting,
-                    'department': department,
+                    'results_estimated_waiting': waiting_times[detail.id],
+                    'department': departments[detail.id],
                     }
                 lines_to_create.append(notebook_line)
+                lines_keys.append(keys[detail.id])
 
         with Transaction().set_user(0):
             lines = NotebookLine.create(lines_to_create)
 
             # copy translated fields from typification
+            typification_ids = dict((k, t.id)
+                for k, t in typifications.items() if t)
+            if not typification_ids:
+                return
             default_language = Config(1).results_report_language
             for lang in Lang.search([
                     ('translatable', '=', True),
                     ('code', '!=', default_language.code),
                     ]):
                 with Transaction().set_context(language=lang.code):
+                    typifications_lang = dict((t.id, t) for t in
+                        Typification.browse(list(set(
+                            typification_ids.values()))))
                     lines_to_save = []
-                    for line in lines:
-                        t = Typification.get_valid_typification(
-                            line.product_type.id, line.matrix.id,
-                            line.analysis.id, line.method.id)
-                        if not t:
+                    for line, key in zip(lines, lines_keys):
+                        if key not in typification_ids:
                             continue
+                        t = typifications_lang[typification_ids[key]]
                         line_lang = NotebookLine(line.id)
                         line_lang.initial_concentration = (
                             t.initial_concentration)
@@ -1305,6 +1284,80 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
                         lines_to_save.append(line_lang)
                     NotebookLine.save(lines_to_save)
 
+    @classmethod
+    def _get_results_estimated_waiting(cls, details):
+        '''
+        Return a dict with the results estimated waiting of each detail,
+        taken from its party waiting times or else from its method
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Method = pool.get('lims.lab.method')
+        WaitingTime = pool.get('lims.lab.method.results_waiting')
+
+        res = dict((d.id, None) for d in details)
+        if not details:
+            return res
+
+        method_ids = list(set(d.method.id for d in details))
+        method_party = list(set((d.method.id, d.party.id) for d in details))
+
+        waiting_times = {}
+        cursor.execute('SELECT method, party, results_estimated_waiting '
+            'FROM "' + WaitingTime._table + '" '
+            'WHERE (method, party) IN %s',
+            (tuple(method_party),))
+        for x in cursor.fetchall():
+            waiting_times.setdefault((x[0], x[1]), x[2])
+
+        methods_waiting = {}
+        cursor.execute('SELECT id, results_estimated_waiting '
+            'FROM "' + Method._table + '" '
+            'WHERE id IN %s',
+            (tuple(method_ids),))
+        for x in cursor.fetchall():
+            methods_waiting[x[0]] = x[1]
+
+        for d in details:
+            key = (d.method.id, d.party.id)
+            if key in waiting_times:
+                res[d.id] = waiting_times[key]
+            else:
+                res[d.id] = methods_waiting.get(d.method.id)
+        return res
+
+    @classmethod
+    def _get_departments(cls, details, fraction):
+        '''
+        Return a dict with the department of each detail, taken from its
+        analysis laboratory or else from the fraction product type
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        AnalysisLaboratory = pool.get('lims.analysis-laboratory')
+
+        res = dict((d.id, None) for d in details)
+        if not details:
+            return res
+
+        analysis_laboratory = list(set((d.analysis.id, d.laboratory.id)
+            for d in details))
+
+        departments = {}
+        cursor.execute('SELECT analysis, laboratory, department '
+            'FROM "' + AnalysisLaboratory._table + '" '
+            'WHERE (analysis, laboratory) IN %s',
+            (tuple(analysis_laboratory),))
+        for x in cursor.fetchall():
+            departments.setdefault((x[0], x[1]), x[2])
+
+        product_type_department = (fraction.product_type.department and
+            fraction.product_type.department.id or None)
+        for d in details:
+            res[d.id] = (departments.get((d.analysis.id, d.laboratory.id)) or
+                product_type_department)
+        return res
+
     @staticmethod
     def default_service_view():
         if (Transaction().context.get('service', 0) > 0):
@@ -1438,9 +1491,15 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
 
     @classmethod
     def write(cls, *args):
+        AnalysisPendingService = Pool().get('lims.analysis.pending_service')
         super().write(*args)
         actions = iter(args)
         for details, vals in zip(actions, actions):
+            for field in ('service', 'analysis', 'plannable', 'state'):
+                if field in vals:
+                    AnalysisPendingService.delay_update_services(
+                        [d.service.id for d in details])
+                    break
             change_cie_data = False
             for field in ('cie_min_value', 'cie_max_value'):
                 if vals.get(field):
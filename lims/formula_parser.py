@@ -2,37 +2,73 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from threading import Lock
 
 from trytond.model import Model
+from trytond.cache import LRUDict
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
+CONSTANTS = {
+    'pi': 3.141592653589793,
+    'e': 2.718281828459045,
+    }
 
-class FormulaParser(Model):
-    'Formula Parser'
-    __slots__ = ('_string', '_index', '_vars')
 
-    def __init__(self, string, vars={}, id=None, **kwargs):
-        self._string = string
-        self._index = 0
-        self._vars = {
-            'pi': 3.141592653589793,
-            'e': 2.718281828459045,
-            }
+class CompiledFormula(object):
+    'Compiled Formula'
+    __slots__ = ('string', 'variables', '_evaluate')
+
+    def __init__(self, string, variables, evaluate):
+        self.string = string
+        self.variables = variables
+        self._evaluate = evaluate
+
+    def get_variables(self, vars):
+        variables = CONSTANTS.copy()
         for var in list(vars.keys()):
-            if self._vars.get(var) is not None:
+            if variables.get(var) is not None:
                 raise UserError(gettext(
                     'lims.msg_variable_redefine', variable=var))
-            self._vars[var] = vars[var]
-        super().__init__(id, **kwargs)
+            variables[var] = vars[var]
+        # All the variables of the formula are checked before evaluating
+        # it, as some of them may not be reached (e.g. after a division by
+        # zero)
+        for var in self.variables:
+            if variables.get(var) is None:
+                raise UserError(gettext(
+                    'lims.msg_unrecognized_variable', variable=var))
+        return variables
 
-    def getValue(self):
-        value = self.parseExpression()
+    def evaluate(self, vars={}):
+        return self._evaluate(self.get_variables(vars))
+
+    def evaluate_many(self, vars_list):
+        evaluate = self._evaluate
+        return [evaluate(self.get_variables(vars)) for vars in vars_list]
+
+
+class FormulaCompiler(object):
+    '''
+    Recursive descent parser that turns a formula string into a tree of
+    closures, so that it can be evaluated many times without parsing it
+    again.
+    '''
+    __slots__ = ('_string', '_index', '_variables')
+
+    def __init__(self, string):
+        self._string = string
+        self._index = 0
+        self._variables = set()
+
+    def compile(self):
+        node = self.parseExpression()
         self.skipWhitespace()
         if self.hasNext():
             raise UserError(gettext('lims.msg_unexpected_character',
                 character=self.peek(), index=str(self._index)))
-        return value
+        return CompiledFormula(self._string, frozenset(self._variables),
+            node)
 
     def peek(self):
         return self._string[self._index:self._index + 1]
@@ -51,71 +87,86 @@ class FormulaParser(Model):
         return self.parseAddition()
 
     def parseAddition(self):
-        values = [self.parseMultiplication()]
+        terms = [(1, self.parseMultiplication())]
         while True:
             self.skipWhitespace()
             char = self.peek()
             if char == '+':
                 self._index += 1
-                values.append(self.parseMultiplication())
+                terms.append((1, self.parseMultiplication()))
             elif char == '-':
                 self._index += 1
-                values.append(-1 * self.parseMultiplication())
+                terms.append((-1, self.parseMultiplication()))
             else:
                 break
-        return sum(values)
+        if len(terms) == 1:
+            return terms[0][1]
+
+        def addition(vars):
+            return sum(node(vars) if sign == 1 else -1 * node(vars)
+                for sign, node in terms)
+        return addition
 
     def parseMultiplication(self):
-        values = [self.parsePower()]
+        factors = [(False, self.parsePower())]
         while True:
             self.skipWhitespace()
             char = self.peek()
             if char == '*':
                 self._index += 1
-                values.append(self.parsePower())
+                factors.append((False, self.parsePower()))
             elif char == '/':
-                # div_index = self._index
                 self._index += 1
-                denominator = self.parsePower()
-                if denominator == 0:
-                    # raise UserError(gettext(
-                    #     'lims.msg_division_zero', index=str(div_index)))
-                    return 0.0
-                values.append(1.0 / denominator)
+                factors.append((True, self.parsePower()))
             else:
                 break
-        value = 1.0
-        for factor in values:
-            value *= factor
-        return value
+        if len(factors) == 1:
+            return factors[0][1]
+
+        def multiplication(vars):
+            value = 1.0
+            for divide, node in factors:
+                factor = node(vars)
+                if divide:
+                    if factor == 0:
+                        return 0.0
+                    factor = 1.0 / factor
+                value *= factor
+            return value
+        return multiplication
 
     def parsePower(self):
-        values = [self.parseParenthesis()]
+        nodes = [self.parseParenthesis()]
         while True:
             self.skipWhitespace()
             char = self.peek()
             if char == '^':
                 self._index += 1
-                values.append(self.parseParenthesis())
+                nodes.append(self.parseParenthesis())
             else:
                 break
-        value = values[0]
-        for exponent in values[1:]:
-            value **= exponent
-        return value
+        if len(nodes) == 1:
+            return nodes[0]
+
+        def power(vars):
+            value = nodes[0](vars)
+            for node in nodes[1:]:
+                value **= node(vars)
+            return value
+        return power
 
     def parseParenthesis(self):
         self.skipWhitespace()
         char = self.peek()
         if char == '(':
             self._index += 1
-            value = self.parseExpression()
+            node = self.parseExpression()
             self.skipWhitespace()
             if self.peek() != ')':
                 raise UserError(gettext(
                     'lims.msg_closing_parenthesis', index=str(self._index)))
             self._index += 1
-            return value
+            return node
         else:
             return self.parseNegative()
 
@@ -124,7 +175,11 @@ class FormulaParser(Model):
         char = self.peek()
         if char == '-':
             self._index += 1
-            return -1 * self.parseParenthesis()
+            node = self.parseParenthesis()
+
+            def negative(vars):
+                return -1 * node(vars)
+            return negative
         else:
             return self.parseValue()
 
@@ -146,18 +201,21 @@ class FormulaParser(Model):
                 self._index += 1
             else:
                 break
-
-        value = self._vars.get(var, None)
-        if value is None:
+        if not var:
             raise UserError(gettext(
                 'lims.msg_unrecognized_variable', variable=var))
-        if value == '':
-            return float(0)
-        try:
-            value = float(value)
-        except (ValueError):
-            return float(0)
-        return value
+        self._variables.add(var)
+
+        def variable(vars):
+            value = vars[var]
+            if value == '':
+                return float(0)
+            try:
+                value = float(value)
+            except (ValueError):
+                return float(0)
+            return value
+        return variable
 
     def parseNumber(self):
         self.skipWhitespace()
@@ -186,4 +244,39 @@ class FormulaParser(Model):
                 raise UserError(gettext('lims.msg_number_expected',
                     index=str(self._index), character=char))
 
-        return float(strValue)
+        value = float(strValue)
+
+        def number(vars):
+            return value
+        return number
+
+
+class FormulaParser(Model):
+    'Formula Parser'
+    __slots__ = ('_string', '_vars')
+    _compiled_cache = LRUDict(1024)
+    _compiled_cache_lock = Lock()
+
+    def __init__(self, string, vars={}, id=None, **kwargs):
+        self._string = string
+        self._vars = vars
+        super().__init__(id, **kwargs)
+
+    def getValue(self):
+        return self.compile(self._string).evaluate(self._vars)
+
+    @classmethod
+    def compile(cls, string):
+        'Return the compiled formula for string, parsing it only once'
+        with cls._compiled_cache_lock:
+            compiled = cls._compiled_cache.get(string)
+        if compiled is None:
+            compiled = FormulaCompiler(string).compile()
+            with cls._compiled_cache_lock:
+                cls._compiled_cache[string] = compiled
+        return compiled
+
+    @classmethod
+    def getValues(cls, string, vars_list):
+        'Evaluate string once per variables dict of vars_list'
+        return cls.compile(string).evaluate_many(vars_list)
@@ -7,6 +7,7 @@ import operator
 from sql import Cast
 
 from trytond.model import ModelView, ModelSQL, DeactivableMixin, fields, Unique
+from trytond.tools import grouped_slice
 from trytond.wizard import Wizard, StateTransition, StateView, Button
 from trytond.pool import Pool
 from trytond.transaction import Transaction
@@ -343,30 +344,43 @@ class LabDevice(DeactivableMixin, ModelSQL, ModelView):
         AnalysisDevice.write(analysis_devices, fields_to_update)
 
     def get_correction(self, value):
+        return self.get_corrections([value])[0]
+
+    def get_corrections(self, values):
+        '''
+        Apply the device correction to every value of values, reading the
+        correction ranges once and evaluating each formula in one batch
+        '''
         cursor = Transaction().connection.cursor()
         DeviceCorrection = Pool().get('lims.lab.device.correction')
 
-        try:
-            value = float(value)
-        except ValueError:
-            return value
-
-        cursor.execute('SELECT formula '
+        cursor.execute('SELECT result_from, result_to, formula '
             'FROM "' + DeviceCorrection._table + '" '
-            'WHERE device = %s '
-                'AND result_from::float <= %s::float '
-                'AND result_to::float >= %s::float',
-            (str(self.id), value, value))
-        correction = cursor.fetchone()
-        if not correction:
-            return value
-
-        formula = correction[0]
-        for i in (' ', '\t', '\n', '\r'):
-            formula = formula.replace(i, '')
-        variables = {'X': value}
-        parser = FormulaParser(formula, variables)
-        return parser.getValue()
+            'WHERE device = %s', (str(self.id),))
+        corrections = [(float(r[0]), float(r[1]), r[2])
+            for r in cursor.fetchall()]
+
+        res = list(values)
+        to_correct = {}
+        for index, value in enumerate(values):
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            res[index] = value
+            for result_from, result_to, formula in corrections:
+                if result_from <= value <= result_to:
+                    to_correct.setdefault(formula, []).append((index, value))
+                    break
+
+        for formula, items in to_correct.items():
+            for i in (' ', '\t', '\n', '\r'):
+                formula = formula.replace(i, '')
+            corrected = FormulaParser.getValues(formula,
+                [{'X': value} for _, value in items])
+            for (index, _), value in zip(items, corrected):
+                res[index] = value
+        return res
 
 
 class LabDeviceType(ModelSQL, ModelView):
@@ -642,41 +656,98 @@ class NotebookRule(ModelSQL, ModelView):
     def get_target_field_domain(self, name=None):
         return self.default_target_field_domain()
 
-    def eval_condition(self, line):
+    @classmethod
+    def get_rules_by_analysis(cls, analysis_ids):
+        '''Return a dict with the rules of each trigger analysis'''
+        res = {}
+        for sub_ids in grouped_slice(list(set(analysis_ids))):
+            for rule in cls.search([('analysis', 'in', list(sub_ids))]):
+                res.setdefault(rule.analysis.id, []).append(rule)
+        return res
+
+    def eval_condition(self, line, values=None):
         for condition in self.conditions:
-            if not condition.eval_condition(line):
+            if not condition.eval_condition(line, values):
                 return False
         return True
 
     def exec_action(self, line):
-        if self.action == 'add':
-            self._exec_add(line)
-        elif self.action == 'edit':
-            self._exec_edit(line)
+        self.exec_actions([(self, line)])
 
-    def _exec_add(self, line):
-        pool = Pool()
-        Typification = pool.get('lims.typification')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        typification = Typification.search([
-            ('product_type', '=', line.product_type),
-            ('matrix', '=', line.matrix),
-            ('analysis', '=', self.target_analysis),
-            ('by_default', '=', True),
-            ('valid', '=', True),
-            ], limit=1)
-        if not typification:
+    @classmethod
+    def exec_actions(cls, actions):
+        '''
+        Execute the actions of a list of (rule, line) whose conditions
+        were met: first the additions and then the editions
+        '''
+        to_add = [(r, l) for r, l in actions if r.action == 'add']
+        if to_add:
+            cls._exec_add(to_add)
+        to_edit = [(r, l) for r, l in actions if r.action == 'edit']
+        if to_edit:
+            cls._exec_edit(to_edit)
+
+    @classmethod
+    def _get_last_lines(cls, keys):
+        '''
+        Return a dict with the last repetition line of each
+        (notebook, analysis) key
+        '''
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        keys = set(keys)
+        analysis_ids = list(set(k[1] for k in keys))
+        res = {}
+        for sub_ids in grouped_slice(list(set(k[0] for k in keys))):
+            lines = NotebookLine.search([
+                ('notebook', 'in', list(sub_ids)),
+                ('analysis', 'in', analysis_ids),
+                ], order=[('repetition', 'DESC')])
+            for line in lines:
+                key = (line.notebook.id, line.analysis.id)
+                if key in keys:
+                    res.setdefault(key, line)
+        return res
+
+    @classmethod
+    def _exec_add(cls, actions):
+        cursor = Transaction().connection.cursor()
+        Typification = Pool().get('lims.typification')
+
+        to_add = {}
+        for rule, line in actions:
+            to_add.setdefault((line.notebook.id, rule.target_analysis.id),
+                (rule, line))
+        existing_lines = cls._get_last_lines(list(to_add.keys()))
+        to_add = [x for k, x in to_add.items() if k not in existing_lines]
+        if not to_add:
             return
 
-        existing_line = NotebookLine.search([
-            ('notebook', '=', line.notebook),
-            ('analysis', '=', self.target_analysis),
-            ], order=[('repetition', 'DESC')], limit=1)
-        if not existing_line:
-            self._exec_add_service(line, typification[0])
+        typifications = {}
+        keys = list(set((line.product_type.id, line.matrix.id,
+            rule.target_analysis.id) for rule, line in to_add))
+        for sub_keys in grouped_slice(keys):
+            cursor.execute('SELECT product_type, matrix, analysis, id '
+                'FROM "' + Typification._table + '" '
+                'WHERE (product_type, matrix, analysis) IN %s '
+                    'AND by_default IS TRUE '
+                    'AND valid IS TRUE',
+                (tuple(sub_keys),))
+            for x in cursor.fetchall():
+                typifications.setdefault(tuple(x[:3]), x[3])
+
+        to_create = []
+        for rule, line in to_add:
+            typification_id = typifications.get((line.product_type.id,
+                line.matrix.id, rule.target_analysis.id))
+            if typification_id:
+                to_create.append(
+                    (rule, line, Typification(typification_id)))
+        if to_create:
+            cls._exec_add_service(to_create)
 
-    def _exec_add_service(self, line, typification):
+    @classmethod
+    def _exec_add_service(cls, to_create):
         cursor = Transaction().connection.cursor()
         pool = Pool()
         AnalysisLaboratory = pool.get('lims.analysis-laboratory')
@@ -684,81 +755,144 @@ class NotebookRule(ModelSQL, ModelView):
         Service = pool.get('lims.service')
         EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
 
-        cursor.execute('SELECT DISTINCT(laboratory) '
-            'FROM "' + AnalysisLaboratory._table + '" '
-            'WHERE analysis = %s',
-            (self.target_analysis.id,))
-        laboratories = [x[0] for x in cursor.fetchall()]
-        if not laboratories:
-            return
-        laboratory_id = laboratories[0]
+        analysis_ids = list(set(r.target_analysis.id for r, l, t in to_create))
 
-        method_id = typification.method and typification.method.id or None
+        laboratories = {}
+        cursor.execute('SELECT analysis, laboratory '
+            'FROM "' + AnalysisLaboratory._table + '" '
+            'WHERE analysis = ANY(%s)',
+            (analysis_ids,))
+        for analysis_id, laboratory_id in cursor.fetchall():
+            laboratories.setdefault(analysis_id, laboratory_id)
 
-        cursor.execute('SELECT DISTINCT(device) '
+        devices = {}
+        cursor.execute('SELECT analysis, laboratory, device '
             'FROM "' + AnalysisDevice._table + '" '
             'WHERE active IS TRUE '
-                'AND analysis = %s  '
-                'AND laboratory = %s '
+                'AND analysis = ANY(%s) '
                 'AND by_default IS TRUE',
-            (self.target_analysis.id, laboratory_id))
-        devices = [x[0] for x in cursor.fetchall()]
-        device_id = devices and devices[0] or None
-
-        service_create = [{
-            'fraction': line.fraction.id,
-            'analysis': self.target_analysis.id,
-            'urgent': True,
-            'laboratory': laboratory_id,
-            'method': method_id,
-            'device': device_id,
-            }]
+            (analysis_ids,))
+        for analysis_id, laboratory_id, device_id in cursor.fetchall():
+            devices.setdefault((analysis_id, laboratory_id), device_id)
+
+        service_create = []
+        for rule, line, typification in to_create:
+            laboratory_id = laboratories.get(rule.target_analysis.id)
+            if not laboratory_id:
+                continue
+            service_create.append({
+                'fraction': line.fraction.id,
+                'analysis': rule.target_analysis.id,
+                'urgent': True,
+                'laboratory': laboratory_id,
+                'method': (typification.method and
+                    typification.method.id or None),
+                'device': devices.get(
+                    (rule.target_analysis.id, laboratory_id)),
+                })
+        if not service_create:
+            return
+
         with Transaction().set_context(manage_service=True):
-            new_service, = Service.create(service_create)
-
-        Service.copy_analysis_comments([new_service])
-        Service.set_confirmation_date([new_service])
-        analysis_detail = EntryDetailAnalysis.search([
-            ('service', '=', new_service.id)])
-        if analysis_detail:
-            EntryDetailAnalysis.create_notebook_lines(analysis_detail,
-                line.fraction)
-            EntryDetailAnalysis.write(analysis_detail, {
+            new_services = Service.create(service_create)
+
+        Service.copy_analysis_comments(new_services)
+        Service.set_confirmation_date(new_services)
+        analysis_details = EntryDetailAnalysis.search([
+            ('service', 'in', [s.id for s in new_services]),
+            ])
+        if analysis_details:
+            details_by_fraction = {}
+            for detail in analysis_details:
+                details_by_fraction.setdefault(detail.fraction,
+                    []).append(detail)
+            for fraction, details in details_by_fraction.items():
+                EntryDetailAnalysis.create_notebook_lines(details, fraction)
+            EntryDetailAnalysis.write(analysis_details, {
                 'state': 'unplanned',
                 })
 
-    def _exec_edit(self, line):
-        pool = Pool()
-        NotebookLine = pool.get('lims.notebook.line')
+    @classmethod
+    def _exec_edit(cls, actions):
+        edits = cls._get_edit_targets(actions)
+        if edits:
+            cls._save_edits(edits)
 
-        now = datetime.now()
-        today = now.date()
+    @classmethod
+    def _get_edit_targets(cls, actions):
+        '''
+        Return a dict with the edition rules to apply to each target line,
+        by id, in the order of actions
+        '''
+        keys = [(line.notebook.id, rule.target_analysis.id)
+            for rule, line in actions if line.analysis != rule.target_analysis]
+        target_lines = keys and cls._get_last_lines(keys) or {}
+
+        edits = {}
+        for rule, line in actions:
+            if line.analysis == rule.target_analysis:
+                line_id = line.id
+            else:
+                target_line = target_lines.get(
+                    (line.notebook.id, rule.target_analysis.id))
+                if not target_line:
+                    continue
+                line_id = target_line.id
+            edits.setdefault(line_id, []).append(rule)
+        return edits
 
-        if line.analysis == self.target_analysis:
-            notebook_line = NotebookLine(line.id)
-        else:
-            target_line = NotebookLine.search([
-                ('notebook', '=', line.notebook),
-                ('analysis', '=', self.target_analysis),
-                ], order=[('repetition', 'DESC')], limit=1)
-            if not target_line:
-                return
-            notebook_line = target_line[0]
-
-        if notebook_line.accepted or notebook_line.annulled:
-            return
+    @classmethod
+    def _check_edit_value(cls, field_name, value):
+        '''
+        Return whether value can be stored in the field of a notebook line,
+        so that invalid editions are skipped before saving the lines
+        '''
+        NotebookLine = Pool().get('lims.notebook.line')
 
+        field = NotebookLine._fields[field_name]
+        # Values are strings, they can not be assigned to relation fields
+        if field._type in ('many2one', 'one2one', 'reference',
+                'one2many', 'many2many'):
+            return False
         try:
-            setattr(notebook_line, self.target_field.name, self.value)
-            if (self.target_field.name in ('result', 'literal_result') and
-                    notebook_line.start_date):
-                notebook_line.end_date = today
-                if notebook_line.laboratory.automatic_accept_result:
-                    notebook_line.accepted = True
-                    notebook_line.acceptance_date = now
-            notebook_line.save()
-        except Exception as e:
-            return
+            field.sql_format(value)
+        except (ValueError, TypeError, ArithmeticError):
+            return False
+        if (field._type == 'selection'
+                and isinstance(field.selection, (list, tuple))
+                and value not in dict(field.selection)):
+            return False
+        return True
+
+    @classmethod
+    def _save_edits(cls, edits):
+        '''
+        Apply the edition rules to their target lines (a dict of rules by
+        line id) and save all the lines at once
+        '''
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        now = datetime.now()
+        today = now.date()
+
+        to_save = []
+        for notebook_line in NotebookLine.browse(list(edits.keys())):
+            for rule in edits[notebook_line.id]:
+                if notebook_line.accepted or notebook_line.annulled:
+                    break
+                if not cls._check_edit_value(rule.target_field.name,
+                        rule.value):
+                    continue
+                setattr(notebook_line, rule.target_field.name, rule.value)
+                if (rule.target_field.name in ('result', 'literal_result')
+                        and notebook_line.start_date):
+                    notebook_line.end_date = today
+                    if notebook_line.laboratory.automatic_accept_result:
+                        notebook_line.accepted = True
+                        notebook_line.acceptance_date = now
+            to_save.append(notebook_line)
+        if to_save:
+            NotebookLine.save(to_save)
 
     def _get_line_last_repetition(self, line):
         NotebookLine = Pool().get('lims.notebook.line')
@@ -792,16 +926,48 @@ class NotebookRuleCondition(ModelSQL, ModelView):
         "\"Not in\" conditions, use a comma-separated list of values " +
         "(e.g.: AB, CD, 12, 34)"))
 
-    def eval_condition(self, line):
-        path = self.field.split('.')
-        field = path.pop(0)
-        try:
-            value = getattr(line, field)
-            while path:
-                field = path.pop(0)
-                value = getattr(value, field)
-        except AttributeError:
-            return False
+    @classmethod
+    def get_lines_values(cls, lines, conditions):
+        '''
+        Read the fields of the conditions for all the lines at once and
+        return a dict with the value of each (line, field) key. Paths that
+        can not be resolved (e.g. through an empty relation) are omitted
+        '''
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        paths = list(set(c.field for c in conditions))
+        res = {}
+        if not paths:
+            return res
+        for sub_lines in grouped_slice(lines):
+            for row in NotebookLine.read([l.id for l in sub_lines], paths):
+                for path in paths:
+                    names = path.split('.')
+                    value = row
+                    for name in names[:-1]:
+                        value = value.get(name + '.')
+                        if not value:
+                            break
+                    else:
+                        res[(row['id'], path)] = value[names[-1]]
+        return res
+
+    def eval_condition(self, line, values=None):
+        if values is not None:
+            key = (line.id, self.field)
+            if key not in values:
+                return False
+            value = values[key]
+        else:
+            path = self.field.split('.')
+            field = path.pop(0)
+            try:
+                value = getattr(line, field)
+                while path:
+                    field = path.pop(0)
+                    value = getattr(value, field)
+            except AttributeError:
+                return False
 
         operator_func = {
             'eq': operator.eq,
@@ -815,13 +981,13 @@ class NotebookRuleCondition(ModelSQL, ModelView):
             }
 
         if self.condition in ('in', 'not_in'):
-            values = [str(x).strip() for x in self.value.split(',')]
+            items = [str(x).strip() for x in self.value.split(',')]
             try:
                 result = operator_func[self.condition](
-                    float(value), [float(x) for x in values])
+                    float(value), [float(x) for x in items])
             except (TypeError, ValueError):
                 result = (value and operator_func[self.condition](
-                    str(value), [str(x) for x in values]) or False)
+                    str(value), [str(x) for x in items]) or False)
         else:
             try:
                 result = operator_func[self.condition](
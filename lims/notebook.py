@@ -1059,7 +1059,7 @@ class NotebookLine(ModelSQL, ModelView):
         lines = super().create(vlist)
         cls.update_detail_report(lines)
         sample_ids = list(set(nl.sample.id for nl in lines))
-        Sample.update_samples_state(sample_ids)
+        Sample.delay_update_samples_state(sample_ids)
         return lines
 
     @classmethod
@@ -1082,7 +1082,7 @@ class NotebookLine(ModelSQL, ModelView):
                     break
             if update_samples_state:
                 sample_ids = list(set(nl.sample.id for nl in lines))
-                Sample.update_samples_state(sample_ids)
+                Sample.delay_update_samples_state(sample_ids)
             update_referrals_state = False
             for field in ('accepted', 'annulled', 'result', 'literal_result',
                     'result_modifier'):
@@ -1148,26 +1148,9 @@ class NotebookLine(ModelSQL, ModelView):
     @classmethod
     def update_referrals_state(cls, lines):
         Referral = Pool().get('lims.referral')
-
-        referral_ids = [l.analysis_detail.referral.id
-            for l in lines if l.analysis_detail.referral]
-        if not referral_ids:
-            return
-
-        referrals = Referral.search([
-            ('state', '=', 'sent'),
-            ('id', 'in', referral_ids),
-            ])
-        for referral in referrals:
-            if cls.search_count([
-                    ('analysis_detail.referral', '=', referral.id),
-                    ('annulled', '=', False),
-                    ('result', 'in', [None, '']),
-                    ('literal_result', 'in', [None, '']),
-                    ('result_modifier', 'not in', [
-                        'd', 'nd', 'pos', 'neg', 'ni', 'abs', 'pre', 'na']),
-                    ]) == 0:
-                Referral.write([referral], {'state': 'done'})
+        referral_ids = set(l.analysis_detail.referral.id
+            for l in lines if l.analysis_detail.referral)
+        Referral.delay_update_referrals_state(referral_ids)
 
     @classmethod
     def validate(cls, notebook_lines):
@@ -2154,13 +2137,11 @@ class NotebookResultsConversion(Wizard):
     def transition_ok(self):
         NotebookLine = Pool().get('lims.notebook.line')
 
-        for notebook_id in Transaction().context['active_ids']:
-            with Transaction().set_context(_check_access=True):
-                notebook_lines = NotebookLine.search([
-                    ('notebook', '=', notebook_id),
-                    ])
-            if not notebook_lines:
-                continue
+        with Transaction().set_context(_check_access=True):
+            notebook_lines = NotebookLine.search([
+                ('notebook', 'in', Transaction().context['active_ids']),
+                ])
+        if notebook_lines:
             self.lines_results_conversion(notebook_lines)
         return 'end'
 
@@ -2171,6 +2152,9 @@ class NotebookResultsConversion(Wizard):
         VolumeConversion = pool.get('lims.volume.conversion')
 
         lines_to_save = []
+        # Conversion formulas are evaluated at once for all the lines that
+        # share them, the result is multiplied by the factor of each line
+        to_convert = {}
         for notebook_line in notebook_lines:
             if notebook_line.accepted:
                 continue
@@ -2206,49 +2190,40 @@ class NotebookResultsConversion(Wizard):
                 if not formula:
                     continue
                 variables = self._get_variables(formula, notebook_line)
-                parser = FormulaParser(formula, variables)
-                formula_result = parser.getValue()
-
-                converted_result = result * formula_result
-                notebook_line.converted_result = str(converted_result)
-                notebook_line.converted_result_modifier = 'eq'
-                lines_to_save.append(notebook_line)
+                to_convert.setdefault(formula, []).append(
+                    (notebook_line, variables, result))
             elif (iu == fu and ic != fc):
                 converted_result = result * (fc / ic)
                 notebook_line.converted_result = str(converted_result)
                 notebook_line.converted_result_modifier = 'eq'
                 lines_to_save.append(notebook_line)
             else:
-                formula = None
-                conversions = UomConversion.search([
-                    ('initial_uom', '=', iu),
-                    ('final_uom', '=', fu),
-                    ])
-                if conversions:
-                    formula = conversions[0].conversion_formula
-                if not formula:
+                conversion = UomConversion.get_conversion(iu, fu)
+                if not conversion or not conversion[0]:
                     continue
 
-                initial_uom_volume = conversions[0].initial_uom_volume
-                final_uom_volume = conversions[0].final_uom_volume
+                formula, initial_uom_volume, final_uom_volume = conversion
                 variables = self._get_variables(formula, notebook_line,
                     initial_uom_volume, final_uom_volume)
-                parser = FormulaParser(formula, variables)
-                formula_result = parser.getValue()
 
                 if initial_uom_volume and final_uom_volume:
                     d_ic = VolumeConversion.brixToDensity(ic)
                     d_fc = VolumeConversion.brixToDensity(fc)
-                    converted_result = (result * (fc / ic) * (d_fc / d_ic) *
-                        formula_result)
-                    notebook_line.converted_result = str(converted_result)
-                    notebook_line.converted_result_modifier = 'eq'
-                    lines_to_save.append(notebook_line)
+                    factor = result * (fc / ic) * (d_fc / d_ic)
                 else:
-                    converted_result = result * (fc / ic) * formula_result
-                    notebook_line.converted_result = str(converted_result)
-                    notebook_line.converted_result_modifier = 'eq'
-                    lines_to_save.append(notebook_line)
+                    factor = result * (fc / ic)
+                to_convert.setdefault(formula, []).append(
+                    (notebook_line, variables, factor))
+
+        for formula, items in to_convert.items():
+            formula_results = FormulaParser.getValues(formula,
+                [variables for _, variables, _ in items])
+            for (notebook_line, _, factor), formula_result in zip(items,
+                    formula_results):
+                converted_result = factor * formula_result
+                notebook_line.converted_result = str(converted_result)
+                notebook_line.converted_result_modifier = 'eq'
+                lines_to_save.append(notebook_line)
         if lines_to_save:
             NotebookLine.save(lines_to_save)
 
@@ -5541,21 +5516,15 @@ class NotebookResultsVerification(Wizard):
                 elif (iu == fu and ic != fc):
                     converted_result = result * (fc / ic)
                 else:
-                    formula = None
-                    conversions = UomConversion.search([
-                        ('initial_uom', '=', iu),
-                        ('final_uom', '=', fu),
-                        ])
-                    if conversions:
-                        formula = conversions[0].conversion_formula
-                    if not formula:
+                    conversion = UomConversion.get_conversion(iu, fu)
+                    if not conversion or not conversion[0]:
                         continue
+                    formula, initial_uom_volume, final_uom_volume = conversion
                     variables = self._get_variables(formula, notebook_line)
                     parser = FormulaParser(formula, variables)
                     formula_result = parser.getValue()
 
-                    if (conversions[0].initial_uom_volume and
-                            conversions[0].final_uom_volume):
+                    if initial_uom_volume and final_uom_volume:
                         d_ic = VolumeConversion.brixToDensity(ic)
                         d_fc = VolumeConversion.brixToDensity(fc)
                         converted_result = (result * (fc / ic) *
@@ -6437,14 +6406,62 @@ class NotebookEvaluateRules(Wizard):
     def evaluate_rules(self, notebook_lines):
         pool = Pool()
         NotebookRule = pool.get('lims.rule')
+        NotebookRuleCondition = pool.get('lims.rule.condition')
 
-        for line in notebook_lines:
-            rules = NotebookRule.search([
-                ('analysis', '=', line.analysis),
-                ])
-            for rule in rules:
-                if rule.eval_condition(line):
-                    rule.exec_action(line)
+        rules = NotebookRule.get_rules_by_analysis(
+            [l.analysis.id for l in notebook_lines])
+        if not rules:
+            return
+
+        lines = [l for l in notebook_lines if l.analysis.id in rules]
+        conditions = [c for r in sum(rules.values(), []) for c in r.conditions]
+        values = NotebookRuleCondition.get_lines_values(lines, conditions)
+
+        # Rules are evaluated in sequence, as if each action was executed
+        # as soon as its conditions are met. Actions are delayed until a
+        # condition has to be checked on an edited line, or the target of
+        # an edition may be a line still to add, and then the values of the
+        # edited lines are read again.
+        to_add, to_edit = [], {}
+        for line in lines:
+            for rule in rules[line.analysis.id]:
+                if line.id in to_edit:
+                    self._exec_rules_actions(to_add, to_edit, values, lines,
+                        conditions)
+                if not rule.eval_condition(line, values):
+                    continue
+                if rule.action == 'add':
+                    to_add.append((rule, line))
+                elif rule.action == 'edit':
+                    if to_add and line.analysis != rule.target_analysis:
+                        self._exec_rules_actions(to_add, to_edit, values,
+                            lines, conditions)
+                    for line_id, edit_rules in (
+                            NotebookRule._get_edit_targets(
+                                [(rule, line)]).items()):
+                        to_edit.setdefault(line_id, []).extend(edit_rules)
+        self._exec_rules_actions(to_add, to_edit, values, lines, conditions)
+
+    def _exec_rules_actions(self, to_add, to_edit, values, lines,
+            conditions):
+        '''
+        Execute the pending additions and editions and update the condition
+        values of the edited lines
+        '''
+        pool = Pool()
+        NotebookRule = pool.get('lims.rule')
+        NotebookRuleCondition = pool.get('lims.rule.condition')
+
+        if to_add:
+            NotebookRule._exec_add(to_add)
+            del to_add[:]
+        if to_edit:
+            NotebookRule._save_edits(to_edit)
+            for key in [k for k in values if k[0] in to_edit]:
+                del values[key]
+            values.update(NotebookRuleCondition.get_lines_values(
+                [l for l in lines if l.id in to_edit], conditions))
+            to_edit.clear()
 
     def end(self):
         return 'reload'
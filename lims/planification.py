@@ -233,6 +233,16 @@ class Planification(Workflow, ModelSQL, ModelView):
             values['code'] = config.planification_sequence.get()
         return super().create(vlist)
 
+    @classmethod
+    def write(cls, *args):
+        AnalysisPendingService = Pool().get('lims.analysis.pending_service')
+        super().write(*args)
+        actions = iter(args)
+        for planifications, vals in zip(actions, actions):
+            if 'state' in vals:
+                AnalysisPendingService.delay_update_planifications(
+                    [p.id for p in planifications])
+
     @classmethod
     def check_delete(cls, planifications):
         for planification in planifications:
@@ -315,6 +325,7 @@ class Planification(Workflow, ModelSQL, ModelView):
         '''
         Cron - Process Waiting Planifications
         '''
+        Queue = Pool().get('ir.queue')
         logger = logging.getLogger('lims_planification')
 
         planifications = cls.search([
@@ -322,20 +333,44 @@ class Planification(Workflow, ModelSQL, ModelView):
             ], order=[('id', 'ASC')])
         if planifications:
             logger.info('Cron - Processing planifications:INIT')
-            for planification in planifications:
-                if planification.state == 'confirmed':
-                    cls.do_confirm([planification])
-                elif planification.state == 'not_executed':
-                    cls.do_release_controls([planification])
+            queued = set()
+            for task in Queue.search([
+                    ('name', '=', cls.__name__),
+                    ('finished_at', '=', None),
+                    ]):
+                if task.data.get('method') == 'process_waiting':
+                    queued.update(task.data['instances'])
+            # Each planification is an independent unit of work, so they
+            # are processed by the queue workers in parallel
+            with Transaction().set_context(queue_name=cls.__name__):
+                for planification in planifications:
+                    if planification.id not in queued:
+                        cls.__queue__.process_waiting([planification])
             logger.info('Cron - Processing planifications:END')
 
+    @classmethod
+    def process_waiting(cls, planifications):
+        '''
+        Confirm or release the controls of the planifications that are
+        still waiting to be processed
+        '''
+        cls.lock(planifications)
+        planifications = [p for p in cls.browse([p.id for p in planifications])
+            if p.waiting_process]
+        to_confirm = [p for p in planifications if p.state == 'confirmed']
+        if to_confirm:
+            cls.do_confirm(to_confirm)
+        to_release = [p for p in planifications
+            if p.state == 'not_executed']
+        if to_release:
+            cls.do_release_controls(to_release)
+
     @classmethod
     def do_confirm(cls, planifications):
-        for planification in planifications:
-            planification.update_laboratory_notebook()
-            if planification.waiting_process:
-                planification.waiting_process = False
-                planification.save()
+        cls.update_laboratory_notebooks(planifications)
+        waiting = [p for p in planifications if p.waiting_process]
+        if waiting:
+            cls.write(waiting, {'waiting_process': False})
 
     def pre_update_laboratory_notebook(self):
         cursor = Transaction().connection.cursor()
@@ -361,70 +396,71 @@ class Planification(Workflow, ModelSQL, ModelView):
                 })
 
     def update_laboratory_notebook(self):
-        cursor = Transaction().connection.cursor()
+        self.update_laboratory_notebooks([self])
+
+    @classmethod
+    def update_laboratory_notebooks(cls, planifications):
+        '''
+        Link the planned notebook lines to their professionals and to the
+        controls of their planifications
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
         pool = Pool()
         PlanificationDetail = pool.get('lims.planification.detail')
         PlanificationServiceDetail = pool.get(
             'lims.planification.service_detail')
         ServiceDetailProfessional = pool.get(
             'lims.planification.service_detail-laboratory.professional')
+        PlanificationFraction = pool.get('lims.planification-fraction')
         NotebookLineProfessional = pool.get(
             'lims.notebook.line-laboratory.professional')
         NotebookLineControl = pool.get('lims.notebook.line-fraction')
 
+        planification_ids = [p.id for p in planifications]
+
         # Professionals
-        cursor.execute('SELECT sd.notebook_line, sdp.professional '
+        professionals_from = (
             'FROM "' + ServiceDetailProfessional._table + '" sdp '
                 'INNER JOIN "' + PlanificationServiceDetail._table + '" sd '
                 'ON sd.id = sdp.detail '
                 'INNER JOIN "' + PlanificationDetail._table + '" pd '
                 'ON pd.id = sd.detail '
-            'WHERE pd.planification = %s '
-                'AND sd.notebook_line IS NOT NULL',
-            (self.id,))
-        res = cursor.fetchall()
-        if res:
-            notebook_lines_ids = ', '.join(str(nl_id)
-                for nl_id, sd_id in res)
-            cursor.execute('DELETE FROM "' +
-                NotebookLineProfessional._table + '" '
-                'WHERE notebook_line IN (' + notebook_lines_ids + ')')
-
-            to_create = []
-            for notebook_line, professional in res:
-                to_create.append({
-                    'notebook_line': notebook_line,
-                    'professional': professional,
-                    })
-            NotebookLineProfessional.create(to_create)
+            'WHERE pd.planification = ANY(%s) '
+                'AND sd.notebook_line IS NOT NULL')
+        cursor.execute('DELETE FROM "' +
+            NotebookLineProfessional._table + '" '
+            'WHERE notebook_line IN ('
+                'SELECT sd.notebook_line ' + professionals_from + ')',
+            (planification_ids,))
+        cursor.execute('INSERT INTO "' +
+            NotebookLineProfessional._table + '" '
+                '(create_uid, create_date, notebook_line, professional) '
+            'SELECT %s, CURRENT_TIMESTAMP, sd.notebook_line, '
+                'sdp.professional ' + professionals_from,
+            (transaction.user, planification_ids))
 
         # Controls
-        controls = [f.id for f in self.controls]
-        if controls:
-            cursor.execute('SELECT sd.notebook_line '
-                'FROM "' + PlanificationServiceDetail._table + '" sd '
-                    'INNER JOIN "' + PlanificationDetail._table + '" pd '
-                    'ON pd.id = sd.detail '
-                'WHERE pd.planification = %s '
-                    'AND sd.notebook_line IS NOT NULL '
-                    'AND sd.is_control = FALSE',
-                (self.id,))
-            res = [x[0] for x in cursor.fetchall()]
-            if res:
-                notebook_lines_ids = ', '.join(str(nl_id)
-                    for nl_id in res)
-                cursor.execute('DELETE FROM "' +
-                    NotebookLineControl._table + '" '
-                    'WHERE notebook_line IN (' + notebook_lines_ids + ')')
-
-                to_create = []
-                for notebook_line in res:
-                    for fraction in controls:
-                        to_create.append({
-                            'notebook_line': notebook_line,
-                            'fraction': fraction,
-                            })
-                NotebookLineControl.create(to_create)
+        controls_from = (
+            'FROM "' + PlanificationServiceDetail._table + '" sd '
+                'INNER JOIN "' + PlanificationDetail._table + '" pd '
+                'ON pd.id = sd.detail '
+                'INNER JOIN "' + PlanificationFraction._table + '" pf '
+                'ON pf.planification = pd.planification '
+            'WHERE pd.planification = ANY(%s) '
+                'AND sd.notebook_line IS NOT NULL '
+                'AND sd.is_control = FALSE')
+        cursor.execute('DELETE FROM "' +
+            NotebookLineControl._table + '" '
+            'WHERE notebook_line IN ('
+                'SELECT sd.notebook_line ' + controls_from + ')',
+            (planification_ids,))
+        cursor.execute('INSERT INTO "' +
+            NotebookLineControl._table + '" '
+                '(create_uid, create_date, notebook_line, fraction) '
+            'SELECT %s, CURRENT_TIMESTAMP, sd.notebook_line, pf.fraction ' +
+            controls_from,
+            (transaction.user, planification_ids))
 
     def update_analysis_detail(self):
         cursor = Transaction().connection.cursor()
@@ -462,26 +498,53 @@ class Planification(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def do_release_controls(cls, planifications):
+        cls.re_update_laboratory_notebooks(planifications)
         for planification in planifications:
-            planification.re_update_laboratory_notebook()
             planification.re_update_analysis_detail()
             planification.unlink_controls()
-            if planification.waiting_process:
-                planification.waiting_process = False
-                planification.save()
+        waiting = [p for p in planifications if p.waiting_process]
+        if waiting:
+            cls.write(waiting, {'waiting_process': False})
 
     def re_update_laboratory_notebook(self):
-        NotebookLine = Pool().get('lims.notebook.line')
-        for detail in self.details:
-            for service_detail in detail.details:
-                if service_detail.is_control and service_detail.notebook_line:
-                    notebook_line = NotebookLine(
-                        service_detail.notebook_line.id)
-                    notebook_line.start_date = None
-                    notebook_line.laboratory_professionals = []
-                    notebook_line.planification = None
-                    notebook_line.controls = []
-                    notebook_line.save()
+        self.re_update_laboratory_notebooks([self])
+
+    @classmethod
+    def re_update_laboratory_notebooks(cls, planifications):
+        '''
+        Unplan the notebook lines of the controls of planifications
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        PlanificationDetail = pool.get('lims.planification.detail')
+        PlanificationServiceDetail = pool.get(
+            'lims.planification.service_detail')
+        NotebookLine = pool.get('lims.notebook.line')
+        NotebookLineProfessional = pool.get(
+            'lims.notebook.line-laboratory.professional')
+        NotebookLineControl = pool.get('lims.notebook.line-fraction')
+
+        cursor.execute('SELECT DISTINCT sd.notebook_line '
+            'FROM "' + PlanificationServiceDetail._table + '" sd '
+                'INNER JOIN "' + PlanificationDetail._table + '" pd '
+                'ON pd.id = sd.detail '
+            'WHERE pd.planification = ANY(%s) '
+                'AND sd.notebook_line IS NOT NULL '
+                'AND sd.is_control = TRUE',
+            ([p.id for p in planifications],))
+        notebook_lines_ids = [x[0] for x in cursor.fetchall()]
+        if not notebook_lines_ids:
+            return
+
+        NotebookLine.write(NotebookLine.browse(notebook_lines_ids), {
+            'start_date': None,
+            'planification': None,
+            })
+        for table in (NotebookLineProfessional._table,
+                NotebookLineControl._table):
+            cursor.execute('DELETE FROM "' + table + '" '
+                'WHERE notebook_line = ANY(%s)',
+                (notebook_lines_ids,))
 
     def re_update_analysis_detail(self):
         EntryDetailAnalysis = Pool().get('lims.entry.detail.analysis')
@@ -833,6 +896,21 @@ class PlanificationServiceDetail(ModelSQL, ModelView):
     def default_is_replanned():
         return False
 
+    @classmethod
+    def create(cls, vlist):
+        AnalysisPendingService = Pool().get('lims.analysis.pending_service')
+        details = super().create(vlist)
+        AnalysisPendingService.delay_update_services(
+            [d.notebook_line.service.id for d in details])
+        return details
+
+    @classmethod
+    def delete(cls, details):
+        AnalysisPendingService = Pool().get('lims.analysis.pending_service')
+        service_ids = [d.notebook_line.service.id for d in details]
+        super().delete(details)
+        AnalysisPendingService.delay_update_services(service_ids)
+
     def get_planification(self, name=None):
         if self.detail:
             if self.detail.planification:
@@ -4033,24 +4111,22 @@ class SearchFractions(Wizard):
 
         planification = Planification(Transaction().context['active_id'])
 
-        records_added = ['(%s,%s)' % (d.fraction.id, d.service_analysis.id)
+        records_added = [(d.fraction.id, d.service_analysis.id)
             for d in self.next.details]
-        records_ids_added = ', '.join(str(x)
-            for x in ['(0,0)'] + records_added)
-        extra_where = (
-            'AND (nb.fraction, srv.analysis) IN (' + records_ids_added + ') ')
+        data = self._get_service_details(planification, records_added)
 
-        data = self._get_service_details(planification, extra_where)
+        existing_details = {}
+        for detail in PlanificationDetail.search([
+                ('planification', '=', planification.id),
+                ]):
+            existing_details.setdefault(
+                (detail.fraction.id, detail.service_analysis.id), detail)
 
         to_create = []
         for k, v in data.items():
-            details = PlanificationDetail.search([
-                ('planification', '=', planification.id),
-                ('fraction', '=', k[0]),
-                ('service_analysis', '=', k[1]),
-                ])
-            if details:
-                PlanificationDetail.write([details[0]], {
+            detail = existing_details.get(k)
+            if detail:
+                PlanificationDetail.write([detail], {
                     'details': [('create', v)],
                     })
             else:
@@ -4066,11 +4142,18 @@ class SearchFractions(Wizard):
 
         return 'end'
 
-    def _get_service_details(self, planification, extra_where=''):
+    def _get_service_details(self, planification, records=None):
+        '''
+        Return the pending services of the planification analysis.
+        When records, a list of (fraction, service analysis) is given,
+        return the notebook lines to plan for each one of them instead.
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
+        Planification = pool.get('lims.planification')
         PlanificationServiceDetail = pool.get(
             'lims.planification.service_detail')
+        PlanificationDetail = pool.get('lims.planification.detail')
         NotebookLine = pool.get('lims.notebook.line')
         Notebook = pool.get('lims.notebook')
         Fraction = pool.get('lims.fraction')
@@ -4078,87 +4161,97 @@ class SearchFractions(Wizard):
         Service = pool.get('lims.service')
         Analysis = pool.get('lims.analysis')
 
-        planification_details = PlanificationServiceDetail.search([
-            ('planification.state', '=', 'preplanned'),
-            ('notebook_line', '!=', None),
-            ])
-        planned_lines = [pd.notebook_line.id for pd in planification_details]
-        planned_lines_ids = ', '.join(str(x) for x in [0] + planned_lines)
-        preplanned_where = 'AND nl.id NOT IN (%s) ' % planned_lines_ids
+        if records is not None and not records:
+            return {}
+
+        # Each analysis is planned as the first planification analysis
+        # (itself or a set/group) that includes it
+        planned_services = {}
+        planification_analysis = [a.id for a in planification.analysis]
+        included_analysis = Analysis.get_included_analysis_analysis_multi(
+            planification_analysis)
+        for analysis_id in planification_analysis:
+            planned_services.setdefault(analysis_id, analysis_id)
+            for included_id in included_analysis[analysis_id]:
+                planned_services.setdefault(included_id, analysis_id)
+        if not planned_services:
+            return {}
+
+        params = [planification.laboratory.id, list(planned_services.keys())]
 
         dates_where = ''
         if planification.date_from:
-            dates_where += ('AND ad.confirmation_date::date >= \'%s\'::date ' %
-                planification.date_from)
+            dates_where += 'AND ad.confirmation_date::date >= %s::date '
+            params.append(planification.date_from)
         if planification.date_to:
-            dates_where += ('AND ad.confirmation_date::date <= \'%s\'::date ' %
-                planification.date_to)
-
-        result = {}
-        nlines_added = []
-        for a in planification.analysis:
-            analysis_id = a.id
+            dates_where += 'AND ad.confirmation_date::date <= %s::date '
+            params.append(planification.date_to)
 
-            all_included_analysis = [analysis_id]
-            all_included_analysis.extend(
-                Analysis.get_included_analysis_analysis(analysis_id))
-            all_included_analysis_ids = ', '.join(str(x)
-                for x in all_included_analysis)
-            service_where = ('AND ad.analysis IN (%s) ' %
-                all_included_analysis_ids)
+        records_where = ''
+        if records:
+            records_where = 'AND (nb.fraction, srv.analysis) IN %s '
+            params.append(tuple(tuple(r) for r in records))
 
-            sql_select = (
-                'SELECT nl.id, nb.fraction, srv.analysis, nl.repetition != 0 ')
+        sql_select = (
+            'SELECT nl.id, nb.fraction, srv.analysis, nl.repetition != 0, '
+            'ad.analysis ')
 
-            sql_from = (
-                'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Analysis._table + '" nla '
-                'ON nla.id = nl.analysis '
-                'INNER JOIN "' + Notebook._table + '" nb '
-                'ON nb.id = nl.notebook '
-                'INNER JOIN "' + Fraction._table + '" frc '
-                'ON frc.id = nb.fraction '
-                'INNER JOIN "' + EntryDetailAnalysis._table + '" ad '
-                'ON ad.id = nl.analysis_detail '
-                'INNER JOIN "' + Service._table + '" srv '
-                'ON srv.id = nl.service ')
+        sql_from = (
+            'FROM "' + NotebookLine._table + '" nl '
+            'INNER JOIN "' + Analysis._table + '" nla '
+            'ON nla.id = nl.analysis '
+            'INNER JOIN "' + Notebook._table + '" nb '
+            'ON nb.id = nl.notebook '
+            'INNER JOIN "' + Fraction._table + '" frc '
+            'ON frc.id = nb.fraction '
+            'INNER JOIN "' + EntryDetailAnalysis._table + '" ad '
+            'ON ad.id = nl.analysis_detail '
+            'INNER JOIN "' + Service._table + '" srv '
+            'ON srv.id = nl.service ')
+
+        sql_where = (
+            'WHERE ad.plannable = TRUE '
+            'AND nl.start_date IS NULL '
+            'AND nl.annulled = FALSE '
+            'AND nl.laboratory = %s '
+            'AND nla.behavior != \'internal_relation\' '
+            'AND ad.analysis = ANY(%s) '
+            'AND NOT EXISTS ('
+                'SELECT 1 '
+                'FROM "' + PlanificationServiceDetail._table + '" psd '
+                    'INNER JOIN "' + PlanificationDetail._table + '" pd '
+                    'ON pd.id = psd.detail '
+                    'INNER JOIN "' + Planification._table + '" p '
+                    'ON p.id = pd.planification '
+                'WHERE psd.notebook_line = nl.id '
+                    'AND p.state = \'preplanned\') ' +
+            dates_where + records_where)
 
-            sql_where = (
-                'WHERE ad.plannable = TRUE '
-                'AND nl.start_date IS NULL '
-                'AND nl.annulled = FALSE '
-                'AND nl.laboratory = %s '
-                'AND nla.behavior != \'internal_relation\' ' +
-                preplanned_where + dates_where + service_where + extra_where)
+        sql_order = (
+            'ORDER BY nb.fraction ASC, srv.analysis ASC')
 
-            sql_order = (
-                'ORDER BY nb.fraction ASC, srv.analysis ASC')
+        with Transaction().set_user(0):
+            cursor.execute(sql_select + sql_from + sql_where + sql_order,
+                tuple(params))
 
-            with Transaction().set_user(0):
-                cursor.execute(sql_select + sql_from + sql_where + sql_order,
-                    (planification.laboratory.id,))
-            notebook_lines = cursor.fetchall()
-            if not notebook_lines:
-                continue
-            if extra_where:
-                for nl in notebook_lines:
-                    f_ = nl[1]
-                    s_ = nl[2]
-                    if (f_, s_) not in result:
-                        result[(f_, s_)] = []
-                    if nl[0] not in nlines_added:
-                        nlines_added.append(nl[0])
-                        result[(f_, s_)].append({
-                            'notebook_line': nl[0],
-                            'planned_service': a.id,
-                            })
-            else:
-                for nl in notebook_lines:
-                    f_ = nl[1]
-                    s_ = nl[2]
-                    result[(f_, s_)] = {
-                        'repetition': nl[3],
-                        }
+        result = {}
+        if records:
+            nlines_added = set()
+            for nl in cursor:
+                key = (nl[1], nl[2])
+                if key not in result:
+                    result[key] = []
+                if nl[0] not in nlines_added:
+                    nlines_added.add(nl[0])
+                    result[key].append({
+                        'notebook_line': nl[0],
+                        'planned_service': planned_services[nl[4]],
+                        })
+        else:
+            for nl in cursor:
+                result[(nl[1], nl[2])] = {
+                    'repetition': nl[3],
+                    }
 
         return result
 
@@ -4907,11 +5000,13 @@ class ReleaseFraction(Wizard):
         PlanificationServiceDetail = pool.get(
             'lims.planification.service_detail')
         PlanificationDetail = pool.get('lims.planification.detail')
+        AnalysisPendingService = pool.get('lims.analysis.pending_service')
 
         notebook_lines_ids = []
         analysis_detail_ids = []
         details_ids = []
         service_details_ids = []
+        service_ids = []
 
         for detail in self.result.fractions:
             for service_detail in detail.details:
@@ -4919,6 +5014,8 @@ class ReleaseFraction(Wizard):
                     continue
                 if service_detail.notebook_line:
                     notebook_lines_ids.append(service_detail.notebook_line.id)
+                    service_ids.append(
+                        service_detail.notebook_line.service.id)
                     if service_detail.notebook_line.analysis_detail:
                         analysis_detail_ids.append(
                             service_detail.notebook_line.analysis_detail.id)
@@ -4958,6 +5055,7 @@ class ReleaseFraction(Wizard):
             ])
         if details:
             PlanificationDetail.delete(details)
+        AnalysisPendingService.delay_update_services(service_ids)
 
         return 'end'
 
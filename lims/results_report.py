@@ -2,8 +2,9 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from io import BytesIO
+import os
 from datetime import datetime
+from tempfile import TemporaryDirectory
 from PyPDF2 import PdfFileMerger
 from sql import Literal
 
@@ -19,6 +20,7 @@ from trytond.rpc import RPC
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond import backend
+from trytond.filestore import filestore
 from .configuration import get_print_date
 from .notebook import NotebookLineRepeatAnalysis
 
@@ -158,6 +160,9 @@ class ResultsReport(ModelSQL, ModelView):
                 if field in vals:
                     vals['write_date2'] = datetime.now()
                     break
+            if 'report_language' in vals:
+                vals['report_cache'] = None
+                vals['report_format'] = None
         super().write(*args)
 
     @staticmethod
@@ -401,6 +406,21 @@ class ResultsReport(ModelSQL, ModelView):
             return ResultsDetail.browse(self._get_details_cached(language))
 
     def build_report(self, language):
+        '''
+        Return the global report of language to deliver, or None when it is
+        not ready yet
+        '''
+        return self.get_global_report(language)
+
+    def get_global_report(self, language):
+        '''
+        Return the global report of language. The merged report of the
+        report language is stored until a detail is released or annulled
+        '''
+        if (language == self.report_language and
+                self.report_format == 'pdf' and self.report_cache):
+            return self.report_cache
+
         details = self.details_cached(language)
         if not details:
             raise UserError(gettext('lims.msg_global_report_cache',
@@ -410,34 +430,69 @@ class ResultsReport(ModelSQL, ModelView):
         if not cache:
             raise UserError(gettext('lims.msg_global_report_build'))
 
-        #self.report_cache = cache
-        #self.report_format = 'pdf'
-        #self.save()
+        if language == self.report_language:
+            self.report_cache = cache
+            self.report_format = 'pdf'
+            self.save()
         return cache
 
     def _get_global_report(self, details, language):
-        pool = Pool()
-        CachedReport = pool.get('lims.results_report.cached_report')
-
-        all_cache = []
-        for detail in details:
-            cached_reports = CachedReport.search([
-                ('version_detail', '=', detail.id),
-                ('report_language', '=', language.id),
-                ('report_format', '=', 'pdf'),
-                ])
-            if cached_reports:
-                all_cache.append(cached_reports[0].report_cache)
-        if not all_cache:
+        cursor = Transaction().connection.cursor()
+        CachedReport = Pool().get('lims.results_report.cached_report')
+
+        cursor.execute('SELECT version_detail, id, report_cache_id '
+            'FROM "' + CachedReport._table + '" '
+            'WHERE version_detail = ANY(%s) '
+                'AND report_language = %s '
+                'AND report_format = \'pdf\'',
+            ([d.id for d in details], language.id))
+        cached_reports = dict((x[0], x[1:]) for x in cursor.fetchall())
+        cached_reports = [cached_reports[d.id] for d in details
+            if d.id in cached_reports]
+        if not cached_reports:
             return False
 
-        merger = PdfFileMerger(strict=False)
-        for cache in all_cache:
-            filedata = BytesIO(cache)
-            merger.append(filedata)
-        output = BytesIO()
-        merger.write(output)
-        return bytearray(output.getvalue())
+        # Each cached report is copied to a temporary file, one at a time,
+        # so the merger reads the pages from disk only when writing
+        prefix = CachedReport.report_cache.store_prefix
+        with TemporaryDirectory() as directory:
+            merger = PdfFileMerger(strict=False)
+            try:
+                for cached_report_id, file_id in cached_reports:
+                    if file_id:
+                        cache = filestore.get(file_id, prefix=prefix)
+                    else:
+                        cursor.execute('SELECT report_cache '
+                            'FROM "' + CachedReport._table + '" '
+                            'WHERE id = %s', (cached_report_id,))
+                        cache = cursor.fetchone()[0]
+                    if not cache:
+                        continue
+                    path = os.path.join(directory,
+                        '%s.pdf' % cached_report_id)
+                    with open(path, 'wb') as f:
+                        f.write(cache)
+                    del cache
+                    merger.append(path)
+
+                output_path = os.path.join(directory, 'global.pdf')
+                with open(output_path, 'wb') as output:
+                    merger.write(output)
+            finally:
+                merger.close()
+
+            with open(output_path, 'rb') as output:
+                return bytearray(output.read())
+
+    @classmethod
+    def clear_global_report(cls, reports):
+        '''Discard the stored global report of reports'''
+        reports = [r for r in reports if r.report_cache_id or r.report_format]
+        if reports:
+            cls.write(reports, {
+                'report_cache': None,
+                'report_format': None,
+                })
 
     @classmethod
     def get_samples_list(cls, reports, name):
@@ -1163,11 +1218,12 @@ class ResultsReportVersionDetail(Workflow, ModelSQL, ModelView):
     def do_release(cls, details):
         Sample = Pool().get('lims.sample')
         cls.link_notebook_lines(details)
+        cls.clear_global_report(details)
         for detail in details:
             detail.generate_report()
             sample_ids = list(set(s.notebook.fraction.sample.id for
                 s in detail.samples))
-            Sample.update_samples_state(sample_ids)
+            Sample.delay_update_samples_state(sample_ids)
 
     @classmethod
     def link_notebook_lines(cls, details):
@@ -1279,6 +1335,13 @@ class ResultsReportVersionDetail(Workflow, ModelSQL, ModelView):
     def release_all_lang(cls, details):
         for detail in details:
             detail.generate_report()
+        cls.clear_global_report(details)
+
+    @classmethod
+    def clear_global_report(cls, details):
+        ResultsReport = Pool().get('lims.results_report')
+        ResultsReport.clear_global_report(list(set(
+            d.report_version.results_report for d in details)))
 
     def generate_report(self):
         pool = Pool()
@@ -1853,7 +1916,7 @@ class ResultsReportVersionDetailSample(
         Sample = Pool().get('lims.sample')
         samples = super().create(vlist)
         sample_ids = list(set(s.notebook.fraction.sample.id for s in samples))
-        Sample.update_samples_state(sample_ids)
+        Sample.delay_update_samples_state(sample_ids)
         return samples
 
     @classmethod
@@ -1861,7 +1924,7 @@ class ResultsReportVersionDetailSample(
         Sample = Pool().get('lims.sample')
         sample_ids = list(set(s.notebook.fraction.sample.id for s in samples))
         super().delete(samples)
-        Sample.update_samples_state(sample_ids)
+        Sample.delay_update_samples_state(sample_ids)
 
 
 class ResultsReportVersionDetailLine(ModelSQL, ModelView):
@@ -2977,6 +3040,7 @@ class ResultsReportAnnulation(Wizard):
                 ])
             if cached_reports:
                 CachedReport.delete(cached_reports)
+            ResultsDetail.clear_global_report(details)
         return 'end'
 
 
@@ -4169,20 +4233,7 @@ class PrintGlobalResultReport(Wizard):
         for active_id in Transaction().context['active_ids']:
             results_report = ResultsReport(active_id)
 
-            details = results_report.details_cached(
-                results_report.report_language)
-            if not details:
-                raise UserError(gettext('lims.msg_global_report_cache',
-                        language=results_report.report_language.name))
-
-            cache = results_report._get_global_report(details,
-                results_report.report_language)
-            if not cache:
-                raise UserError(gettext('lims.msg_global_report_build'))
-
-            results_report.report_cache = cache
-            results_report.report_format = 'pdf'
-            results_report.save()
+            results_report.get_global_report(results_report.report_language)
 
         return 'print_'
 
@@ -19,6 +19,60 @@ from trytond.report import Report
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.rpc import RPC
+from trytond.tools import grouped_slice
+
+
+class SampleStateDataManager(object):
+    '''
+    Collect the samples and referrals whose state must be recomputed
+    during a transaction and update each one of them only once, just
+    before the transaction is committed
+    '''
+
+    def __init__(self):
+        self.sample_ids = set()
+        self.referral_ids = set()
+
+    def __eq__(self, other):
+        if not isinstance(other, SampleStateDataManager):
+            return NotImplemented
+        return True
+
+    def process(self):
+        pool = Pool()
+        Sample = pool.get('lims.sample')
+        Referral = pool.get('lims.referral')
+        while self.sample_ids or self.referral_ids:
+            sample_ids = list(self.sample_ids)
+            self.sample_ids.clear()
+            if sample_ids:
+                Sample.update_samples_state(sample_ids)
+            referral_ids = list(self.referral_ids)
+            self.referral_ids.clear()
+            if referral_ids:
+                Referral.update_referrals_state(referral_ids)
+
+    def _clear(self):
+        self.sample_ids.clear()
+        self.referral_ids.clear()
+
+    def abort(self, trans):
+        self._clear()
+
+    def tpc_begin(self, trans):
+        self.process()
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self._clear()
+
+    def tpc_abort(self, trans):
+        self._clear()
 
 
 class Zone(ModelSQL, ModelView):
@@ -518,18 +572,19 @@ class Service(ModelSQL, ModelView):
                 # from lims_account_invoice
                 if hasattr(aditional_services[0].fraction.type,
                         'invoiceable'):
-                    for aditional_service in aditional_services:
-                        aditional_service.create_invoice_line()
+                    cls.create_invoice_lines(aditional_services)
 
         fractions_ids = list(set(s.fraction.id for s in services))
         cls.set_shared_fraction(fractions_ids)
         sample_ids = list(set(s.sample.id for s in services))
-        Sample.update_samples_state(sample_ids)
+        Sample.delay_update_samples_state(sample_ids)
         return services
 
     @classmethod
     def write(cls, *args):
-        Sample = Pool().get('lims.sample')
+        pool = Pool()
+        Sample = pool.get('lims.sample')
+        AnalysisPendingService = pool.get('lims.analysis.pending_service')
         super().write(*args)
         actions = iter(args)
         for services, vals in zip(actions, actions):
@@ -563,7 +618,12 @@ class Service(ModelSQL, ModelView):
                     break
             if update_samples_state:
                 sample_ids = list(set(s.sample.id for s in services))
-                Sample.update_samples_state(sample_ids)
+                Sample.delay_update_samples_state(sample_ids)
+            for field in ('analysis', 'laboratory', 'confirmation_date'):
+                if field in vals:
+                    AnalysisPendingService.delay_update_services(
+                        [s.id for s in services])
+                    break
 
     @classmethod
     def delete(cls, services):
@@ -574,7 +634,7 @@ class Service(ModelSQL, ModelView):
         sample_ids = list(set(s.sample.id for s in services))
         super().delete(services)
         cls.set_shared_fraction(fractions_ids)
-        Sample.update_samples_state(sample_ids)
+        Sample.delay_update_samples_state(sample_ids)
 
     @classmethod
     def check_delete(cls, services):
@@ -1629,11 +1689,20 @@ class Fraction(ModelSQL, ModelView):
 
     @classmethod
     def write(cls, *args):
+        pool = Pool()
+        Service = pool.get('lims.service')
+        AnalysisPendingService = pool.get('lims.analysis.pending_service')
         super().write(*args)
         actions = iter(args)
         for fractions, vals in zip(actions, actions):
             if vals.get('type'):
                 cls.update_details_plannable(fractions, vals.get('type'))
+            if 'type' in vals or 'confirmed' in vals:
+                services = Service.search([
+                    ('fraction', 'in', [f.id for f in fractions]),
+                    ])
+                AnalysisPendingService.delay_update_services(
+                    [s.id for s in services])
 
     @classmethod
     def update_details_plannable(cls, fractions, fraction_type_id):
@@ -2647,8 +2716,8 @@ class Sample(ModelSQL, ModelView):
                 not qty_lines_pending_acceptance_exist):
             logging.getLogger(__name__).info(
                 'Updating Pending lines in Samples...')
-            for sample in cls.search([]):
-                sample.update_qty_lines()
+            for samples in grouped_slice(cls.search([])):
+                cls.update_samples_qty_lines(list(samples))
         if not party_exist:
             logging.getLogger(__name__).info('Updating Party in Samples...')
             cursor.execute('UPDATE "' + cls._table + '" s '
@@ -3157,7 +3226,8 @@ class Sample(ModelSQL, ModelView):
             return [('id', 'not in', [u.id for u in urgents])]
         return []
 
-    def get_completion_percentage(self, name=None):
+    @classmethod
+    def get_completion_percentage(cls, samples, name):
         cursor = Transaction().connection.cursor()
         pool = Pool()
         Config = pool.get('lims.configuration')
@@ -3169,63 +3239,53 @@ class Sample(ModelSQL, ModelView):
 
         _ZERO = Decimal(0)
         samples_in_progress = Config(1).samples_in_progress
-        digits = Sample.completion_percentage.digits[1]
-
-        cursor.execute('SELECT nl.notebook, nl.analysis, nl.method, '
-                'nl.accepted, nl.result, nl.literal_result, '
-                'nl.result_modifier '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + EntryDetailAnalysis._table + '" d '
-                'ON d.id = nl.analysis_detail '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = nl.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-                'INNER JOIN "' + FractionType._table + '" ft '
-                'ON ft.id = f.type '
-            'WHERE ft.report = TRUE '
-                'AND f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE',
-            (self.id,))
-        notebook_lines = cursor.fetchall()
-        total = len(notebook_lines)
-        if not total:
-            return _ZERO
+        digits = cls.completion_percentage.digits[1]
 
-        # Check repetitions
-        oks, to_check = [], []
+        result = dict((s.id, _ZERO) for s in samples)
+        if not result:
+            return result
 
         if samples_in_progress == 'accepted':
-            for line in notebook_lines:
-                key = (line[0], line[1], line[2])
-                if line[3]:
-                    oks.append(key)
-                else:
-                    to_check.append(key)
-
+            ok_where = 'nl.accepted = TRUE'
         elif samples_in_progress == 'result':
-            for line in notebook_lines:
-                key = (line[0], line[1], line[2])
-                if (line[4] not in [None, ''] or
-                        line[5] not in [None, ''] or
-                        line[6] in ['d', 'nd', 'pos',
-                        'neg', 'ni', 'abs', 'pre', 'na']):
-                    oks.append(key)
-                else:
-                    to_check.append(key)
-
-        accepted = len(oks)
-        if not accepted:
-            return _ZERO
-
-        for key in to_check:
-            if key in oks:
-                total -= 1
-
-        return Decimal(
-            Decimal(accepted) / Decimal(total)
-            ).quantize(Decimal(str(10 ** -digits)))
+            ok_where = ('COALESCE(nl.result, \'\') != \'\' '
+                'OR COALESCE(nl.literal_result, \'\') != \'\' '
+                'OR nl.result_modifier IN (\'d\', \'nd\', \'pos\', '
+                    '\'neg\', \'ni\', \'abs\', \'pre\', \'na\')')
+        else:
+            ok_where = 'FALSE'
+
+        # Lines are grouped by repetition key (notebook, analysis, method):
+        # the repetitions of a key with a result are not taken into account
+        cursor.execute('SELECT sample, SUM(ok), SUM(total), '
+                'SUM(CASE WHEN ok > 0 THEN total - ok ELSE 0 END) '
+            'FROM ('
+                'SELECT f.sample, COUNT(*) AS total, '
+                    'COUNT(*) FILTER (WHERE ' + ok_where + ') AS ok '
+                'FROM "' + NotebookLine._table + '" nl '
+                    'INNER JOIN "' + EntryDetailAnalysis._table + '" d '
+                    'ON d.id = nl.analysis_detail '
+                    'INNER JOIN "' + Notebook._table + '" n '
+                    'ON n.id = nl.notebook '
+                    'INNER JOIN "' + Fraction._table + '" f '
+                    'ON f.id = n.fraction '
+                    'INNER JOIN "' + FractionType._table + '" ft '
+                    'ON ft.id = f.type '
+                'WHERE ft.report = TRUE '
+                    'AND f.sample = ANY(%s) '
+                    'AND nl.report = TRUE '
+                    'AND nl.annulled = FALSE '
+                'GROUP BY f.sample, nl.notebook, nl.analysis, nl.method'
+                ') AS l '
+            'GROUP BY sample',
+            (list(result.keys()),))
+        for sample_id, accepted, total, repeated in cursor.fetchall():
+            if not accepted:
+                continue
+            result[sample_id] = Decimal(
+                Decimal(accepted) / Decimal(total - repeated)
+                ).quantize(Decimal(str(10 ** -digits)))
+        return result
 
     @classmethod
     def get_department(cls, samples, name):
@@ -3318,124 +3378,167 @@ class Sample(ModelSQL, ModelView):
             return [('id', '=', -1)]
         return [('id', 'in', samples_ids)]
 
+    @classmethod
+    def delay_update_samples_state(cls, sample_ids):
+        '''
+        Recompute dates and state of the samples once, when the current
+        transaction is committed
+        '''
+        if not sample_ids:
+            return
+        datamanager = Transaction().join(SampleStateDataManager())
+        datamanager.sample_ids.update(sample_ids)
+
     @classmethod
     def update_samples_state(cls, sample_ids):
         samples = cls.browse(sample_ids)
+        lines = cls._get_samples_lines(samples)
+        dates = cls._get_samples_dates(samples, lines)
+
+        to_write = []
         for sample in samples:
-            sample.update_sample_dates()
-            sample.update_sample_state()
-            sample.update_qty_lines()
+            values = dates[sample.id]
+            values['state'] = cls._get_sample_state(values, lines[sample.id])
+            values.update(cls._get_qty_lines(lines[sample.id]))
+            values = dict((k, v) for k, v in values.items()
+                if getattr(sample, k) != v)
+            if values:
+                to_write.extend(([sample], values))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def update_samples_qty_lines(cls, samples):
+        lines = cls._get_samples_lines(samples)
 
-    def update_sample_dates(self):
-        dates = self._get_sample_dates()
-        for field, value in dates.items():
-            setattr(self, field, value)
-        self.save()
+        to_write = []
+        for sample in samples:
+            values = cls._get_qty_lines(lines[sample.id])
+            values = dict((k, v) for k, v in values.items()
+                if getattr(sample, k) != v)
+            if values:
+                to_write.extend(([sample], values))
+        if to_write:
+            cls.write(*to_write)
 
-    def _get_sample_dates(self):
+    @classmethod
+    def _get_samples_lines(cls, samples):
+        '''
+        Return a summary of the notebook lines of each sample: the
+        start, end and acceptance dates and the number of lines in
+        each stage
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
         Fraction = pool.get('lims.fraction')
         Service = pool.get('lims.service')
-        Notebook = pool.get('lims.notebook')
         NotebookLine = pool.get('lims.notebook.line')
-        ResultsReport = pool.get('lims.results_report')
-        ResultsVersion = pool.get('lims.results_report.version')
-        ResultsDetail = pool.get('lims.results_report.version.detail')
-        ResultsSample = pool.get('lims.results_report.version.detail.sample')
-
-        res = {}
-
-        # Confirmation date
-        cursor.execute('SELECT MIN(s.confirmation_date) '
-            'FROM "' + Service._table + '" s '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s',
-            (self.id,))
-        res['confirmation_date'] = cursor.fetchone()[0] or None
-
-        # Laboratory deadline
-        cursor.execute('SELECT MAX(s.laboratory_date) '
-            'FROM "' + Service._table + '" s '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s',
-            (self.id,))
-        res['laboratory_date'] = cursor.fetchone()[0] or None
-
-        # Date agreed for result
-        cursor.execute('SELECT MAX(s.report_date) '
-            'FROM "' + Service._table + '" s '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s',
-            (self.id,))
-        res['report_date'] = cursor.fetchone()[0] or None
 
-        # Laboratory start date
-        cursor.execute('SELECT MIN(nl.start_date) '
+        result = dict((s.id, {
+            'start_date': None,
+            'end_date': None,
+            'acceptance_date': None,
+            'total': 0,
+            'annulled': 0,
+            'pending': 0,
+            'ended': 0,
+            'not_accepted': 0,
+            'pending_acceptance': 0,
+            }) for s in samples)
+        if not result:
+            return result
+
+        reportable = 'nl.report = TRUE AND nl.annulled = FALSE'
+        cursor.execute('SELECT f.sample, MIN(nl.start_date), '
+                'MAX(nl.end_date), MAX(nl.acceptance_date::date), '
+                'COUNT(*), '
+                'COUNT(*) FILTER (WHERE nl.annulled = TRUE), '
+                'COUNT(*) FILTER (WHERE ' + reportable + ' '
+                    'AND nl.end_date IS NULL), '
+                'COUNT(*) FILTER (WHERE ' + reportable + ' '
+                    'AND nl.end_date IS NOT NULL), '
+                'COUNT(*) FILTER (WHERE ' + reportable + ' '
+                    'AND nl.acceptance_date IS NULL), '
+                'COUNT(*) FILTER (WHERE ' + reportable + ' '
+                    'AND nl.end_date IS NOT NULL '
+                    'AND nl.acceptance_date IS NULL) '
             'FROM "' + NotebookLine._table + '" nl '
                 'INNER JOIN "' + Service._table + '" s '
                 'ON s.id = nl.service '
                 'INNER JOIN "' + Fraction._table + '" f '
                 'ON f.id = s.fraction '
-            'WHERE f.sample = %s',
-            (self.id,))
-        res['laboratory_start_date'] = cursor.fetchone()[0] or None
+            'WHERE f.sample = ANY(%s) '
+            'GROUP BY f.sample',
+            (list(result.keys()),))
+        for x in cursor.fetchall():
+            result[x[0]] = {
+                'start_date': x[1],
+                'end_date': x[2],
+                'acceptance_date': x[3],
+                'total': x[4],
+                'annulled': x[5],
+                'pending': x[6],
+                'ended': x[7],
+                'not_accepted': x[8],
+                'pending_acceptance': x[9],
+                }
+        return result
 
-        # Laboratory end date
-        laboratory_end_date = None
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.end_date IS NULL',
-            (self.id,))
-        if cursor.fetchone()[0] == 0:
-            cursor.execute('SELECT MAX(nl.end_date) '
-                'FROM "' + NotebookLine._table + '" nl '
-                    'INNER JOIN "' + Service._table + '" s '
-                    'ON s.id = nl.service '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s',
-                (self.id,))
-            laboratory_end_date = cursor.fetchone()[0] or None
-        res['laboratory_end_date'] = laboratory_end_date
+    @classmethod
+    def _get_samples_dates(cls, samples, lines=None):
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Fraction = pool.get('lims.fraction')
+        Service = pool.get('lims.service')
+        Notebook = pool.get('lims.notebook')
+        ResultsReport = pool.get('lims.results_report')
+        ResultsVersion = pool.get('lims.results_report.version')
+        ResultsDetail = pool.get('lims.results_report.version.detail')
+        ResultsSample = pool.get('lims.results_report.version.detail.sample')
 
-        # Laboratory acceptance date
-        laboratory_acceptance_date = None
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
+        if lines is None:
+            lines = cls._get_samples_lines(samples)
+
+        res = {}
+        for sample in samples:
+            sample_lines = lines[sample.id]
+            res[sample.id] = {
+                'confirmation_date': None,
+                'laboratory_date': None,
+                'report_date': None,
+                # Laboratory start date
+                'laboratory_start_date': sample_lines['start_date'],
+                # Laboratory end date
+                'laboratory_end_date': (sample_lines['end_date']
+                    if not sample_lines['pending'] else None),
+                # Laboratory acceptance date
+                'laboratory_acceptance_date': (
+                    sample_lines['acceptance_date']
+                    if not sample_lines['not_accepted'] else None),
+                'results_report_create_date': None,
+                'results_report_release_date': None,
+                }
+        if not res:
+            return res
+        sample_ids = list(res.keys())
+
+        # Confirmation date, laboratory deadline and date agreed for result
+        cursor.execute('SELECT f.sample, MIN(s.confirmation_date), '
+                'MAX(s.laboratory_date), MAX(s.report_date) '
+            'FROM "' + Service._table + '" s '
                 'INNER JOIN "' + Fraction._table + '" f '
                 'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.acceptance_date IS NULL',
-            (self.id,))
-        if cursor.fetchone()[0] == 0:
-            cursor.execute('SELECT MAX(nl.acceptance_date::date) '
-                'FROM "' + NotebookLine._table + '" nl '
-                    'INNER JOIN "' + Service._table + '" s '
-                    'ON s.id = nl.service '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s',
-                (self.id,))
-            laboratory_acceptance_date = cursor.fetchone()[0] or None
-        res['laboratory_acceptance_date'] = laboratory_acceptance_date
-
-        # Report start date
-        cursor.execute('SELECT MIN(r.create_date::date) '
+            'WHERE f.sample = ANY(%s) '
+            'GROUP BY f.sample',
+            (sample_ids,))
+        for x in cursor.fetchall():
+            res[x[0]]['confirmation_date'] = x[1]
+            res[x[0]]['laboratory_date'] = x[2]
+            res[x[0]]['report_date'] = x[3]
+
+        # Report start date and report release date
+        cursor.execute('SELECT f.sample, MIN(r.create_date::date), '
+                'MAX(rd.release_date::date) FILTER (WHERE rd.valid) '
             'FROM "' + ResultsReport._table + '" r '
                 'INNER JOIN "' + ResultsVersion._table + '" rv '
                 'ON rv.results_report = r.id '
@@ -3447,142 +3550,42 @@ class Sample(ModelSQL, ModelView):
                 'ON n.id = rs.notebook '
                 'INNER JOIN "' + Fraction._table + '" f '
                 'ON f.id = n.fraction '
-            'WHERE f.sample = %s '
-                'AND rd.type != \'preliminary\'',
-            (self.id,))
-        res['results_report_create_date'] = cursor.fetchone()[0] or None
-
-        # Report release date
-        cursor.execute('SELECT MAX(rd.release_date::date) '
-            'FROM "' + ResultsDetail._table + '" rd '
-                'INNER JOIN "' + ResultsSample._table + '" rs '
-                'ON rs.version_detail = rd.id '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = rs.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-            'WHERE f.sample = %s '
-                'AND rd.valid '
-                'AND rd.type != \'preliminary\'',
-            (self.id,))
-        res['results_report_release_date'] = cursor.fetchone()[0] or None
+            'WHERE f.sample = ANY(%s) '
+                'AND rd.type != \'preliminary\' '
+            'GROUP BY f.sample',
+            (sample_ids,))
+        for x in cursor.fetchall():
+            res[x[0]]['results_report_create_date'] = x[1]
+            res[x[0]]['results_report_release_date'] = x[2]
 
         return res
 
-    def update_sample_state(self):
-        state = self._get_sample_state()
-        if self.state != state:
-            self.state = state
-            self.save()
-
-    def _get_sample_state(self):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Fraction = pool.get('lims.fraction')
-        Service = pool.get('lims.service')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        if self.results_report_release_date:
+    @staticmethod
+    def _get_sample_state(dates, lines):
+        if dates['results_report_release_date']:
             return 'report_released'
-        if self.results_report_create_date:
+        if dates['results_report_create_date']:
             return 'in_report'
-        if self.laboratory_acceptance_date:
+        if dates['laboratory_acceptance_date']:
             return 'pending_report'
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.annulled = TRUE',
-            (self.id,))
-        annulled_lines = cursor.fetchone()[0]
-        if annulled_lines > 0:
-            cursor.execute('SELECT COUNT(*) '
-                'FROM "' + NotebookLine._table + '" nl '
-                    'INNER JOIN "' + Service._table + '" s '
-                    'ON s.id = nl.service '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s',
-                (self.id,))
-            if cursor.fetchone()[0] == annulled_lines:
-                return 'annulled'
-        if self.laboratory_end_date:
+        if lines['annulled'] > 0 and lines['annulled'] == lines['total']:
+            return 'annulled'
+        if dates['laboratory_end_date']:
             return 'lab_pending_acceptance'
-        if self.laboratory_start_date:
-            cursor.execute('SELECT COUNT(*) '
-                'FROM "' + NotebookLine._table + '" nl '
-                    'INNER JOIN "' + Service._table + '" s '
-                    'ON s.id = nl.service '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s '
-                    'AND nl.report = TRUE '
-                    'AND nl.annulled = FALSE '
-                    'AND nl.end_date IS NOT NULL',
-                (self.id,))
-            if cursor.fetchone()[0] > 0:
+        if dates['laboratory_start_date']:
+            if lines['ended'] > 0:
                 return 'in_lab'
             return 'planned'
-        if self.confirmation_date:
+        if dates['confirmation_date']:
             return 'pending_planning'
         return 'draft'
 
-    def update_qty_lines(self):
-        save = False
-        qty = self._get_qty_lines_pending()
-        if self.qty_lines_pending != qty:
-            self.qty_lines_pending = qty
-            save = True
-        qty = self._get_qty_lines_pending_acceptance()
-        if self.qty_lines_pending_acceptance != qty:
-            self.qty_lines_pending_acceptance = qty
-            save = True
-        if save:
-            self.save()
-
-    def _get_qty_lines_pending(self):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Fraction = pool.get('lims.fraction')
-        Service = pool.get('lims.service')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.end_date IS NULL',
-            (self.id,))
-        return cursor.fetchone()[0]
-
-    def _get_qty_lines_pending_acceptance(self):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Fraction = pool.get('lims.fraction')
-        Service = pool.get('lims.service')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.end_date IS NOT NULL '
-                'AND nl.acceptance_date IS NULL',
-            (self.id,))
-        return cursor.fetchone()[0]
+    @staticmethod
+    def _get_qty_lines(lines):
+        return {
+            'qty_lines_pending': lines['pending'],
+            'qty_lines_pending_acceptance': lines['pending_acceptance'],
+            }
 
 
 class DuplicateSampleStart(ModelView):
@@ -6783,6 +6786,41 @@ class Referral(ModelSQL, ModelView):
         if self.laboratory and self.laboratory.carrier:
             self.carrier = self.laboratory.carrier
 
+    @classmethod
+    def delay_update_referrals_state(cls, referral_ids):
+        '''
+        Check whether the sent referrals are done once, when the current
+        transaction is committed
+        '''
+        if not referral_ids:
+            return
+        datamanager = Transaction().join(SampleStateDataManager())
+        datamanager.referral_ids.update(referral_ids)
+
+    @classmethod
+    def update_referrals_state(cls, referral_ids):
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        referrals = cls.search([
+            ('state', '=', 'sent'),
+            ('id', 'in', referral_ids),
+            ])
+        if not referrals:
+            return
+
+        pending_lines = NotebookLine.search([
+            ('analysis_detail.referral', 'in', [r.id for r in referrals]),
+            ('annulled', '=', False),
+            ('result', 'in', [None, '']),
+            ('literal_result', 'in', [None, '']),
+            ('result_modifier', 'not in', [
+                'd', 'nd', 'pos', 'neg', 'ni', 'abs', 'pre', 'na']),
+            ])
+        pending = set(l.analysis_detail.referral.id for l in pending_lines)
+        done = [r for r in referrals if r.id not in pending]
+        if done:
+            cls.write(done, {'state': 'done'})
+
     @classmethod
     @ModelView.button
     def send(cls, referrals):
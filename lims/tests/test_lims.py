@@ -1,19 +1,221 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import random
 import unittest
 import doctest
+from math import sqrt
+from types import SimpleNamespace
+
+import numpy as np
 
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond.pool import Pool
+from trytond.exceptions import UserError
+
+from trytond.modules.lims import control_tendency
+from trytond.modules.lims.formula_parser import FormulaParser
 
 
 class LimsTestCase(ModuleTestCase):
     'Test lims module'
     module = 'lims'
 
+    @with_transaction()
+    def test_analysis_included_tree(self):
+        'Test included analysis of sets and groups'
+        pool = Pool()
+        Analysis = pool.get('lims.analysis')
+        AnalysisIncluded = pool.get('lims.analysis.included')
+
+        analysis, set_, group, parent = Analysis.create([{
+                    'code': code,
+                    'description': code,
+                    'type': type_,
+                    'behavior': 'additional',
+                    } for code, type_ in [
+                    ('A', 'analysis'), ('S', 'set'),
+                    ('G', 'group'), ('P', 'group')]])
+        AnalysisIncluded.create([{
+                    'analysis': set_.id,
+                    'included_analysis': analysis.id,
+                    }, {
+                    'analysis': group.id,
+                    'included_analysis': set_.id,
+                    }, {
+                    'analysis': parent.id,
+                    'included_analysis': group.id,
+                    }])
+        Analysis.write([set_, group, parent], {'state': 'active'})
+
+        self.assertEqual(Analysis.get_included_analysis(parent.id),
+            sorted([analysis.id, set_.id, group.id]))
+        self.assertEqual(Analysis.get_included_analysis_analysis(parent.id),
+            [analysis.id])
+        self.assertEqual(Analysis.get_parents_analysis(analysis.id),
+            sorted([set_.id, group.id, parent.id]))
+
+        # The walk up the tree stops at inactive sets and groups
+        Analysis.write([group], {'state': 'disabled'})
+        self.assertEqual(Analysis.get_parents_analysis(analysis.id),
+            [set_.id])
+        self.assertEqual(Analysis.get_parents_analysis(group.id),
+            [parent.id])
+
+    @with_transaction()
+    def test_formula_parser(self):
+        'Test formula parser'
+        for formula, vars, value in [
+                ('1 + 2 * 3', {}, 7.0),
+                ('(1 + 2) * 3', {}, 9.0),
+                ('2 ^ 3 - -1', {}, 9.0),
+                ('X / 4', {'X': 2}, 0.5),
+                ('X / 0 * Y', {'X': 2, 'Y': 3}, 0.0),
+                ('X * 2', {'X': ''}, 0.0),
+                ('X * 2', {'X': 'a'}, 0.0),
+                ('pi * 2', {}, 2 * 3.141592653589793),
+                ]:
+            self.assertEqual(FormulaParser(formula, vars).getValue(), value,
+                msg=formula)
+        self.assertEqual(FormulaParser.getValues('X * Y + 1',
+                [{'X': 1, 'Y': 2}, {'X': '3', 'Y': 4}]),
+            [3.0, 13.0])
+
+        for formula, vars in [
+                ('1 +', {}),
+                ('(1 + 2', {}),
+                ('1.2.3', {}),
+                ('1 2', {}),
+                ('X * 2', {}),
+                ('X * 2', {'X': None}),
+                # Undefined variables are reported even if not reached
+                ('X / 0 * Y', {'X': 2}),
+                ('pi * 2', {'pi': 3}),
+                ]:
+            with self.assertRaises(UserError, msg=formula):
+                FormulaParser(formula, vars).getValue()
+
+    @with_transaction()
+    def test_control_tendency_rules(self):
+        'Test tendency rules against a backwards scan of the results'
+        TendenciesAnalysis = Pool().get('lims.control.tendencies_analysis',
+            type='wizard')
+
+        def check_rule(results, upper_parameter, lower_parameter,
+                occurrences, total):
+            # Backwards scan of the last total results
+            if len(results) < total:
+                return False
+
+            total_counter = 0
+            upper_counter = 0
+            lower_counter = 0
+            for result in reversed(results):
+
+                total_counter += 1
+                if result > upper_parameter:
+                    upper_counter += 1
+                    if total_counter == total:
+                        if (upper_counter >= occurrences or
+                                lower_counter >= occurrences):
+                            return True
+                        return False
+                    lower_counter = 0
+                elif result < lower_parameter:
+                    lower_counter += 1
+                    if total_counter == total:
+                        if (lower_counter >= occurrences or
+                                upper_counter >= occurrences):
+                            return True
+                        return False
+                    upper_counter = 0
+                else:
+                    if total_counter == total:
+                        if (upper_counter >= occurrences or
+                                lower_counter >= occurrences):
+                            return True
+                        return False
+                    upper_counter = 0
+                    lower_counter = 0
+            return False
+
+        def get_rules(results, tendency):
+            rules = []
+            for rule, sd, occurrences, total in [
+                    ('4', tendency.three_sd_adj, 1, 1),
+                    ('3', tendency.two_sd_adj, 2, 3),
+                    ('2', tendency.one_sd_adj, 4, 5),
+                    ('1', 0, 8, 8)]:
+                if check_rule(results, tendency.mean + sd,
+                        tendency.mean - sd, occurrences, total):
+                    rules.append(rule)
+            return rules or ['']
+
+        session_id, _, _ = TendenciesAnalysis.create()
+        tendencies_analysis = TendenciesAnalysis(session_id)
+        tendency = SimpleNamespace(mean=10.0, one_sd_adj=1.0,
+            two_sd_adj=2.0, three_sd_adj=3.0)
+        generator = random.Random(0)
+        for i in range(500):
+            results = [round(generator.gauss(10.5, 1.5), 1)
+                for _ in range(generator.randint(0, 40))]
+            self.assertEqual(
+                tendencies_analysis.get_rules(np.array(results), tendency),
+                [get_rules(results[:i + 1], tendency)
+                    for i in range(len(results))], msg=results)
+
+    def test_control_statistics(self):
+        'Test control chart statistics against a loop over the results'
+
+        def get_statistics(results):
+            count = len(results)
+            total = mr_abs_diff = 0.0
+            mr_last_result = None
+            mrs = []
+            for result in results:
+                mr = (mr_last_result and abs(result - mr_last_result)
+                    or 0.0)
+                mr_last_result = result
+                mrs.append(mr)
+                total += result
+                mr_abs_diff += mr
+            if count > 2:
+                mr_avg_abs_diff = round(mr_abs_diff / (count - 1), 2)
+            else:
+                mr_avg_abs_diff = mr_abs_diff
+            mean = round(total / count, 2)
+            total = 0.0
+            for result in results:
+                total += (result - mean) ** 2
+            if count > 1:
+                deviation = round(sqrt(total / (count - 1)), 2)
+            else:
+                deviation = 0.0
+            return {
+                'mean': mean,
+                'deviation': deviation,
+                'mr': mrs,
+                'mr_avg_abs_diff': mr_avg_abs_diff,
+                }
+
+        generator = random.Random(0)
+        for i in range(500):
+            results = [generator.choice([0.0,
+                        round(generator.uniform(-5, 50), 3)])
+                for _ in range(generator.randint(1, 60))]
+            statistics = control_tendency.get_statistics(np.array(results))
+            expected = get_statistics(results)
+            self.assertEqual(statistics['mean'], expected['mean'],
+                msg=results)
+            self.assertEqual(statistics['deviation'], expected['deviation'],
+                msg=results)
+            self.assertEqual(statistics['mr'], expected['mr'], msg=results)
+            self.assertEqual(statistics['mr_avg_abs_diff'],
+                expected['mr_avg_abs_diff'], msg=results)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -2,10 +2,13 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from bisect import bisect_left
 
 from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.cache import Cache
 
 
 class Uom(metaclass=PoolMeta):
@@ -50,16 +53,57 @@ class UomConversion(ModelSQL, ModelView):
     final_uom_volume = fields.Boolean('Volume involved in Final UoM')
     conversion_formula = fields.Char('Conversion formula')
 
+    _conversions_cache = Cache('lims.uom.conversion', context=False)
+
     @classmethod
-    def get_conversion_formula(cls, initial_uom, final_uom):
+    def create(cls, vlist):
+        cls._conversions_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._conversions_cache.clear()
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, conversions):
+        cls._conversions_cache.clear()
+        super().delete(conversions)
+
+    @classmethod
+    def _get_conversions(cls):
+        conversions = cls._conversions_cache.get('conversions')
+        if conversions is not None:
+            return conversions
+
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT initial_uom, final_uom, conversion_formula, '
+                'initial_uom_volume, final_uom_volume '
+            'FROM "' + cls._table + '" '
+            'ORDER BY id')
+        conversions = {}
+        for x in cursor.fetchall():
+            conversions.setdefault((x[0], x[1]),
+                (x[2], bool(x[3]), bool(x[4])))
+        cls._conversions_cache.set('conversions', conversions)
+        return conversions
+
+    @classmethod
+    def get_conversion(cls, initial_uom, final_uom):
+        '''
+        Return the (conversion_formula, initial_uom_volume, final_uom_volume)
+        of the conversion between both uoms, or None
+        '''
         if not initial_uom or not final_uom:
             return None
-        values = cls.search([
-            ('initial_uom', '=', initial_uom),
-            ('final_uom', '=', final_uom),
-            ])
-        if values:
-            return values[0].conversion_formula
+        return cls._get_conversions().get(
+            (int(initial_uom), int(final_uom)))
+
+    @classmethod
+    def get_conversion_formula(cls, initial_uom, final_uom):
+        conversion = cls.get_conversion(initial_uom, final_uom)
+        if conversion:
+            return conversion[0]
         return None
 
 
@@ -90,6 +134,7 @@ class VolumeConversion(ModelSQL, ModelView):
         'get_configuration_field')
     soluble_solids_digits = fields.Function(fields.Integer(
         'Soluble solids digits'), 'get_configuration_field')
+    _table_cache = Cache('lims.volume.conversion.table', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -127,83 +172,70 @@ class VolumeConversion(ModelSQL, ModelView):
         return result
 
     @classmethod
-    def brixToDensity(cls, brix):
-        if not brix:
-            return None
-        brix = float(brix)
+    def create(cls, vlist):
+        cls._table_cache.clear()
+        return super().create(vlist)
 
-        values = cls.search([
-            ('brix', '=', brix),
-            ], limit=1)
-        if values:
-            return values[0].density
-
-        intrpltn = {
-            'x_a': 0,
-            'y_a': 0,
-            'x_b': 0,
-            'y_b': 0,
-            }
-        lower_values = cls.search([
-            ('brix', '<', brix),
-            ], order=[('brix', 'DESC')], limit=1)
-        if not lower_values:
-            return None
-        intrpltn['x_a'] = lower_values[0].brix
-        intrpltn['y_a'] = lower_values[0].density
+    @classmethod
+    def write(cls, *args):
+        cls._table_cache.clear()
+        super().write(*args)
 
-        upper_values = cls.search([
-            ('brix', '>', brix),
-            ], order=[('brix', 'ASC')], limit=1)
-        if not upper_values:
-            return None
-        intrpltn['x_b'] = upper_values[0].brix
-        intrpltn['y_b'] = upper_values[0].density
+    @classmethod
+    def delete(cls, conversions):
+        cls._table_cache.clear()
+        super().delete(conversions)
 
-        value = (intrpltn['y_a'] + (brix - intrpltn['x_a']) * (
-            (intrpltn['y_b'] - intrpltn['y_a']) /
-            (intrpltn['x_b'] - intrpltn['x_a'])))
-        return value
+    @classmethod
+    def _get_table(cls):
+        '''
+        Return the conversion table as lists of brix, density and soluble
+        solids sorted by brix
+        '''
+        table = cls._table_cache.get('table')
+        if table is not None:
+            return table
+
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT brix, density, soluble_solids '
+            'FROM "' + cls._table + '" '
+            'ORDER BY brix ASC, id ASC')
+        rows = cursor.fetchall()
+        table = {
+            'brix': [x[0] for x in rows],
+            'density': [x[1] for x in rows],
+            'soluble_solids': [x[2] for x in rows],
+            }
+        cls._table_cache.set('table', table)
+        return table
 
     @classmethod
-    def brixToSolubleSolids(cls, brix):
+    def _interpolate(cls, brix, name):
         if not brix:
             return None
         brix = float(brix)
 
-        values = cls.search([
-            ('brix', '=', brix),
-            ], limit=1)
-        if values:
-            return values[0].soluble_solids
-
-        intrpltn = {
-            'x_a': 0,
-            'y_a': 0,
-            'x_b': 0,
-            'y_b': 0,
-            }
-        lower_values = cls.search([
-            ('brix', '<', brix),
-            ], order=[('brix', 'DESC')], limit=1)
-        if not lower_values:
+        table = cls._get_table()
+        brixes, values = table['brix'], table[name]
+        i = bisect_left(brixes, brix)
+        if i < len(brixes) and brixes[i] == brix:
+            return values[i]
+        if i == 0 or i == len(brixes):
             return None
-        intrpltn['x_a'] = lower_values[0].brix
-        intrpltn['y_a'] = lower_values[0].soluble_solids
 
-        upper_values = cls.search([
-            ('brix', '>', brix),
-            ], order=[('brix', 'ASC')], limit=1)
-        if not upper_values:
-            return None
-        intrpltn['x_b'] = upper_values[0].brix
-        intrpltn['y_b'] = upper_values[0].soluble_solids
-
-        value = (intrpltn['y_a'] + (brix - intrpltn['x_a']) * (
-            (intrpltn['y_b'] - intrpltn['y_a']) /
-            (intrpltn['x_b'] - intrpltn['x_a'])))
+        x_a, y_a = brixes[i - 1], values[i - 1]
+        x_b, y_b = brixes[i], values[i]
+        value = y_a + (brix - x_a) * ((y_b - y_a) / (x_b - x_a))
         return value
 
+    @classmethod
+    def brixToDensity(cls, brix):
+        return cls._interpolate(brix, 'density')
+
+    @classmethod
+    def brixToSolubleSolids(cls, brix):
+        return cls._interpolate(brix, 'soluble_solids')
+
 
 class ConcentrationLevel(ModelSQL, ModelView):
     'Concentration Level'
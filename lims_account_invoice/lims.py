@@ -12,6 +12,7 @@ from trytond.report import Report
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import PYSONEncoder
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
@@ -33,6 +34,9 @@ class Entry(metaclass=PoolMeta):
         'Last Release date'), 'get_last_release_date')
     qty_lines_pending_invoicing = fields.Function(fields.Integer(
         'Lines pending invoicing'), 'get_qty_lines_pending_invoicing')
+    ready_for_invoicing = fields.Function(fields.Boolean(
+        'Ready for invoicing'), 'get_ready_for_invoicing',
+        searcher='search_ready_for_invoicing')
 
     @classmethod
     def get_last_release_date(cls, entries, name):
@@ -45,9 +49,9 @@ class Entry(metaclass=PoolMeta):
         Fraction = pool.get('lims.fraction')
         Sample = pool.get('lims.sample')
 
-        result = {}
-        for e in entries:
-            cursor.execute('SELECT MAX(rd.release_date) '
+        result = dict((e.id, None) for e in entries)
+        for sub_ids in grouped_slice(list(result.keys())):
+            cursor.execute('SELECT s.entry, MAX(rd.release_date) '
                 'FROM "' + ResultsVersion._table + '" rv '
                     'INNER JOIN "' + ResultsDetail._table + '" rd '
                     'ON rv.id = rd.report_version '
@@ -59,48 +63,113 @@ class Entry(metaclass=PoolMeta):
                     'ON f.id = n.fraction '
                     'INNER JOIN "' + Sample._table + '" s '
                     'ON s.id = f.sample '
-                'WHERE s.entry = %s '
+                'WHERE s.entry = ANY(%s) '
                     'AND rd.state = \'released\' '
-                    'AND rd.type != \'preliminary\'',
-                (str(e.id),))
-            result[e.id] = cursor.fetchone()[0]
-
+                    'AND rd.type != \'preliminary\' '
+                'GROUP BY s.entry',
+                (list(sub_ids),))
+            result.update(cursor.fetchall())
         return result
 
     @classmethod
     def get_qty_lines_pending_invoicing(cls, entries, name):
         cursor = Transaction().connection.cursor()
+
+        result = dict((e.id, 0) for e in entries)
+        for sub_ids in grouped_slice(list(result.keys())):
+            cursor.execute('SELECT s.entry, COUNT(il.id) ' +
+                cls._get_lines_pending_invoicing_from() +
+                'WHERE il.invoice IS NULL '
+                    'AND s.entry = ANY(%s) '
+                'GROUP BY s.entry',
+                (list(sub_ids),))
+            result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def get_lines_pending_invoicing(cls, entries):
+        '''
+        Return the ids of the invoice lines of entries not yet invoiced
+        '''
+        cursor = Transaction().connection.cursor()
+
+        lines_ids = []
+        for sub_ids in grouped_slice([e.id for e in entries]):
+            cursor.execute('SELECT il.id ' +
+                cls._get_lines_pending_invoicing_from() +
+                'WHERE il.invoice IS NULL '
+                    'AND s.entry = ANY(%s)',
+                (list(sub_ids),))
+            lines_ids.extend(x[0] for x in cursor.fetchall())
+        return lines_ids
+
+    @staticmethod
+    def _get_lines_pending_invoicing_from():
         pool = Pool()
         Sample = pool.get('lims.sample')
         Fraction = pool.get('lims.fraction')
         Service = pool.get('lims.service')
         InvoiceLine = pool.get('account.invoice.line')
 
-        result = {}
-        for e in entries:
-            result[e.id] = 0
+        return ('FROM "' + InvoiceLine._table + '" il '
+                'INNER JOIN "' + Service._table + '" srv '
+                'ON il.origin = \'lims.service,\' || srv.id '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = srv.fraction '
+                'INNER JOIN "' + Sample._table + '" s '
+                'ON s.id = f.sample ')
 
-            cursor.execute('SELECT srv.id '
-                'FROM "' + Service._table + '" srv '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = srv.fraction '
-                    'INNER JOIN "' + Sample._table + '" s '
-                    'ON s.id = f.sample '
-                'WHERE s.entry = %s',
-                (str(e.id),))
-            services_ids = [x[0] for x in cursor.fetchall()]
-            if not services_ids:
-                continue
+    @classmethod
+    def get_ready_for_invoicing(cls, entries, name):
+        ready_ids = cls._get_entries_ready_for_invoicing(
+            [e.id for e in entries])
+        return dict((e.id, e.id in ready_ids) for e in entries)
 
-            origins = '\', \''.join(['lims.service,' + str(s)
-                for s in services_ids])
-            cursor.execute('SELECT COUNT(*) '
-                'FROM "' + InvoiceLine._table + '" '
-                'WHERE origin IN (\'' + origins + '\') '
-                    'AND invoice IS NULL')
-            result[e.id] = cursor.fetchone()[0]
+    @classmethod
+    def search_ready_for_invoicing(cls, name, clause):
+        ready_ids = list(cls._get_entries_ready_for_invoicing())
+        _, operator_, value = clause
+        if (operator_ == '=') == bool(value):
+            return [('id', 'in', ready_ids)]
+        return [('id', 'not in', ready_ids)]
 
-        return result
+    @classmethod
+    def _get_entries_ready_for_invoicing(cls, entries_ids=None):
+        '''
+        Return the ids of the entries with services pending invoicing
+        whose results have all been reported
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        NotebookLine = pool.get('lims.notebook.line')
+        Notebook = pool.get('lims.notebook')
+        Fraction = pool.get('lims.fraction')
+        Sample = pool.get('lims.sample')
+
+        sql_where = 'WHERE il.invoice IS NULL '
+        sql_params = []
+        if entries_ids is not None:
+            sql_where += 'AND s.entry = ANY(%s) '
+            sql_params.append(entries_ids)
+
+        cursor.execute('SELECT s.entry '
+            'FROM "' + NotebookLine._table + '" nl '
+                'INNER JOIN "' + InvoiceLine._table + '" il '
+                'ON il.origin = \'lims.service,\' || nl.service '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.id = nl.notebook '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = n.fraction '
+                'INNER JOIN "' + Sample._table + '" s '
+                'ON s.id = f.sample ' +
+            sql_where +
+            'GROUP BY s.entry '
+            'HAVING NOT COALESCE(BOOL_OR(nl.annulled = FALSE '
+                'AND nl.report = TRUE '
+                'AND nl.results_report IS NULL), FALSE)',
+            sql_params)
+        return set(x[0] for x in cursor.fetchall())
 
     @classmethod
     def on_hold(cls, entries):
@@ -116,8 +185,7 @@ class Entry(metaclass=PoolMeta):
                 ('entry', 'in', [e.id for e in entries]),
                 ('annulled', '=', False),
                 ])
-        for service in services:
-            service.create_invoice_line()
+        Service.create_invoice_lines(services)
 
     @classmethod
     def view_toolbar_get(cls):
@@ -191,8 +259,7 @@ class Fraction(metaclass=PoolMeta):
                 ('fraction', 'in', [f.id for f in fractions]),
                 ('annulled', '=', False),
                 ])
-        for service in services:
-            service.create_invoice_line()
+        Service.create_invoice_lines(services)
 
 
 class Service(metaclass=PoolMeta):
@@ -203,69 +270,100 @@ class Service(metaclass=PoolMeta):
         services = super().create(vlist)
         services_to_invoice = [s for s in services if
             s.entry.state == 'pending']
-        for service in services_to_invoice:
-            service.create_invoice_line()
+        cls.create_invoice_lines(services_to_invoice)
         return services
 
     def create_invoice_line(self):
+        self.create_invoice_lines([self])
+
+    @classmethod
+    def create_invoice_lines(cls, services):
         InvoiceLine = Pool().get('account.invoice.line')
 
-        if (not self.fraction.type.invoiceable or
-                self.fraction.cie_fraction_type):
+        services = [s for s in services if s.fraction.type.invoiceable and
+            not s.fraction.cie_fraction_type]
+        if not services:
             return
-        invoice_line = self.get_invoice_line()
-        if not invoice_line:
+        invoice_lines = cls.get_invoice_lines(services)
+        to_create = [invoice_lines[s.id] for s in services
+            if invoice_lines.get(s.id)]
+        if not to_create:
             return
         with Transaction().set_context(_check_access=False):
-            InvoiceLine.create([invoice_line])
+            InvoiceLine.create(to_create)
 
     def get_invoice_line(self):
+        return self.get_invoice_lines([self]).get(self.id)
+
+    @classmethod
+    def get_invoice_lines(cls, services):
+        '''
+        Return the invoice line values of each service, looking up the
+        accounts and taxes once per product and invoice party
+        '''
         Company = Pool().get('company.company')
 
         company = Transaction().context.get('company')
         currency = Company(company).currency.id
-        product = self.analysis.product if self.analysis else None
-        if not product:
-            return
-        account_revenue = product.account_revenue_used
-        if not account_revenue:
-            raise UserError(
-                gettext('lims_account_invoice.msg_missing_account_revenue',
-                    product=self.analysis.product.rec_name,
-                    service=self.rec_name))
-
-        party = self.entry.invoice_party
+
+        products = {}
+        taxes = {}
+        result = {}
+        for service in services:
+            product = service.analysis.product if service.analysis else None
+            if not product:
+                continue
+            if product.id not in products:
+                products[product.id] = product.account_revenue_used
+            account_revenue = products[product.id]
+            if not account_revenue:
+                raise UserError(
+                    gettext('lims_account_invoice.msg_missing_account_revenue',
+                        product=service.analysis.product.rec_name,
+                        service=service.rec_name))
+
+            party = service.entry.invoice_party
+            tax_rule = party.customer_tax_rule
+            key = (product.id, tax_rule.id if tax_rule else None)
+            if key not in taxes:
+                taxes[key] = cls._get_invoice_line_taxes(product, tax_rule)
+            taxes_to_add = None
+            if taxes[key]:
+                taxes_to_add = [('add', list(taxes[key]))]
+
+            result[service.id] = {
+                'company': company,
+                'currency': currency,
+                'invoice_type': 'out',
+                'party': party,
+                'description': (service.number + ' - ' +
+                    service.analysis.rec_name),
+                'origin': str(service),
+                'quantity': 1,
+                'unit': product.default_uom,
+                'product': product,
+                'unit_price': Decimal('1.00'),
+                'taxes': taxes_to_add,
+                'account': account_revenue,
+                }
+        return result
+
+    @staticmethod
+    def _get_invoice_line_taxes(product, tax_rule):
         taxes = []
         pattern = {}
         for tax in product.customer_taxes_used:
-            if party.customer_tax_rule:
-                tax_ids = party.customer_tax_rule.apply(tax, pattern)
+            if tax_rule:
+                tax_ids = tax_rule.apply(tax, pattern)
                 if tax_ids:
                     taxes.extend(tax_ids)
                 continue
             taxes.append(tax.id)
-        if party.customer_tax_rule:
-            tax_ids = party.customer_tax_rule.apply(None, pattern)
+        if tax_rule:
+            tax_ids = tax_rule.apply(None, pattern)
             if tax_ids:
                 taxes.extend(tax_ids)
-        taxes_to_add = None
-        if taxes:
-            taxes_to_add = [('add', taxes)]
-
-        return {
-            'company': company,
-            'currency': currency,
-            'invoice_type': 'out',
-            'party': party,
-            'description': self.number + ' - ' + self.analysis.rec_name,
-            'origin': str(self),
-            'quantity': 1,
-            'unit': product.default_uom,
-            'product': product,
-            'unit_price': Decimal('1.00'),
-            'taxes': taxes_to_add,
-            'account': account_revenue,
-            }
+        return taxes
 
     @classmethod
     def delete(cls, services):
@@ -335,61 +433,12 @@ class OpenEntriesReadyForInvoicing(Wizard):
     start_state = 'open_'
     open_ = StateAction('lims_account_invoice.act_entries_ready_for_invoicing')
 
-    def _get_entries_ready_for_invoicing(self):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        InvoiceLine = pool.get('account.invoice.line')
-        NotebookLine = pool.get('lims.notebook.line')
-        Notebook = pool.get('lims.notebook')
-        Fraction = pool.get('lims.fraction')
-        Sample = pool.get('lims.sample')
-
-        cursor.execute('SELECT origin '
-            'FROM "' + InvoiceLine._table + '" '
-            'WHERE origin LIKE \'lims.service,%\' '
-                'AND invoice IS NULL')
-        invoiced_services = [x[0][13:] for x in cursor.fetchall()]
-        if not invoiced_services:
-            return []
-        services_ids = ', '.join(s for s in invoiced_services)
-
-        cursor.execute('SELECT DISTINCT(s.entry) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = nl.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-                'INNER JOIN "' + Sample._table + '" s '
-                'ON s.id = f.sample '
-            'WHERE nl.service IN (' + services_ids + ')')
-        invoiced_entries = [x[0] for x in cursor.fetchall()]
-
-        cursor.execute('SELECT DISTINCT(s.entry) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = nl.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-                'INNER JOIN "' + Sample._table + '" s '
-                'ON s.id = f.sample '
-            'WHERE nl.service IN (' + services_ids + ') '
-                'AND (nl.annulled = FALSE '
-                'AND nl.report = TRUE '
-                'AND nl.results_report IS NULL)')
-        pending_entries = [x[0] for x in cursor.fetchall()]
-
-        entries = list(set(invoiced_entries) - set(pending_entries))
-        if not entries:
-            return []
-        return entries
-
     def do_open_(self, action):
-        entries_ids = self._get_entries_ready_for_invoicing()
         action['pyson_context'] = PYSONEncoder().encode({
             'ready_for_invoicing': True,
             })
         action['pyson_domain'] = PYSONEncoder().encode([
-            ('id', 'in', entries_ids),
+            ('ready_for_invoicing', '=', True),
             ])
         return action, {}
 
@@ -402,36 +451,10 @@ class OpenLinesPendingInvoicing(Wizard):
     open_ = StateAction('lims_account_invoice.act_invoice_line')
 
     def do_open_(self, action):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Entry = pool.get('lims.entry')
-        Sample = pool.get('lims.sample')
-        Fraction = pool.get('lims.fraction')
-        Service = pool.get('lims.service')
-        InvoiceLine = pool.get('account.invoice.line')
+        Entry = Pool().get('lims.entry')
 
-        lines_ids = []
         entries = Entry.browse(Transaction().context['active_ids'])
-        for entry in entries:
-            cursor.execute('SELECT srv.id '
-                'FROM "' + Service._table + '" srv '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = srv.fraction '
-                    'INNER JOIN "' + Sample._table + '" s '
-                    'ON s.id = f.sample '
-                'WHERE s.entry = %s',
-                (str(entry.id),))
-            services_ids = [x[0] for x in cursor.fetchall()]
-            if not services_ids:
-                continue
-
-            origins = '\', \''.join(['lims.service,' + str(s)
-                for s in services_ids])
-            cursor.execute('SELECT id '
-                'FROM "' + InvoiceLine._table + '" '
-                'WHERE origin IN (\'' + origins + '\') '
-                    'AND invoice IS NULL')
-            lines_ids.extend(x[0] for x in cursor.fetchall())
+        lines_ids = Entry.get_lines_pending_invoicing(entries)
 
         action['pyson_domain'] = PYSONEncoder().encode([
             ('id', 'in', lines_ids),
@@ -27,10 +27,10 @@ class NotebookRule(metaclass=PoolMeta):
     def default_apply_on_notebook():
         return False
 
-    def eval_condition(self, line):
+    def eval_condition(self, line, values=None):
         if self.analysis_sheet:
             return False
-        return super().eval_condition(line)
+        return super().eval_condition(line, values)
 
     def eval_sheet_condition(self, line):
         for condition in self.conditions:
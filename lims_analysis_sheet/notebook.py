@@ -959,20 +959,14 @@ class ResultsVerification(Wizard):
             elif (iu == fu and ic != fc):
                 converted_result = result * (fc / ic)
             else:
-                formula = None
-                conversions = UomConversion.search([
-                    ('initial_uom', '=', iu),
-                    ('final_uom', '=', fu),
-                    ])
-                if conversions:
-                    formula = conversions[0].conversion_formula
-                if not formula:
+                conversion = UomConversion.get_conversion(iu, fu)
+                if not conversion or not conversion[0]:
                     return None
+                formula, initial_uom_volume, final_uom_volume = conversion
                 variables = self._get_variables(formula, notebook_line)
                 parser = FormulaParser(formula, variables)
                 formula_result = parser.getValue()
-                if (conversions[0].initial_uom_volume and
-                        conversions[0].final_uom_volume):
+                if initial_uom_volume and final_uom_volume:
                     d_ic = VolumeConversion.brixToDensity(ic)
                     d_fc = VolumeConversion.brixToDensity(fc)
                     converted_result = (result * (fc / ic) *
@@ -1185,11 +1179,10 @@ class EvaluateRules(Wizard):
                 ('compilation', '=', sheet.compilation.id),
                 ('notebook_line', '!=', None),
                 ])
+            rules = NotebookRule.get_rules_by_analysis(
+                [l.notebook_line.analysis.id for l in lines])
             for line in lines:
-                rules = NotebookRule.search([
-                    ('analysis', '=', line.notebook_line.analysis),
-                    ])
-                for rule in rules:
+                for rule in rules.get(line.notebook_line.analysis.id, []):
                     if rule.eval_sheet_condition(line):
                         rule.exec_sheet_action(line)
         return 'end'
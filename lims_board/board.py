@@ -1,11 +1,14 @@
 # This file is part of lims_board module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from dateutil.relativedelta import relativedelta
+from collections import defaultdict
+from sql import Column, Literal
+from sql.aggregate import Count
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.cache import Cache
 from trytond.i18n import gettext
 
 DEPARTMENTS_LIMIT = 30
@@ -15,6 +18,91 @@ SAMPLES_IN_PROGRESS = ['pending_planning', 'planned',
 SAMPLES_IN_LABORATORY = ['pending_planning', 'planned',
     'in_lab', 'lab_pending_acceptance']
 
+_samples_count_cache = Cache('lims.board.samples_count', duration=60)
+
+
+def get_samples_clause(board, states):
+    clause = [('state', 'in', states)]
+    if board.date_from:
+        clause.append(('date2', '>=', board.date_from))
+    if board.date_to:
+        clause.append(('date2', '<=', board.date_to))
+    if board.parties:
+        clause.append(('party', 'in', [p.id for p in board.parties]))
+    if board.departments:
+        clause.append(('department', 'in',
+            [d.id for d in board.departments]))
+    if board.analysis:
+        clause.append(('fractions.services.analysis', 'in',
+            [a.id for a in board.analysis]))
+    return clause
+
+
+def count_samples(clause, date_field):
+    '''
+    Return the quantity of samples matching clause grouped by department,
+    state and date_field, as a list of (department, state, date, quantity)
+    '''
+    pool = Pool()
+    Sample = pool.get('lims.sample')
+    ProductType = pool.get('lims.product.type')
+    cursor = Transaction().connection.cursor()
+
+    key = (str(clause), date_field)
+    res = _samples_count_cache.get(key)
+    if res is not None:
+        return res
+
+    sample = Sample.__table__()
+    product_type = ProductType.__table__()
+    date = Column(sample, date_field)
+    query = sample.join(product_type, 'LEFT',
+        condition=product_type.id == sample.product_type).select(
+        product_type.department, sample.state, date, Count(Literal('*')),
+        where=sample.id.in_(Sample.search(clause, order=[], query=True)),
+        group_by=[product_type.department, sample.state, date])
+    cursor.execute(*query)
+    res = cursor.fetchall()
+    _samples_count_cache.set(key, res)
+    return res
+
+
+def get_samples_date_records(counts, today):
+    '''
+    Return the rows of the samples per date widgets: the quantity of
+    samples per department for each day around today
+    '''
+    Department = Pool().get('company.department')
+
+    i = 0
+    dep = {None: ''}
+    departments = Department.search([], order=[('id', 'ASC')],
+        limit=DEPARTMENTS_LIMIT)
+    for d in departments:
+        i += 1
+        dep[d.id] = i
+
+    labels = ['< -4 d', '-3 d', '-2 d',
+        gettext('lims_board.msg_yesterday'),
+        gettext('lims_board.msg_today'),
+        gettext('lims_board.msg_tomorrow'),
+        '+2 d', '+3 d', '> +4 d']
+    quantities = defaultdict(int)
+    for department, _, date, quantity in counts:
+        if date is None:
+            bucket = 8
+        else:
+            bucket = min(max((date - today).days, -4), 4) + 4
+        quantities[(bucket, department)] += quantity
+
+    records = []
+    for bucket, label in enumerate(labels):
+        record = {'t': label}
+        for d_id, d_it in dep.items():
+            record['q%s' % d_it] = quantities[(bucket, d_id)]
+        records.append(record)
+    return records
+
 
 class BoardGeneral(ModelSQL, ModelView):
     'General Dashboard'
@@ -74,19 +162,7 @@ class BoardGeneral(ModelSQL, ModelView):
         pool = Pool()
         Sample = pool.get('lims.sample')
 
-        clause = [('state', 'in', SAMPLES_IN_PROGRESS)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
+        clause = get_samples_clause(self, SAMPLES_IN_PROGRESS)
 
         samples = Sample.search(clause + [
             ('fractions.services.urgent', '=', True),
@@ -101,191 +177,47 @@ class BoardGeneral(ModelSQL, ModelView):
         return records
 
     def get_samples_state(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-
-        clause = []
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
+        clause = get_samples_clause(self, SAMPLES_IN_PROGRESS)
+        quantities = defaultdict(int)
+        for _, state, _, quantity in count_samples(clause, 'report_date'):
+            quantities[state] += quantity
 
         records = []
-
         for state in SAMPLES_IN_PROGRESS:
             record = {
                 's': gettext('lims_board.msg_sample_state_%s' % state),
                 }
-            record['q'] = Sample.search_count(clause + [
-                ('state', '=', state),
-                ])
+            record['q'] = quantities[state]
             records.append(record)
 
         return records
 
     def get_samples_department(self):
         pool = Pool()
-        Sample = pool.get('lims.sample')
         Department = pool.get('company.department')
 
-        clause = [('state', 'in', SAMPLES_IN_PROGRESS)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
+        clause = get_samples_clause(self, SAMPLES_IN_PROGRESS)
+        quantities = defaultdict(int)
+        for department, _, _, quantity in count_samples(
+                clause, 'report_date'):
+            quantities[department] += quantity
 
         records = []
 
         departments = Department.search([], order=[('id', 'ASC')])
         for d in departments:
             record = {'d': d.name}
-            record['q'] = Sample.search_count(clause + [
-                ('department', '=', d.id),
-                ])
+            record['q'] = quantities[d.id]
             records.append(record)
 
         return records
 
     def get_samples_report_date(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-        Department = pool.get('company.department')
-        Date = pool.get('ir.date')
-
-        i = 0
-        dep = {None: ''}
-        departments = Department.search([], order=[('id', 'ASC')],
-            limit=DEPARTMENTS_LIMIT)
-        for d in departments:
-            i += 1
-            dep[d.id] = i
-
-        clause = [('state', 'in', SAMPLES_IN_PROGRESS)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
-        records = []
-        today = Date.today()
-
-        # < -4 d
-        report_date = today - relativedelta(days=4)
-        record = {'t': '< -4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '<=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -3 d
-        report_date = today - relativedelta(days=3)
-        record = {'t': '-3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -2 d
-        report_date = today - relativedelta(days=2)
-        record = {'t': '-2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -1 d
-        report_date = today - relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_yesterday')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # t
-        record = {'t': gettext('lims_board.msg_today')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', today),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +1 d
-        report_date = today + relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_tomorrow')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +2 d
-        report_date = today + relativedelta(days=2)
-        record = {'t': '+2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +3 d
-        report_date = today + relativedelta(days=3)
-        record = {'t': '+3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # > +4 d
-        report_date = today + relativedelta(days=4)
-        record = {'t': '> +4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ['OR',
-                    ('report_date', '=', None),
-                    ('report_date', '>=', report_date),
-                    ],
-                ('department', '=', d_id),
-                ])
-        records.append(record)
+        Date = Pool().get('ir.date')
 
-        return records
+        clause = get_samples_clause(self, SAMPLES_IN_PROGRESS)
+        return get_samples_date_records(
+            count_samples(clause, 'report_date'), Date.today())
 
 
 class BoardGeneralSampleState(ModelView):
@@ -495,19 +427,7 @@ class BoardLaboratory(ModelSQL, ModelView):
         pool = Pool()
         Sample = pool.get('lims.sample')
 
-        clause = [('state', 'in', SAMPLES_IN_LABORATORY)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
+        clause = get_samples_clause(self, SAMPLES_IN_LABORATORY)
 
         samples = Sample.search(clause + [
             ('fractions.services.urgent', '=', True),
@@ -522,129 +442,11 @@ class BoardLaboratory(ModelSQL, ModelView):
         return records
 
     def get_samples_laboratory_date(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-        Department = pool.get('company.department')
-        Date = pool.get('ir.date')
-
-        i = 0
-        dep = {None: ''}
-        departments = Department.search([], order=[('id', 'ASC')],
-            limit=DEPARTMENTS_LIMIT)
-        for d in departments:
-            i += 1
-            dep[d.id] = i
-
-        clause = [('state', 'in', SAMPLES_IN_LABORATORY)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
-        records = []
-        today = Date.today()
-
-        # < -4 d
-        laboratory_date = today - relativedelta(days=4)
-        record = {'t': '< -4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '<=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -3 d
-        laboratory_date = today - relativedelta(days=3)
-        record = {'t': '-3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
+        Date = Pool().get('ir.date')
 
-        # -2 d
-        laboratory_date = today - relativedelta(days=2)
-        record = {'t': '-2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -1 d
-        laboratory_date = today - relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_yesterday')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # t
-        record = {'t': gettext('lims_board.msg_today')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', today),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +1 d
-        laboratory_date = today + relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_tomorrow')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +2 d
-        laboratory_date = today + relativedelta(days=2)
-        record = {'t': '+2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +3 d
-        laboratory_date = today + relativedelta(days=3)
-        record = {'t': '+3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # > +4 d
-        laboratory_date = today + relativedelta(days=4)
-        record = {'t': '> +4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ['OR',
-                    ('laboratory_date', '=', None),
-                    ('laboratory_date', '>=', laboratory_date),
-                    ],
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        return records
+        clause = get_samples_clause(self, SAMPLES_IN_LABORATORY)
+        return get_samples_date_records(
+            count_samples(clause, 'laboratory_date'), Date.today())
 
 
 class BoardLaboratorySampleLaboratoryDate(ModelView):
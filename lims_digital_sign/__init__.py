@@ -10,6 +10,8 @@ def register():
     Pool.register(
         results_report.ResultsReportVersionDetail,
         results_report.ResultsReport,
+        results_report.ResultsReportSigning,
+        results_report.Cron,
         module='lims_digital_sign', type_='model')
     Pool.register(
         results_report.ResultsReportAnnulation,
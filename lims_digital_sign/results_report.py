@@ -5,12 +5,15 @@
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from trytond.model import ModelView, fields
+from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
+from trytond.pyson import Eval
 from trytond.config import config as tconfig
+from trytond.tools import grouped_slice
 from .tokenclient import GetToken
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
@@ -18,29 +21,47 @@ from trytond.i18n import gettext
 logger = logging.getLogger(__name__)
 
 
+def sign_document(listen, path, name, document):
+    '''
+    Sign a PDF document through the token service and return the signed
+    document. It does not use the database, so it can be run by workers
+    '''
+    t = time.strftime("%Y%m%d%H%M%S")
+    origin = ''.join(['origin', t, '_', name, '.pdf'])
+    target = ''.join(['target', t, '_', name, '.pdf'])
+
+    with open(os.path.join(path, origin), 'wb') as f:
+        f.write(document)
+
+    token = GetToken(listen, origin, target)
+    token.signDoc()
+
+    with open(os.path.join(path, target), 'rb') as f:
+        return f.read()
+
+
 class ResultsReportVersionDetail(metaclass=PoolMeta):
     __name__ = 'lims.results_report.version.detail'
 
     def unsign(self):
-        results_report = self.report_version.results_report
-        if results_report.signed:
-            results_report.signed = False
-            results_report.signed_date = None
-            results_report.save()
+        ResultsReport = Pool().get('lims.results_report')
+        ResultsReport.reset_signatures([self.report_version.results_report])
         return True
 
     @classmethod
     def do_release(cls, details):
+        ResultsReport = Pool().get('lims.results_report')
         super().do_release(details)
-        for detail in details:
-            detail.unsign()
+        ResultsReport.reset_signatures(list(set(
+            d.report_version.results_report for d in details)))
 
     @classmethod
     @ModelView.button
     def release_all_lang(cls, details):
+        ResultsReport = Pool().get('lims.results_report')
         super().release_all_lang(details)
-        for detail in details:
-            detail.unsign()
+        ResultsReport.reset_signatures(list(set(
+            d.report_version.results_report for d in details)))
 
 
 class ResultsReport(metaclass=PoolMeta):
@@ -48,6 +69,8 @@ class ResultsReport(metaclass=PoolMeta):
 
     signed = fields.Boolean('Signed', readonly=True)
     signed_date = fields.DateTime('Signed date', readonly=True)
+    signings = fields.One2Many('lims.results_report.signing',
+        'results_report', 'Signings', readonly=True)
 
     @classmethod
     def _get_modified_fields(cls):
@@ -59,35 +82,237 @@ class ResultsReport(metaclass=PoolMeta):
         return fields
 
     def build_report(self, language):
-        cache = super().build_report(language)
-        cache = self.sign_report(cache)
-        self.signed = True
-        self.signed_date = datetime.now()
-        self.save()
-        return cache
-
-    def sign_report(self, cache):
+        '''
+        Return the signed global report, or None while it is waiting to be
+        signed. Signing is done by the queue, see
+        ResultsReportSigning.cron_sign_reports
+        '''
+        Signing = Pool().get('lims.results_report.signing')
+
+        signings = Signing.search([
+            ('results_report', '=', self.id),
+            ('report_language', '=', language.id),
+            ], limit=1)
+        if not signings or signings[0].state == 'pending':
+            return None
+        if signings[0].state == 'failed':
+            raise UserError(gettext('lims_digital_sign.msg_sign_report_error',
+                    report=self.number))
+        return signings[0].report_cache
+
+    @classmethod
+    def reset_signatures(cls, reports):
+        '''
+        Discard the signatures of reports and queue the signing of their
+        current global reports
+        '''
+        pool = Pool()
+        Signing = pool.get('lims.results_report.signing')
+        Lang = pool.get('ir.lang')
+
+        signings = Signing.search([
+            ('results_report', 'in', [r.id for r in reports]),
+            ])
+        if signings:
+            Signing.delete(signings)
+        signed_reports = [r for r in reports if r.signed]
+        if signed_reports:
+            cls.write(signed_reports, {
+                'signed': False,
+                'signed_date': None,
+                })
+
+        languages = Lang.search([('translatable', '=', True)])
+        to_create = []
+        for report in reports:
+            for lang in languages:
+                if not report.has_report_cached(lang):
+                    continue
+                to_create.append({
+                    'results_report': report.id,
+                    'report_language': lang.id,
+                    })
+        if to_create:
+            Signing.create(to_create)
+
+
+class ResultsReportSigning(ModelSQL, ModelView):
+    'Results Report Signing'
+    __name__ = 'lims.results_report.signing'
+
+    results_report = fields.Many2One('lims.results_report', 'Results Report',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    report_language = fields.Many2One('ir.lang', 'Language', required=True,
+        readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Signed'),
+        ('failed', 'Failed'),
+        ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    error = fields.Text('Error', readonly=True)
+    signed_date = fields.DateTime('Signed date', readonly=True)
+    report_cache = fields.Binary('Signed report', readonly=True,
+        file_id='report_cache_id', store_prefix='results_report')
+    report_cache_id = fields.Char('Signed report id', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._buttons.update({
+            'retry': {
+                'invisible': Eval('state') != 'failed',
+                'depends': ['state'],
+                },
+            })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, signings):
+        cls.write(signings, {
+            'state': 'pending',
+            'attempts': 0,
+            'error': None,
+            })
+
+    @classmethod
+    def queue_reports(cls):
+        '''
+        Queue the signing of the cached global reports that have no signing
+        (e.g. released before signing was queued)
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        CachedReport = pool.get('lims.results_report.cached_report')
+        ResultsDetail = pool.get('lims.results_report.version.detail')
+        ResultsVersion = pool.get('lims.results_report.version')
+        Lang = pool.get('ir.lang')
+
+        languages = Lang.search([('translatable', '=', True)])
+        if not languages:
+            return
+        cursor.execute('SELECT DISTINCT rv.results_report, '
+                'cr.report_language '
+            'FROM "' + CachedReport._table + '" cr '
+                'INNER JOIN "' + ResultsDetail._table + '" rd '
+                'ON cr.version_detail = rd.id '
+                'INNER JOIN "' + ResultsVersion._table + '" rv '
+                'ON rd.report_version = rv.id '
+            'WHERE rd.valid = TRUE '
+                'AND cr.report_format = \'pdf\' '
+                'AND cr.report_language = ANY(%s) '
+                'AND NOT EXISTS ('
+                    'SELECT 1 FROM "' + cls._table + '" s '
+                    'WHERE s.results_report = rv.results_report '
+                        'AND s.report_language = cr.report_language)',
+            ([l.id for l in languages],))
+        to_create = [{
+                'results_report': report_id,
+                'report_language': language_id,
+                } for report_id, language_id in cursor.fetchall()]
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def cron_sign_reports(cls):
+        '''
+        Cron - Sign Results Reports
+        '''
+        logger.info('Cron - Sign Results Reports: INIT')
+        batch_size = tconfig.getint('token', 'batch_size', default=10)
+
+        cls.queue_reports()
+        Transaction().commit()
+
+        signings = cls.search([('state', '=', 'pending')],
+            order=[('id', 'ASC')])
+        for sub_signings in grouped_slice(signings, batch_size):
+            cls.sign(list(sub_signings))
+            Transaction().commit()
+
+        logger.info('Cron - Sign Results Reports: END')
+        return True
+
+    @classmethod
+    def sign(cls, signings):
+        '''
+        Sign the global reports of signings. The documents are sent to the
+        token service by a pool of workers, limited by the concurrency
+        option of the [token] section of the configuration
+        '''
+        pool = Pool()
+        ResultsReport = pool.get('lims.results_report')
+
         listen = tconfig.get('token', 'listen')
         path = tconfig.get('token', 'path')
+        concurrency = tconfig.getint('token', 'concurrency', default=2)
+        retries = tconfig.getint('token', 'retries', default=3)
 
-        t = time.strftime("%Y%m%d%H%M%S")
-        origin = ''.join(['origin', t, '.pdf'])
-        target = ''.join(['target', t, '.pdf'])
+        results = {}
+        documents = {}
+        for signing in signings:
+            try:
+                documents[signing.id] = (
+                    signing.results_report.get_global_report(
+                        signing.report_language))
+            except UserError as e:
+                results[signing.id] = (None, str(e))
 
-        try:
-            with open(os.path.join(path, origin), 'wb') as f:
-                f.write(cache)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = dict((signing_id, executor.submit(sign_document,
+                        listen, path, str(signing_id), document))
+                for signing_id, document in documents.items())
+            for signing_id, future in futures.items():
+                try:
+                    results[signing_id] = (future.result(), None)
+                except Exception as e:
+                    results[signing_id] = (None, str(e))
 
-            token = GetToken(listen, origin, target)
-            token.signDoc()
+        now = datetime.now()
+        to_write = []
+        for signing in signings:
+            signed_document, error = results[signing.id]
+            attempts = signing.attempts + 1
+            if signed_document:
+                to_write.extend(([signing], {
+                    'state': 'done',
+                    'attempts': attempts,
+                    'error': None,
+                    'signed_date': now,
+                    'report_cache': signed_document,
+                    }))
+                continue
+            logger.error('Sign Results Report: %s: %s',
+                signing.results_report.number, error)
+            to_write.extend(([signing], {
+                'state': 'failed' if attempts >= retries else 'pending',
+                'attempts': attempts,
+                'error': error,
+                }))
+        if to_write:
+            cls.write(*to_write)
 
-            with open(os.path.join(path, target), 'rb') as f:
-                f_target = f.read()
-            return f_target
-        except Exception as e:
-            logger.error(str(e))
-            raise UserError(gettext('lims_digital_sign.msg_sign_report_error',
-                    report=self.number))
+        report_ids = list(set(s.results_report.id for s in signings))
+        unsigned_ids = set(s.results_report.id for s in cls.search([
+            ('results_report', 'in', report_ids),
+            ('state', '!=', 'done'),
+            ]))
+        signed_reports = ResultsReport.browse(
+            [i for i in report_ids if i not in unsigned_ids])
+        if signed_reports:
+            ResultsReport.write(signed_reports, {
+                'signed': True,
+                'signed_date': now,
+                })
 
 
 class ResultsReportAnnulation(metaclass=PoolMeta):
@@ -95,12 +320,27 @@ class ResultsReportAnnulation(metaclass=PoolMeta):
 
     def transition_annul(self):
         super().transition_annul()
-        ResultsDetail = Pool().get('lims.results_report.version.detail')
+        pool = Pool()
+        ResultsDetail = pool.get('lims.results_report.version.detail')
+        ResultsReport = pool.get('lims.results_report')
 
         details_annulled = ResultsDetail.search([
             ('id', 'in', Transaction().context['active_ids']),
             ('state', '=', 'annulled'),
             ])
-        for detail in details_annulled:
-            detail.unsign()
+        if details_annulled:
+            ResultsReport.reset_signatures(list(set(
+                d.report_version.results_report for d in details_annulled)))
         return 'end'
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('lims.results_report.signing|cron_sign_reports',
+                    "Sign Results Reports"),
+                ])
@@ -1,16 +1,211 @@
 # This file is part of lims_digital_sign module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest.mock import patch
+from xmlrpc.server import SimpleXMLRPCServer
 
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+class TokenServer(object):
+    'Stub of the token service, it signs the documents that do not fail'
+
+    def __init__(self, path):
+        self.path = path
+        self.fail = set()
+        self.server = SimpleXMLRPCServer(('127.0.0.1', 0),
+            logRequests=False, allow_none=True)
+        self.server.register_function(self.signDoc, 'signDoc')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+
+    @property
+    def listen(self):
+        return '%s:%s' % self.server.server_address
+
+    def signDoc(self, data):
+        data = json.loads(data)
+        with open(os.path.join(self.path, data['origin']), 'rb') as f:
+            document = f.read()
+        if document in self.fail:
+            raise ValueError('Unable to sign')
+        with open(os.path.join(self.path, data['target']), 'wb') as f:
+            f.write(b'signed ' + document)
+        return True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
 
 
 class LimsTestCase(ModuleTestCase):
     'Test lims_digital_sign module'
     module = 'lims_digital_sign'
 
+    def setUp(self):
+        super().setUp()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.token_server = TokenServer(path)
+        self.token_server.start()
+        self.addCleanup(self.token_server.stop)
+
+        if not config.has_section('token'):
+            config.add_section('token')
+            self.addCleanup(config.remove_section, 'token')
+        for option, value in [
+                ('listen', self.token_server.listen),
+                ('path', path),
+                ('retries', '2'),
+                ('batch_size', '1'),
+                ]:
+            config.set('token', option, value)
+
+    @with_transaction()
+    def test_sign_reports(self):
+        'Test signing of results reports'
+        pool = Pool()
+        ResultsReport = pool.get('lims.results_report')
+        Signing = pool.get('lims.results_report.signing')
+        Lang = pool.get('ir.lang')
+        cursor = Transaction().connection.cursor()
+
+        lang, = Lang.search([('code', '=', 'en')])
+        table = ResultsReport.__table__()
+        cursor.execute(*table.insert([table.number, table.report_language],
+                [['R1', lang.id], ['R2', lang.id]],
+                returning=[table.id]))
+        report1, report2 = ResultsReport.browse(
+            sorted(x[0] for x in cursor))
+        signing1, signing2 = Signing.create([{
+                    'results_report': r.id,
+                    'report_language': lang.id,
+                    } for r in (report1, report2)])
+        self.token_server.fail.add(b'R2')
+
+        with patch.object(ResultsReport, 'get_global_report',
+                lambda self, language: self.number.encode()):
+            # pending -> done and pending -> pending
+            Signing.sign([signing1, signing2])
+            self.assertEqual((signing1.state, signing1.attempts,
+                    signing1.report_cache), ('done', 1, b'signed R1'))
+            self.assertIsNone(signing1.error)
+            self.assertEqual((signing2.state, signing2.attempts),
+                ('pending', 1))
+            self.assertTrue(signing2.error)
+            self.assertTrue(report1.signed)
+            self.assertFalse(report2.signed)
+            self.assertEqual(report1.build_report(lang), b'signed R1')
+            self.assertIsNone(report2.build_report(lang))
+
+            # pending -> failed after the retries
+            Signing.cron_sign_reports()
+            self.assertEqual((signing2.state, signing2.attempts),
+                ('failed', 2))
+            with self.assertRaises(UserError):
+                report2.build_report(lang)
+
+            # failed -> pending -> done
+            self.token_server.fail.clear()
+            Signing.retry([signing2])
+            self.assertEqual((signing2.state, signing2.attempts),
+                ('pending', 0))
+            Signing.cron_sign_reports()
+            self.assertEqual((signing2.state, signing2.attempts,
+                    signing2.report_cache), ('done', 1, b'signed R2'))
+            self.assertTrue(report2.signed)
+
+            # The signatures are reset when the reports change
+            ResultsReport.reset_signatures([report1])
+            self.assertFalse(report1.signed)
+            self.assertFalse(Signing.search([
+                        ('results_report', '=', report1.id),
+                        ]))
+            self.assertIsNone(report1.build_report(lang))
+
+    @with_transaction()
+    def test_queue_reports(self):
+        'Test queue of the reports without signing'
+        pool = Pool()
+        Party = pool.get('party.party')
+        LaboratoryProfessional = pool.get('lims.laboratory.professional')
+        Location = pool.get('stock.location')
+        Laboratory = pool.get('lims.laboratory')
+        ResultsReport = pool.get('lims.results_report')
+        ResultsVersion = pool.get('lims.results_report.version')
+        ResultsDetail = pool.get('lims.results_report.version.detail')
+        CachedReport = pool.get('lims.results_report.cached_report')
+        Signing = pool.get('lims.results_report.signing')
+        Lang = pool.get('ir.lang')
+        cursor = Transaction().connection.cursor()
+
+        lang, = Lang.search([('code', '=', 'en')])
+        lang.translatable = True
+        lang.save()
+
+        table = ResultsReport.__table__()
+        cursor.execute(*table.insert([table.number, table.report_language],
+                [['R1', lang.id], ['R2', lang.id], ['R3', lang.id]],
+                returning=[table.id]))
+        report_ids = sorted(x[0] for x in cursor)
+        party, = Party.create([{
+                    'name': 'Laboratory Professional',
+                    'is_lab_professional': True,
+                    'lims_user': Transaction().user,
+                    }])
+        professional, = LaboratoryProfessional.create([{
+                    'party': party.id,
+                    'code': 'LP',
+                    }])
+        location, = Location.search([('code', '=', 'STO')])
+        laboratory, = Laboratory.create([{
+                    'code': 'SQ',
+                    'description': 'Laboratory',
+                    'default_signer': professional.id,
+                    'related_location': location.id,
+                    'section': 'sq',
+                    }])
+        table = ResultsVersion.__table__()
+        cursor.execute(*table.insert([table.results_report,
+                    table.laboratory],
+                [[i, laboratory.id] for i in report_ids],
+                returning=[table.id]))
+        version_ids = sorted(x[0] for x in cursor)
+        table = ResultsDetail.__table__()
+        cursor.execute(*table.insert([table.report_version, table.valid],
+                [[version_ids[0], True], [version_ids[1], True],
+                    [version_ids[2], False]],
+                returning=[table.id]))
+        detail_ids = sorted(x[0] for x in cursor)
+        table = CachedReport.__table__()
+        cursor.execute(*table.insert([table.version_detail,
+                    table.report_language, table.report_format],
+                [[i, lang.id, 'pdf'] for i in detail_ids]))
+        Signing.create([{
+                    'results_report': report_ids[1],
+                    'report_language': lang.id,
+                    'state': 'failed',
+                    }])
+
+        Signing.queue_reports()
+        self.assertEqual(sorted((s.results_report.id, s.state)
+                for s in Signing.search([])),
+            [(report_ids[0], 'pending'), (report_ids[1], 'failed')])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -2,6 +2,9 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import logging
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from email import encoders
 from email.mime.base import MIMEBase
@@ -13,7 +16,7 @@ from trytond.model import ModelSQL, ModelView, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
-from trytond.tools import get_smtp_server
+from trytond.tools import get_smtp_server, grouped_slice
 from trytond.config import config as tconfig
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
@@ -21,6 +24,98 @@ from trytond.i18n import gettext
 logger = logging.getLogger(__name__)
 
 
+class SMTPDelivery(object):
+    '''
+    Deliver messages over a reused SMTP connection, limiting the sending
+    rate and retrying failed deliveries with an exponential backoff.
+    It is configured in the [lims_email] section of the server
+    configuration: smtp_rate (messages per second, 0 for no limit),
+    smtp_retries and smtp_retry_delay (seconds)
+    '''
+
+    def __init__(self, rate=None, retries=None, retry_delay=None):
+        if rate is None:
+            rate = tconfig.getfloat('lims_email', 'smtp_rate', default=0)
+        if retries is None:
+            retries = tconfig.getint('lims_email', 'smtp_retries',
+                default=3)
+        if retry_delay is None:
+            retry_delay = tconfig.getfloat('lims_email', 'smtp_retry_delay',
+                default=2)
+        self.rate = rate
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.server = None
+        self.last_sent = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _connect(self):
+        if self.server is None:
+            self.server = get_smtp_server()
+        return self.server
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+    def _wait(self):
+        if not self.rate or self.last_sent is None:
+            return
+        delay = self.last_sent + 1.0 / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                server = self._connect()
+                self._wait()
+                server.sendmail(from_addr, to_addrs, msg)
+                self.last_sent = time.monotonic()
+                return
+            except smtplib.SMTPRecipientsRefused:
+                raise
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code >= 500 or attempt == self.retries:
+                    raise
+                logger.warning('SMTP delivery failed (%s), retrying',
+                    e.smtp_code)
+                self.close()
+            except OSError as e:
+                # Connection errors, including SMTPServerDisconnected
+                if attempt == self.retries:
+                    raise
+                logger.warning('SMTP delivery failed (%s), retrying', e)
+                self.close()
+
+
+def _build_reports(database_name, user, context, report_ids, language_ids):
+    '''
+    Build the global reports in a new transaction, to be run by the
+    workers of SendResultsReport.build_reports
+    '''
+    with Transaction().start(database_name, user, context=context):
+        pool = Pool()
+        ResultsReport = pool.get('lims.results_report')
+        Lang = pool.get('ir.lang')
+
+        languages = Lang.browse(language_ids)
+        return dict((r.id, r.build_reports_cache(languages))
+            for r in ResultsReport.browse(report_ids))
+
+
 class ResultsReportVersionDetail(metaclass=PoolMeta):
     __name__ = 'lims.results_report.version.detail'
 
@@ -87,42 +182,86 @@ class ResultsReport(metaclass=PoolMeta):
             type='wizard')
 
         results_reports = cls.search([('sent', '=', False)])
+        render_workers = tconfig.getint('lims_email', 'render_workers',
+            default=4)
 
         session_id, _, _ = SendResultsReport.create()
         send_results_report = SendResultsReport(session_id)
         with Transaction().set_context(active_ids=[results_report.id
-                for results_report in results_reports]):
+                for results_report in results_reports],
+                render_workers=render_workers):
             send_results_report.transition_send()
 
         logger.info('Cron - Send Results Report: END')
         return True
 
+    def build_reports_cache(self, languages):
+        '''
+        Return a dict with the global report of each language that has
+        cached reports, None for the languages that failed to build and
+        False for the ones that are not ready yet (e.g. waiting to be
+        digitally signed)
+        '''
+        report_cache = {}
+        for lang in languages:
+            if not self.has_report_cached(lang):
+                continue
+            report_cache[lang.id] = None
+
+            try:
+                report_cache[lang.id] = self.build_report(lang)
+            except Exception:
+                break
+            if report_cache[lang.id] is None:
+                report_cache[lang.id] = False
+                break
+        return report_cache
+
     def attach_report(self, report_cache, language):
         '''
         Attach Report file from provided cache
         '''
+        self.attach_reports([(self, report_cache, language)])
+
+    @classmethod
+    def attach_reports(cls, reports_caches):
+        '''
+        Attach Report files from a list of (report, cache, language)
+        '''
         pool = Pool()
         Attachment = pool.get('ir.attachment')
 
-        name = '%s_%s.pdf' % ('informe-global-de-resultados', language.code)
-        data = report_cache
-        resource = '%s,%s' % (self.__name__, self.id)
-
-        values = {
-            'name': name,
-            'type': 'data',
-            'data': data,
-            'resource': '%s,%s' % (self.__name__, self.id),
-            }
-
-        attachment = Attachment.search([
-            ('resource', '=', resource),
-            ('name', '=', name),
+        to_attach = {}
+        for report, report_cache, language in reports_caches:
+            name = '%s_%s.pdf' % ('informe-global-de-resultados',
+                language.code)
+            resource = '%s,%s' % (cls.__name__, report.id)
+            to_attach[(resource, name)] = {
+                'name': name,
+                'type': 'data',
+                'data': report_cache,
+                'resource': resource,
+                }
+        if not to_attach:
+            return
+
+        existing = {}
+        attachments = Attachment.search([
+            ('resource', 'in', list(set(k[0] for k in to_attach))),
+            ('name', 'in', list(set(k[1] for k in to_attach))),
             ])
-        if attachment:
-            Attachment.write(attachment, values)
-        else:
-            Attachment.create([values])
+        for attachment in attachments:
+            key = (str(attachment.resource), attachment.name)
+            if key in to_attach:
+                existing.setdefault(key, []).append(attachment)
+
+        to_write = []
+        for key, attachments in existing.items():
+            to_write.extend((attachments, to_attach.pop(key)))
+        if to_write:
+            Attachment.write(*to_write)
+        if to_attach:
+            Attachment.create(list(to_attach.values()))
 
     def clean_attached_reports(self):
         '''
@@ -361,110 +500,172 @@ class SendResultsReport(Wizard):
             logger.info('Send Results Report: '
                 'Processing context Results Reports')
 
+        languages = Lang.search([('translatable', '=', True)])
+        render_workers = context.get('render_workers') or 1
+
         reports_not_ready = []
         reports_not_sent = []
-        for group in self.get_grouped_reports(active_ids).values():
-            group['reports_ready'] = []
-            group['to_addrs'] = {}
-            group['attachments_data'] = []
-
-            for report in group['reports']:
-                logger.info('Send Results Report: %s', report.number)
+        groups = list(self.get_grouped_reports(active_ids).values())
+        with SMTPDelivery() as delivery:
+            for sub_groups in grouped_slice(groups, render_workers * 10):
+                sub_groups = list(sub_groups)
+                to_build = []
+                for group in sub_groups:
+                    group['reports_to_build'] = []
+                    for report in group['reports']:
+                        logger.info('Send Results Report: %s', report.number)
+
+                        if (report.single_sending_report and not
+                                report.single_sending_report_ready):
+                            logger.warning('Send Results Report: %s: '
+                                'IGNORED: NOT READY TO SINGLE SENDING',
+                                report.number)
+                            continue
+
+                        if (report.entry_single_sending_report and not
+                                report.entry_single_sending_report_ready):
+                            logger.warning('Send Results Report: %s: '
+                                'IGNORED: NOT READY TO SINGLE SENDING',
+                                report.number)
+                            continue
+                        group['reports_to_build'].append(report)
+                    to_build.extend(group['reports_to_build'])
+
+                reports_cache = self.build_reports(to_build, languages)
+
+                for group in sub_groups:
+                    self._send_group(group, reports_cache, from_addr,
+                        hide_recipients, email_qa, delivery,
+                        reports_not_ready, reports_not_sent)
 
-                if (report.single_sending_report and not
-                        report.single_sending_report_ready):
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: NOT READY TO SINGLE SENDING',
-                        report.number)
-                    continue
+        if reports_not_ready or reports_not_sent:
+            logger.warning('Send Results Report: FAILED')
+            self.failed.reports_not_ready = reports_not_ready
+            self.failed.reports_not_sent = reports_not_sent
+            return 'failed'
 
-                if (report.entry_single_sending_report and not
-                        report.entry_single_sending_report_ready):
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: NOT READY TO SINGLE SENDING',
-                        report.number)
-                    continue
+        logger.info('Send Results Report: SUCCEED')
+        return 'succeed'
 
-                report_cache = {}
-                for lang in Lang.search([('translatable', '=', True)]):
-                    if not report.has_report_cached(lang):
-                        continue
-                    report_cache[lang] = None
-
-                    try:
-                        report_cache[lang] = report.build_report(lang)
-                    except Exception as e:
-                        break
-
-                if not report_cache:
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: HAS NO CACHED REPORTS',
-                        report.number)
-                    continue
+    def _send_group(self, group, reports_cache, from_addr, hide_recipients,
+            email_qa, delivery, reports_not_ready, reports_not_sent):
+        pool = Pool()
+        ResultsReport = pool.get('lims.results_report')
+        Lang = pool.get('ir.lang')
 
-                if None in report_cache.values():
-                    reports_not_ready.append(report)
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: GLOBAL REPORT BUILD FAILED',
-                        report.number)
-                    continue
+        group['reports_ready'] = []
+        group['to_addrs'] = {}
+        group['attachments_data'] = []
 
-                logger.info('Send Results Report: %s: Build',
+        to_attach = []
+        for report in group['reports_to_build']:
+            report_cache = reports_cache.get(report.id, {None: None})
+            if not report_cache:
+                logger.warning('Send Results Report: %s: '
+                    'IGNORED: HAS NO CACHED REPORTS',
                     report.number)
-                group['reports_ready'].append(report)
-
-                for lang, cache in report_cache.items():
-                    report.attach_report(cache, lang)
-                    logger.info('Send Results Report: %s: Attached (%s)' % (
-                        report.number, lang.name))
-                    group['attachments_data'].append(
-                        report.get_attached_report(cache, lang))
-
-                if group['cie_fraction_type']:
-                    group['to_addrs'][email_qa] = 'QA'
-                else:
-                    group['to_addrs'].update(self.get_report_addrs(
-                        report))
+                continue
 
-            if not group['reports_ready']:
+            if False in report_cache.values():
+                reports_not_ready.append(report)
+                logger.info('Send Results Report: %s: '
+                    'IGNORED: GLOBAL REPORT NOT READY YET',
+                    report.number)
                 continue
 
-            # Email sending
-            to_addrs = list(group['to_addrs'].keys())
-            if not to_addrs:
-                reports_not_sent.extend(group['reports_ready'])
-                logger.warning('Send Results Report: Missing addresses')
+            if None in report_cache.values():
+                reports_not_ready.append(report)
+                logger.warning('Send Results Report: %s: '
+                    'IGNORED: GLOBAL REPORT BUILD FAILED',
+                    report.number)
                 continue
-            logger.info('Send Results Report: To addresses: %s',
-                ', '.join(to_addrs))
 
-            subject, body = self._get_subject_body(group['reports_ready'])
+            logger.info('Send Results Report: %s: Build',
+                report.number)
+            group['reports_ready'].append(report)
 
-            msg = self._create_msg(from_addr, to_addrs, subject,
-                body, hide_recipients, group['attachments_data'])
-            sent = self._send_msg(from_addr, to_addrs, msg)
-            if not sent:
-                reports_not_sent.extend(group['reports_ready'])
-                logger.warning('Send Results Report: Not sent')
-                continue
-            logger.info('Send Results Report: Sent')
+            for lang_id, cache in report_cache.items():
+                lang = Lang(lang_id)
+                to_attach.append((report, cache, lang))
+                group['attachments_data'].append(
+                    report.get_attached_report(cache, lang))
 
-            addresses = ', '.join(['"%s" <%s>' % (v, k)
-                    for k, v in group['to_addrs'].items()])
-            ResultsReport.write(group['reports_ready'], {
-                'sent': True, 'sent_date': datetime.now(),
-                'mailings': [('create', [{'addresses': addresses}])],
-                })
-            Transaction().commit()
+            if group['cie_fraction_type']:
+                group['to_addrs'][email_qa] = 'QA'
+            else:
+                group['to_addrs'].update(self.get_report_addrs(
+                    report))
 
-        if reports_not_ready or reports_not_sent:
-            logger.warning('Send Results Report: FAILED')
-            self.failed.reports_not_ready = reports_not_ready
-            self.failed.reports_not_sent = reports_not_sent
-            return 'failed'
+        if not group['reports_ready']:
+            return
 
-        logger.info('Send Results Report: SUCCEED')
-        return 'succeed'
+        ResultsReport.attach_reports(to_attach)
+        for report, cache, lang in to_attach:
+            logger.info('Send Results Report: %s: Attached (%s)' % (
+                report.number, lang.name))
+
+        # Email sending
+        to_addrs = list(group['to_addrs'].keys())
+        if not to_addrs:
+            reports_not_sent.extend(group['reports_ready'])
+            logger.warning('Send Results Report: Missing addresses')
+            return
+        logger.info('Send Results Report: To addresses: %s',
+            ', '.join(to_addrs))
+
+        subject, body = self._get_subject_body(group['reports_ready'])
+
+        msg = self._create_msg(from_addr, to_addrs, subject,
+            body, hide_recipients, group['attachments_data'])
+        sent = self._send_msg(from_addr, to_addrs, msg, delivery)
+        if not sent:
+            reports_not_sent.extend(group['reports_ready'])
+            logger.warning('Send Results Report: Not sent')
+            return
+        logger.info('Send Results Report: Sent')
+
+        addresses = ', '.join(['"%s" <%s>' % (v, k)
+                for k, v in group['to_addrs'].items()])
+        ResultsReport.write(group['reports_ready'], {
+            'sent': True, 'sent_date': datetime.now(),
+            'mailings': [('create', [{'addresses': addresses}])],
+            })
+        Transaction().commit()
+
+    def build_reports(self, reports, languages):
+        '''
+        Return a dict with the global reports of each report by language.
+        When the render_workers context key is greater than 1 (as set by
+        the cron), the reports are built by a pool of workers, each one in
+        its own transaction
+        '''
+        transaction = Transaction()
+        workers = transaction.context.get('render_workers') or 1
+        if workers <= 1 or len(reports) <= 1:
+            return dict((r.id, r.build_reports_cache(languages))
+                for r in reports)
+
+        # The workers must see the data committed so far
+        transaction.commit()
+        database_name = transaction.database.name
+        context = dict(transaction.context)
+        language_ids = [l.id for l in languages]
+        report_ids = [r.id for r in reports]
+        size = -(-len(report_ids) // workers)
+
+        res = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_build_reports, database_name,
+                    transaction.user, context, list(sub_ids), language_ids)
+                for sub_ids in grouped_slice(report_ids, size)]
+            for future in futures:
+                try:
+                    res.update(future.result())
+                except Exception as e:
+                    logger.error('Send Results Report: '
+                        'Unable to build reports')
+                    logger.error(str(e))
+        return res
 
     def get_grouped_reports(self, report_ids):
         pool = Pool()
@@ -605,13 +806,15 @@ class SendResultsReport(Wizard):
             msg.attach(attachment)
         return msg
 
-    def _send_msg(self, from_addr, to_addrs, msg):
+    def _send_msg(self, from_addr, to_addrs, msg, delivery=None):
         to_addrs = list(set(to_addrs))
         success = False
         try:
-            server = get_smtp_server()
-            server.sendmail(from_addr, to_addrs, msg.as_string())
-            server.quit()
+            if delivery:
+                delivery.sendmail(from_addr, to_addrs, msg.as_string())
+            else:
+                with SMTPDelivery() as delivery:
+                    delivery.sendmail(from_addr, to_addrs, msg.as_string())
             success = True
         except Exception as e:
             logger.error('Send Results Report: Unable to deliver mail')
@@ -1,16 +1,142 @@
 # This file is part of lims_email module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import smtplib
+import threading
 import unittest
+import warnings
+from unittest.mock import patch
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    import asyncore
+    import smtpd
 
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.config import config
+from trytond.pool import Pool
+
+from trytond.modules.lims_email.results_report import SMTPDelivery
+
+
+class SMTPServer(smtpd.SMTPServer):
+    '''
+    Debugging SMTP server that keeps the received messages and counts the
+    connections. The replies of the next messages can be set in errors
+    '''
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), None, decode_data=False)
+        self.messages = []
+        self.connections = 0
+        self.errors = []
+        self.thread = threading.Thread(target=asyncore.loop,
+            kwargs={'timeout': 0.1, 'map': self._map})
+
+    @property
+    def uri(self):
+        return 'smtp://%s:%s' % self.socket.getsockname()
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        super().handle_accepted(conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        if self.errors:
+            return self.errors.pop(0)
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.close()
+        for channel in list(self._map.values()):
+            channel.close()
+        self.thread.join()
 
 
 class LimsTestCase(ModuleTestCase):
     'Test lims_email module'
     module = 'lims_email'
 
+    def setUp(self):
+        super().setUp()
+        self.smtp_server = SMTPServer()
+        self.smtp_server.start()
+        self.addCleanup(self.smtp_server.stop)
+
+        uri = config.get('email', 'uri')
+        config.set('email', 'uri', self.smtp_server.uri)
+        self.addCleanup(config.set, 'email', 'uri', uri)
+
+    def send(self, delivery, count):
+        for i in range(count):
+            delivery.sendmail('lims@example.com', ['customer@example.com'],
+                'Subject: Report %s\n\nResults report' % i)
+
+    def test_smtp_delivery_connection(self):
+        'Test SMTP delivery reuses the connection'
+        with SMTPDelivery(retries=0) as delivery:
+            self.send(delivery, 3)
+        self.assertEqual(len(self.smtp_server.messages), 3)
+        self.assertEqual(self.smtp_server.connections, 1)
+
+    def test_smtp_delivery_retry(self):
+        'Test SMTP delivery retries temporary errors with backoff'
+        self.smtp_server.errors = [
+            '451 Try again later', '421 Service not available']
+        with patch('time.sleep') as sleep, \
+                SMTPDelivery(retries=2, retry_delay=1) as delivery:
+            self.send(delivery, 1)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 2])
+        self.assertEqual(len(self.smtp_server.messages), 1)
+        # The connection is opened again after each failure
+        self.assertEqual(self.smtp_server.connections, 3)
+
+    def test_smtp_delivery_retries_exhausted(self):
+        'Test SMTP delivery raises after the retries'
+        self.smtp_server.errors = ['451 Try again later'] * 3
+        with patch('time.sleep') as sleep, \
+                SMTPDelivery(retries=2, retry_delay=1) as delivery:
+            with self.assertRaises(smtplib.SMTPDataError):
+                self.send(delivery, 1)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertFalse(self.smtp_server.messages)
+
+    def test_smtp_delivery_permanent_error(self):
+        'Test SMTP delivery does not retry permanent errors'
+        self.smtp_server.errors = ['554 Transaction failed']
+        with patch('time.sleep') as sleep, \
+                SMTPDelivery(retries=2, retry_delay=1) as delivery:
+            with self.assertRaises(smtplib.SMTPDataError):
+                self.send(delivery, 1)
+            self.send(delivery, 1)
+        sleep.assert_not_called()
+        self.assertEqual(len(self.smtp_server.messages), 1)
+
+    @with_transaction()
+    def test_build_reports_cache(self):
+        'Test global reports not ready are told apart from failed ones'
+        pool = Pool()
+        ResultsReport = pool.get('lims.results_report')
+        Lang = pool.get('ir.lang')
+
+        lang, = Lang.search([('code', '=', 'en')])
+        report = ResultsReport()
+        with patch.object(ResultsReport, 'has_report_cached',
+                return_value=True):
+            for build_report, cache in [
+                    (lambda language: b'report', b'report'),
+                    (lambda language: None, False),
+                    (ValueError, None),
+                    ]:
+                with patch.object(ResultsReport, 'build_report',
+                        side_effect=build_report):
+                    self.assertEqual(report.build_reports_cache([lang]),
+                        {lang.id: cache})
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -670,15 +670,21 @@ class ResultsReportVersionDetailSample(metaclass=PoolMeta):
     @classmethod
     def create(cls, vlist):
         samples = super().create(vlist)
+        default_precedents = cls.get_samples_default_precedents(
+            [s for s in samples if not s.precedent1])
+        to_write = []
+        to_update = []
         for sample in samples:
-            if not sample.precedent1:
-                precedents = cls.get_default_precedents(sample)
-                if not precedents:
-                    continue
-                for i in range(0, min(3, len(precedents))):
-                    setattr(sample, 'precedent%s' % str(i + 1), precedents[i])
-                sample.save()
-                cls.update_precedent_lines(sample)
+            precedents = default_precedents.get(sample.id)
+            if not precedents:
+                continue
+            to_write.extend(([sample], dict(
+                ('precedent%s' % str(i + 1), precedent.id)
+                for i, precedent in enumerate(precedents))))
+            to_update.append(sample)
+        if to_write:
+            cls.write(*to_write)
+            cls.update_samples_precedent_lines(to_update)
         return samples
 
     @classmethod
@@ -699,56 +705,122 @@ class ResultsReportVersionDetailSample(metaclass=PoolMeta):
                 for sample in samples:
                     cls.update_precedent_lines(sample)
 
-    @staticmethod
-    def get_default_precedents(sample):
+    @classmethod
+    def get_default_precedents(cls, sample):
+        return cls.get_samples_default_precedents([sample]).get(sample.id, [])
+
+    @classmethod
+    def get_samples_default_precedents(cls, samples, limit=3):
+        '''
+        Return the last notebooks of the same component and invoice party
+        of each sample, resolved for all the samples in a single query
+        '''
+        cursor = Transaction().connection.cursor()
         pool = Pool()
         Notebook = pool.get('lims.notebook')
-        if not sample.component:
-            return []
-        precedents = Notebook.search([
-            ('id', '!=', sample.notebook.id),
-            ('component', '=', sample.component),
-            ('fraction.sample.state', '!=', 'annulled'),
-            ('invoice_party', '=', sample.notebook.invoice_party),
-            ], order=[
-            ('fraction.sample.number', 'DESC'),
-            ], limit=3)
-        return precedents
+        Fraction = pool.get('lims.fraction')
+        Sample = pool.get('lims.sample')
+        Entry = pool.get('lims.entry')
+
+        samples = [s for s in samples if s.component]
+        if not samples:
+            return {}
+
+        # Each sample excludes its own notebook, so one extra notebook
+        # per component and invoice party is enough
+        cursor.execute('SELECT id, component, invoice_party '
+            'FROM ('
+                'SELECT n.id, s.component, e.invoice_party, '
+                    'ROW_NUMBER() OVER ('
+                        'PARTITION BY s.component, e.invoice_party '
+                        'ORDER BY s.number DESC, n.id DESC) '
+                    'AS precedent_order '
+                'FROM "' + Notebook._table + '" n '
+                    'INNER JOIN "' + Fraction._table + '" f '
+                    'ON f.id = n.fraction '
+                    'INNER JOIN "' + Sample._table + '" s '
+                    'ON s.id = f.sample '
+                    'INNER JOIN "' + Entry._table + '" e '
+                    'ON e.id = s.entry '
+                'WHERE s.component IN %s '
+                    'AND s.state != \'annulled\''
+            ') p '
+            'WHERE precedent_order <= %s '
+            'ORDER BY precedent_order ASC',
+            (tuple(set(s.component.id for s in samples)), limit + 1))
+        notebooks = {}
+        for notebook_id, component_id, invoice_party_id in cursor.fetchall():
+            notebooks.setdefault((component_id, invoice_party_id),
+                []).append(notebook_id)
+
+        result = {}
+        for sample in samples:
+            invoice_party = sample.notebook.invoice_party
+            key = (sample.component.id,
+                invoice_party.id if invoice_party else None)
+            result[sample.id] = Notebook.browse([n
+                for n in notebooks.get(key, [])
+                if n != sample.notebook.id][:limit])
+        return result
 
     @classmethod
     def update_precedent_lines(cls, sample):
+        cls.update_samples_precedent_lines([sample])
+
+    @classmethod
+    def update_samples_precedent_lines(cls, samples):
+        cursor = Transaction().connection.cursor()
         pool = Pool()
         ResultsLine = pool.get('lims.results_report.version.detail.line')
         NotebookLine = pool.get('lims.notebook.line')
 
         precedent_lines = ResultsLine.search([
-            ('detail_sample', '=', sample.id),
+            ('detail_sample', 'in', [s.id for s in samples]),
             ('notebook_line', '=', None),
             ])
         if precedent_lines:
             ResultsLine.delete(precedent_lines)
 
+        analysis = dict((s.id, []) for s in samples)
         result_lines = ResultsLine.search([
-            ('detail_sample', '=', sample.id),
+            ('detail_sample', 'in', [s.id for s in samples]),
             ])
-        analysis = [rl.notebook_line.analysis.id for rl in result_lines]
+        for rl in result_lines:
+            analysis[rl.detail_sample.id].append(rl.notebook_line.analysis.id)
+
+        notebook_ids = set()
+        for sample in samples:
+            for precedent in [sample.precedent1, sample.precedent2,
+                    sample.precedent3]:
+                if precedent:
+                    notebook_ids.add(precedent.id)
+        if not notebook_ids:
+            return
+
+        precedent_analysis = {}
+        cursor.execute('SELECT notebook, analysis '
+            'FROM "' + NotebookLine._table + '" '
+            'WHERE notebook IN %s '
+                'AND accepted = TRUE '
+            'ORDER BY id ASC',
+            (tuple(notebook_ids),))
+        for notebook_id, analysis_id in cursor.fetchall():
+            precedent_analysis.setdefault(notebook_id, []).append(analysis_id)
 
         lines_to_create = []
-        for precedent in [sample.precedent1, sample.precedent2,
-                sample.precedent3]:
-            if not precedent:
-                continue
-            precedent_lines = NotebookLine.search([
-                ('notebook', '=', precedent),
-                ('analysis', 'not in', analysis),
-                ('accepted', '=', True),
-                ])
-            for line in precedent_lines:
-                lines_to_create.append({
-                    'detail_sample': sample.id,
-                    'precedent_analysis': line.analysis.id,
-                    })
-                analysis.append(line.analysis.id)
+        for sample in samples:
+            for precedent in [sample.precedent1, sample.precedent2,
+                    sample.precedent3]:
+                if not precedent:
+                    continue
+                for analysis_id in precedent_analysis.get(precedent.id, []):
+                    if analysis_id in analysis[sample.id]:
+                        continue
+                    lines_to_create.append({
+                        'detail_sample': sample.id,
+                        'precedent_analysis': analysis_id,
+                        })
+                    analysis[sample.id].append(analysis_id)
 
         if lines_to_create:
             ResultsLine.create(lines_to_create)
@@ -795,63 +867,77 @@ class ResultsReportVersionDetailLine(metaclass=PoolMeta):
 
     @classmethod
     def get_precedent_result(cls, details, names):
+        pool = Pool()
+        NotebookLine = pool.get('lims.notebook.line')
+
+        precedents = {}
+        for d in details:
+            if not d.notebook_line:
+                continue
+            for name in names:
+                precedent = getattr(d.detail_sample, name[:-7])
+                if precedent:
+                    precedents[(d.id, name)] = precedent.id
+
+        precedent_lines = cls._get_precedent_lines(
+            set(precedents.values()), set(d.analysis.id for d in details
+                if d.notebook_line and d.analysis))
+
+        lines = {}
+        for d in details:
+            for name in names:
+                if (d.id, name) not in precedents:
+                    continue
+                equivalence_code = d.method and d.method.equivalence_code
+                for line_id, method_id, line_equivalence_code in (
+                        precedent_lines.get((precedents[(d.id, name)],
+                            d.analysis and d.analysis.id), [])):
+                    if (method_id == (d.method and d.method.id) or (
+                            equivalence_code and
+                            line_equivalence_code == equivalence_code)):
+                        lines[(d.id, name)] = line_id
+                        break
+
+        formated_results = dict((l.id, l.formated_result)
+            for l in NotebookLine.browse(list(set(lines.values()))))
+
         result = {}
         for name in names:
             result[name] = {}
-            if name == 'precedent1_result':
-                for d in details:
-                    result[name][d.id] = cls._get_precedent_result(
-                        d.detail_sample.precedent1, d)
-            elif name == 'precedent2_result':
-                for d in details:
-                    result[name][d.id] = cls._get_precedent_result(
-                        d.detail_sample.precedent2, d)
-            elif name == 'precedent3_result':
-                for d in details:
-                    result[name][d.id] = cls._get_precedent_result(
-                        d.detail_sample.precedent3, d)
-            elif name == 'precedent4_result':
-                for d in details:
-                    result[name][d.id] = cls._get_precedent_result(
-                        d.detail_sample.precedent4, d)
-            elif name == 'precedent5_result':
-                for d in details:
-                    result[name][d.id] = cls._get_precedent_result(
-                        d.detail_sample.precedent5, d)
-            elif name == 'precedent6_result':
-                for d in details:
-                    result[name][d.id] = cls._get_precedent_result(
-                        d.detail_sample.precedent6, d)
-            elif name == 'precedent7_result':
-                for d in details:
-                    result[name][d.id] = cls._get_precedent_result(
-                        d.detail_sample.precedent7, d)
-            else:  # name == 'precedent8_result':
-                for d in details:
-                    result[name][d.id] = cls._get_precedent_result(
-                        d.detail_sample.precedent8, d)
+            for d in details:
+                line_id = lines.get((d.id, name))
+                result[name][d.id] = (formated_results[line_id]
+                    if line_id else '')
         return result
 
     @classmethod
-    def _get_precedent_result(cls, precedent, line):
+    def _get_precedent_lines(cls, notebook_ids, analysis_ids):
+        '''
+        Return the accepted lines of the precedent notebooks grouped by
+        notebook and analysis, with their method and equivalence code
+        '''
+        cursor = Transaction().connection.cursor()
         pool = Pool()
         NotebookLine = pool.get('lims.notebook.line')
-        if not precedent:
-            return ''
-        if not line.notebook_line:
-            return ''
-        precedent_line = NotebookLine.search([
-            ('notebook', '=', precedent),
-            ('analysis', '=', line.analysis),
-            ['OR', ('method', '=', line.method), [
-                ('method.equivalence_code', 'not in', [None, '']),
-                ('method.equivalence_code', '=', line.method.equivalence_code),
-                ]],
-            ('accepted', '=', True),
-            ])
-        if not precedent_line:
-            return ''
-        return precedent_line[0].formated_result
+        LabMethod = pool.get('lims.lab.method')
+
+        if not notebook_ids or not analysis_ids:
+            return {}
+
+        cursor.execute('SELECT nl.notebook, nl.analysis, nl.id, nl.method, '
+                'm.equivalence_code '
+            'FROM "' + NotebookLine._table + '" nl '
+                'LEFT JOIN "' + LabMethod._table + '" m '
+                'ON m.id = nl.method '
+            'WHERE nl.notebook IN %s '
+                'AND nl.analysis IN %s '
+                'AND nl.accepted = TRUE '
+            'ORDER BY nl.repetition ASC, nl.id ASC',
+            (tuple(notebook_ids), tuple(analysis_ids)))
+        result = {}
+        for x in cursor.fetchall():
+            result.setdefault((x[0], x[1]), []).append(x[2:])
+        return result
 
 
 class OpenResultsDetailPrecedent(Wizard):
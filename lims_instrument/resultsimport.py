@@ -306,71 +306,97 @@ class NotebookLoadResultsFile(Wizard):
         Notebook = pool.get('lims.notebook')
         NotebookLine = pool.get('lims.notebook.line')
         Analysis = pool.get('lims.analysis')
+        Device = pool.get('lims.lab.device')
 
-        lines = []
+        raw_data = []
         for fline in [str(item).zfill(2) for item in range(1, 61)]:
             file_ = getattr(self.start, 'infile_%s' % fline)
             if not file_:
                 continue
             self.start.results_importer.parse(file_)
             raw_results = self.start.results_importer.rawresults
-            fractions_numbers = list(raw_results.keys())
-            if not fractions_numbers:
+            for number in sorted(raw_results.keys()):
+                for analysis in list(raw_results[number].keys()):
+                    for rep in list(raw_results[number][analysis].keys()):
+                        raw_data.append((number, analysis, rep,
+                            raw_results[number][analysis][rep]))
+        if not raw_data:
+            return 'empty'
+
+        numbers = list(set(str(r[0]) for r in raw_data))
+        cursor.execute('SELECT f.number, MIN(n.id) '
+            'FROM "' + Fraction._table + '" f '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.fraction = f.id '
+            'WHERE f.number = ANY(%s) '
+            'GROUP BY f.number', (numbers,))
+        notebooks = dict(cursor.fetchall())
+
+        codes = list(set(r[1] for r in raw_data))
+        cursor.execute('SELECT DISTINCT code '
+            'FROM "' + Analysis._table + '" '
+            'WHERE code = ANY(%s) '
+                'AND automatic_acquisition = TRUE', (codes,))
+        codes = [x[0] for x in cursor.fetchall()]
+
+        raw_data = [r for r in raw_data
+            if str(r[0]) in notebooks and r[1] in codes]
+        if not raw_data:
+            return 'empty'
+
+        notebook_lines = {}
+        clause = [
+            ('notebook', 'in', list(set(notebooks[str(r[0])]
+                for r in raw_data))),
+            ('analysis.code', 'in', codes),
+            ('repetition', 'in', list(set(r[2] for r in raw_data))),
+            ('start_date', '!=', None),
+            ('result', 'in', [None, '']),
+            ('converted_result', 'in', [None, '']),
+            ('literal_result', 'in', [None, '']),
+            ('result_modifier', 'not in', ['d', 'nd', 'pos',
+                'neg', 'ni', 'abs', 'pre', 'na']),
+            ('converted_result_modifier', 'not in',
+                ['d', 'nd', 'pos', 'neg', 'ni', 'abs', 'pre']),
+            ]
+        for line in NotebookLine.search(clause):
+            notebook_lines.setdefault((line.notebook.id, line.analysis.code,
+                line.repetition), line)
+
+        devices = {}
+        device_codes = list(set(r[3]['device'] for r in raw_data
+            if r[3].get('device')))
+        if device_codes:
+            for device in Device.search([('code', 'in', device_codes)]):
+                devices.setdefault(device.code, device.id)
+
+        lines, results = [], {}
+        for number, analysis, rep, data in raw_data:
+            line = notebook_lines.get(
+                (notebooks[str(number)], analysis, rep))
+            if not line:
                 continue
-
-            numbers = '\', \''.join(str(n) for n in fractions_numbers)
-            cursor.execute('SELECT id, number '
-                'FROM "' + Fraction._table + '" '
-                'WHERE number IN (\'' + numbers + '\') '
-                'ORDER BY number ASC')
-
-            for f in cursor.fetchall():
-                cursor.execute('SELECT id '
-                    'FROM "' + Notebook._table + '" '
-                    'WHERE fraction = %s '
-                    'LIMIT 1', (f[0],))
-                notebook = cursor.fetchone()
-                if not notebook:
-                    continue
-
-                for analysis in list(raw_results[f[1]].keys()):
-                    cursor.execute('SELECT id '
-                        'FROM "' + Analysis._table + '" '
-                        'WHERE code = %s '
-                            'AND automatic_acquisition = TRUE '
-                        'LIMIT 1', (analysis,))
-                    if not cursor.fetchone():
-                        continue
-
-                    for rep in list(raw_results[f[1]][analysis].keys()):
-                        clause = [
-                            ('notebook', '=', notebook[0]),
-                            ('analysis', '=', analysis),
-                            ('repetition', '=', rep),
-                            ('start_date', '!=', None),
-                            ('result', 'in', [None, '']),
-                            ('converted_result', 'in', [None, '']),
-                            ('literal_result', 'in', [None, '']),
-                            ('result_modifier', 'not in', ['d', 'nd', 'pos',
-                                'neg', 'ni', 'abs', 'pre', 'na']),
-                            ('converted_result_modifier', 'not in',
-                                ['d', 'nd', 'pos', 'neg', 'ni', 'abs', 'pre']),
-                            ]
-                        line = NotebookLine.search(clause, limit=1)
-                        if not line:
-                            continue
-                        data = raw_results[f[1]][analysis][rep]
-                        res = self.get_results(line[0], data)
-                        if res:
-                            NotebookLine.write([line[0]], res)
-                            lines.append(line[0])
+            res = self.get_results(line, data, devices)
+            if res:
+                if line.id not in results:
+                    lines.append(line)
+                results[line.id] = res
+
+        # Write the lines with identical results together
+        to_write = {}
+        for line in lines:
+            key = tuple(sorted(results[line.id].items()))
+            to_write.setdefault(key, []).append(line)
+        if to_write:
+            NotebookLine.write(*[x for key, records in to_write.items()
+                    for x in (records, dict(key))])
 
         if lines:
             self.result.result_lines = [l.id for l in lines]
             return 'result'
         return 'empty'
 
-    def get_results(self, line, data):
+    def get_results(self, line, data, devices=None):
         pool = Pool()
         Device = pool.get('lims.lab.device')
 
@@ -390,9 +416,13 @@ class NotebookLoadResultsFile(Wizard):
                 res['imported_chromatogram'] = data['chromatogram']
             device = data['device'] if 'device' in data else None
             if device:
-                dev = Device.search([('code', '=', device)])
-                if dev:
-                    res['imported_device'] = dev[0].id
+                if devices is not None:
+                    if device in devices:
+                        res['imported_device'] = devices[device]
+                else:
+                    dev = Device.search([('code', '=', device)])
+                    if dev:
+                        res['imported_device'] = dev[0].id
             if 'dilution_factor' in data:
                 res['imported_dilution_factor'] = data['dilution_factor']
             if 'rm_correction_formula' in data:
@@ -405,56 +435,90 @@ class NotebookLoadResultsFile(Wizard):
         default['result_lines'] = [l.id for l in self.result.result_lines]
         return default
 
-    def get_professionals(self, professionals_codes):
+    def get_professionals(self, professionals_codes, codes=None):
         '''
         This function gets a string with one or more professionals codes,
         separated by commas, like: 'ABC' or 'JLB, ABC'
         It returns the professionals
         '''
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Professional = pool.get('lims.laboratory.professional')
+        if codes is None:
+            codes = self._get_professionals_by_code([professionals_codes])
 
         res = []
         professionals = ''.join(professionals_codes.split())
         professionals = professionals.split(',')
         for professional in professionals:
-            cursor.execute('SELECT id, code '
-                'FROM "' + Professional._table + '" '
-                'WHERE code = %s '
-                'LIMIT 1', (professional,))
-            prof = cursor.fetchone()
+            prof = codes.get(professional)
             if not prof:
                 return []
             res.append(prof)
         return res
 
-    def check_professionals(self, professionals, method):
+    def _get_professionals_by_code(self, professionals_codes):
+        '''
+        Return a dict with the (id, code) of the professionals referenced
+        by the given codes strings, by code
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Professional = pool.get('lims.laboratory.professional')
+
+        codes = set()
+        for professionals in professionals_codes:
+            codes.update(''.join(professionals.split()).split(','))
+        if not codes:
+            return {}
+        cursor.execute('SELECT id, code '
+            'FROM "' + Professional._table + '" '
+            'WHERE code = ANY(%s) '
+            'ORDER BY id', (list(codes),))
+        res = {}
+        for prof in cursor.fetchall():
+            res.setdefault(prof[1], prof)
+        return res
+
+    def _get_qualifications(self, professional_ids):
+        '''
+        Return the analytical qualification state of the professionals,
+        by (professional, method)
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
         LabProfessionalMethod = pool.get('lims.lab.professional.method')
 
+        if not professional_ids:
+            return {}
+        cursor.execute('SELECT professional, method, state '
+            'FROM "' + LabProfessionalMethod._table + '" '
+            'WHERE professional = ANY(%s) '
+                'AND type = \'analytical\' '
+            'ORDER BY id', (list(professional_ids),))
+        res = {}
+        for professional, method, state in cursor.fetchall():
+            res.setdefault((professional, method), state)
+        return res
+
+    def check_professionals(self, professionals, method,
+            qualifications=None):
+        if qualifications is None:
+            qualifications = self._get_qualifications(
+                [p[0] for p in professionals])
+
         validated = False
         msg = ''
         for professional in professionals:
-            cursor.execute('SELECT state '
-                'FROM "' + LabProfessionalMethod._table + '" '
-                'WHERE professional = %s '
-                    'AND method = %s '
-                    'AND type = \'analytical\' '
-                'LIMIT 1', (professional[0], method.id))
-            qualification = cursor.fetchone()
+            qualification = qualifications.get((professional[0], method.id))
             if not qualification:
                 validated = False
                 msg += '%s not qualified for method: %s' % (
                     professional[1], method.code)
                 return validated, msg
-            elif qualification[0] == 'training':
+            elif qualification == 'training':
                 if not validated:
                     msg += '%s in training for method: %s. ' \
                         'Add qualified professional' % (
                             professional[1], method.code)
-            elif (qualification[0] in ('qualified', 'requalified')):
+            elif (qualification in ('qualified', 'requalified')):
                 validated = True
 
         return validated, msg
@@ -471,6 +535,12 @@ class NotebookLoadResultsFile(Wizard):
         messages = ''
         export_results = self.start.results_importer.exportResults()
 
+        codes = self._get_professionals_by_code([
+                l.imported_professionals for l in self.result.result_lines
+                if l.imported_professionals])
+        qualifications = self._get_qualifications(
+            [p[0] for p in codes.values()])
+
         previous_professionals = []
         new_professionals = []
         for line in self.result.result_lines:
@@ -535,10 +605,11 @@ class NotebookLoadResultsFile(Wizard):
 
             line_previous_professionals = []
             if line.imported_professionals:
-                profs = self.get_professionals(line.imported_professionals)
+                profs = self.get_professionals(line.imported_professionals,
+                    codes)
                 if profs:
                     validated, msg = self.check_professionals(
-                        profs, line.method)
+                        profs, line.method, qualifications)
                     if validated:
                         line_previous_professionals = [p for p in
                             line.professionals]
@@ -2,9 +2,10 @@
 # This file is part of lims_interface module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from sql import (Table, Column as SqlColumn, Literal,
+from sql import (Table, Column as SqlColumn, Literal, Values, Cast,
     Desc, Asc, NullsFirst, NullsLast)
 from sql.aggregate import Count
+from sql.conditionals import Coalesce
 import formulas
 import schedula
 from decimal import Decimal
@@ -14,12 +15,12 @@ from collections import defaultdict
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
-from trytond.tools import cursor_dict
+from trytond.tools import cursor_dict, grouped_slice
 from trytond.pyson import PYSONEncoder, Eval
 from trytond.rpc import RPC
 from trytond.exceptions import UserError
 from trytond.model.modelsql import convert_from
-from .interface import FIELD_TYPE_TRYTON, FIELD_TYPE_CAST
+from .interface import FIELD_TYPE_TRYTON, FIELD_TYPE_CAST, FIELD_TYPE_SQL
 
 
 class Adapter:
@@ -622,18 +623,24 @@ class Data(ModelSQL, ModelView):
         sql_table = cls.get_sql_table()
         cursor = Transaction().connection.cursor()
 
-        ids = []
-        for record in vlist:
-            fields = []
-            values = []
-            for key, value in record.items():
-                fields.append(SqlColumn(sql_table, key))
-                values.append(value)
-
-            query = sql_table.insert(fields, values=[values],
-                returning=[sql_table.id])
-            cursor.execute(*query)
-            ids.append(cursor.fetchone()[0])
+        # Rows sharing the same columns are inserted together
+        to_insert = defaultdict(list)
+        for position, record in enumerate(vlist):
+            to_insert[tuple(record.keys())].append((position, record))
+
+        ids = [None] * len(vlist)
+        for keys, rows in to_insert.items():
+            fields = [SqlColumn(sql_table, key) for key in keys]
+            for sub_rows in grouped_slice(rows):
+                sub_rows = list(sub_rows)
+                query = sql_table.insert(fields,
+                    values=[[r[key] for key in keys] for _, r in sub_rows],
+                    returning=[sql_table.id])
+                cursor.execute(*query)
+                # ids are taken from the sequence in insertion order
+                new_ids = sorted(x[0] for x in cursor.fetchall())
+                for (position, _), id_ in zip(sub_rows, new_ids):
+                    ids[position] = id_
         records = cls.browse(ids)
         cls.update_formulas(records)
         return records
@@ -661,51 +668,65 @@ class Data(ModelSQL, ModelView):
     @classmethod
     def update_formulas(cls, records=None):
         Column = Pool().get('lims.interface.column')
-        cursor = Transaction().connection.cursor()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
 
         table = cls.get_table()
         sql_table = cls.get_sql_table()
         interface = cls.get_interface()
 
-        formula_fields = []
-        for field in table.fields_:
-            if not field.formula:
-                continue
-            col = Column.search([
-                ('interface', '=', interface),
-                ('alias', '=', field.name),
-                ])
-            order = col and col[0].evaluation_order or 0
-            formula_fields.append({
-                'order': order,
-                'field': field,
-                })
-        if not formula_fields:
+        fields_ = [f for f in table.fields_ if f.formula]
+        if not fields_:
             return
 
+        orders = {}
+        for col in Column.search([
+                ('interface', '=', interface),
+                ('alias', 'in', [f.name for f in fields_]),
+                ]):
+            orders.setdefault(col.alias, col.evaluation_order or 0)
+        formula_fields = sorted(fields_,
+            key=lambda f: orders.get(f.name, 0))
+        asts = {f.name: f.get_ast() for f in formula_fields}
+
         if not records:
             records = cls.search([])
+        rows = []
         for record in records:
             vals = {}
-            fields = []
-            values = []
-            for field in sorted(formula_fields, key=lambda x: x['order']):
-                field_name = field['field'].name
-                value = record.get_formula_value(field['field'], vals)
+            for field in formula_fields:
+                value = record.get_formula_value(field, vals,
+                    ast=asts[field.name])
                 if value is None:
                     continue
-                fields.append(SqlColumn(sql_table, field_name))
-                values.append(value)
-                vals[field_name] = value
+                vals[field.name] = value
+            if vals:
+                rows.append([record.id] + [vals.get(f.name)
+                        for f in formula_fields])
+        if not rows:
+            return
 
-            if not values:
-                continue
-            query = sql_table.update(fields, values,
-                where=(sql_table.id == record.id))
+        # Values are bound with their own type and cast to the type of each
+        # column, so NULL (not computed) values keep the value already stored
+        columns, types = [], []
+        for field in formula_fields:
+            columns.append(SqlColumn(sql_table, field.name))
+            types.append(transaction.database.sql_type(
+                FIELD_TYPE_SQL[field.type]).base)
+        for sub_rows in grouped_slice(rows):
+            values = Values([[r[0]] + [Cast(Literal(v), type_)
+                        for v, type_ in zip(r[1:], types)]
+                    for r in sub_rows])
+            query = sql_table.update(columns, [
+                    Coalesce(SqlColumn(values, 'column%s' % (i + 2)), column)
+                    for i, column in enumerate(columns)],
+                from_=[values],
+                where=sql_table.id == values.column1)
             cursor.execute(*query)
 
-    def get_formula_value(self, field, vals={}):
-        ast = field.get_ast()
+    def get_formula_value(self, field, vals={}, ast=None):
+        if ast is None:
+            ast = field.get_ast()
         inputs = []
         if field.inputs:
             for x in field.inputs.split():
@@ -16,7 +16,7 @@ from openpyxl import load_workbook
 from decimal import Decimal
 from datetime import datetime, date, time
 from dateutil import relativedelta
-from itertools import chain
+from itertools import chain, islice
 from collections import defaultdict
 
 from trytond.config import config
@@ -1630,13 +1630,19 @@ class Compilation(Workflow, ModelSQL, ModelView):
     def collect_csv(self, create_new_lines=True):
         pool = Pool()
         Origin = pool.get('lims.interface.compilation.origin')
-        Data = pool.get('lims.interface.data')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        data_create = []
-        data_write = []
 
         schema, formula_fields = self._get_schema()
+        with Transaction().set_context(
+                lims_interface_table=self.table):
+            imported_files = [o for o in self.origins if not o.imported]
+            lines = self._read_csv_lines(imported_files, schema,
+                create_new_lines)
+            self._collect_lines(lines, schema, formula_fields,
+                create_new_lines)
+            if imported_files:
+                Origin.write(imported_files, {'imported': True})
+
+    def _read_csv_lines(self, origins, schema, create_new_lines=True):
         schema_keys = list(schema.keys())
         separator = {
             'comma': ',',
@@ -1649,219 +1655,209 @@ class Compilation(Workflow, ModelSQL, ModelView):
         delimiter = separator[self.interface.field_separator]
         first_row = self.interface.first_row - 1
         encoding = self.interface.charset
-        with Transaction().set_context(
-                lims_interface_table=self.table):
-            imported_files = []
-            for origin in self.origins:
-                if origin.imported:
-                    continue
-                filedata = io.BytesIO(origin.origin_file)
-                wrapper = io.TextIOWrapper(filedata, encoding=encoding)
+        for origin in origins:
+            filedata = io.BytesIO(origin.origin_file)
+            wrapper = io.TextIOWrapper(filedata, encoding=encoding)
+            reader = enumerate(csv.reader(wrapper, delimiter=delimiter))
+            while True:
                 try:
-                    str_data = io.StringIO(wrapper.read())
+                    count, row = next(reader)
+                except StopIteration:
+                    break
                 except UnicodeDecodeError:
                     raise UserError(gettext(
                         'lims_interface.invalid_interface_charset'))
-                reader = csv.reader(str_data, delimiter=delimiter)
-                count = 0
-                for row in reader:
-                    if count < first_row:
-                        count += 1
-                        continue
-                    if len(row) == 0:
-                        continue
-                    line = {'compilation': self.id}
-                    for k in schema_keys:
-                        value = None
-                        default_value = schema[k]['default_value']
-                        if default_value not in (None, ''):
-                            if not create_new_lines:
-                                continue
-                            if default_value.startswith('='):
-                                continue
-                            value = default_value
-                        else:
-                            col = schema[k]['col']
-                            if (not row[col - 1] or
-                                    not str(row[col - 1]).strip()):
-                                line[k] = None
-                                continue
-                            value = row[col - 1]
-
-                        if schema[k]['type'] == 'integer':
-                            line[k] = int(value)
-                        elif schema[k]['type'] == 'float':
-                            line[k] = float(value)
-                        elif schema[k]['type'] == 'numeric':
-                            line[k] = Decimal(str(value))
-                        elif schema[k]['type'] == 'boolean':
-                            line[k] = bool(value)
-                        elif schema[k]['type'] == 'date':
-                            line[k] = str2date(value, self.interface.language)
-                        elif (schema[k]['type'] == 'many2one' and
-                                default_value):
-                            resource = get_model_resource(
-                                schema[k]['model_name'], value,
-                                schema[k]['field_name'])
-                            line[k] = resource[0].id
-                        else:
-                            line[k] = str(value)
-
-                    f_fields = sorted(formula_fields.items(),
-                        key=lambda x: x[1]['evaluation_order'])
-                    for field in f_fields:
-                        line[field[0]] = self._get_formula_value(field, line)
-
-                    line['notebook_line'] = self._get_notebook_line(line)
-                    if (line['notebook_line']):
-                        nl = NotebookLine(line['notebook_line'])
-                        for k in schema_keys:
-                            default_value = schema[k]['default_value']
-                            if (default_value not in (None, '') and
-                                    default_value.startswith('=')):
-                                path = default_value[1:].split('.')
-                                field = path.pop(0)
-                                try:
-                                    value = getattr(nl, field)
-                                    while path:
-                                        field = path.pop(0)
-                                        value = getattr(value, field)
-                                except AttributeError:
-                                    value = None
-                                line[k] = value
-                    line_id = self._get_compilation_line_id(line)
-                    if line_id:
-                        line['id'] = line_id
-                        data_write.append(line)
+                if count < first_row:
+                    continue
+                if len(row) == 0:
+                    continue
+                line = {'compilation': self.id}
+                for k in schema_keys:
+                    value = None
+                    default_value = schema[k]['default_value']
+                    if default_value not in (None, ''):
+                        if not create_new_lines:
+                            continue
+                        if default_value.startswith('='):
+                            continue
+                        value = default_value
                     else:
-                        data_create.append(line)
-                    count += 1
-                imported_files.append(origin)
+                        col = schema[k]['col']
+                        if (not row[col - 1] or
+                                not str(row[col - 1]).strip()):
+                            line[k] = None
+                            continue
+                        value = row[col - 1]
+
+                    if schema[k]['type'] == 'integer':
+                        line[k] = int(value)
+                    elif schema[k]['type'] == 'float':
+                        line[k] = float(value)
+                    elif schema[k]['type'] == 'numeric':
+                        line[k] = Decimal(str(value))
+                    elif schema[k]['type'] == 'boolean':
+                        line[k] = bool(value)
+                    elif schema[k]['type'] == 'date':
+                        line[k] = str2date(value, self.interface.language)
+                    elif (schema[k]['type'] == 'many2one' and
+                            default_value):
+                        resource = get_model_resource(
+                            schema[k]['model_name'], value,
+                            schema[k]['field_name'])
+                        line[k] = resource[0].id
+                    else:
+                        line[k] = str(value)
+                yield line
+
+    def collect_excel(self, create_new_lines=True):
+        pool = Pool()
+        Origin = pool.get('lims.interface.compilation.origin')
 
+        schema, formula_fields = self._get_schema()
+        with Transaction().set_context(
+                lims_interface_table=self.table):
+            imported_files = [o for o in self.origins if not o.imported]
+            lines = self._read_excel_lines(imported_files, schema,
+                create_new_lines)
+            self._collect_lines(lines, schema, formula_fields,
+                create_new_lines)
             if imported_files:
                 Origin.write(imported_files, {'imported': True})
 
-            if data_create and create_new_lines:
-                Data.create(data_create)
-            for data in data_write:
-                data_line = Data(data['id'])
-                del data['id']
-                del data['notebook_line']
-                del data['compilation']
-                Data.write([data_line], data)
+    def _read_excel_lines(self, origins, schema, create_new_lines=True):
+        schema_keys = list(schema.keys())
+        first_row = self.interface.first_row
+        for origin in origins:
+            filedata = io.BytesIO(origin.origin_file)
+            book = load_workbook(filename=filedata, read_only=True,
+                data_only=True)
+            sheet = book.active
+            singletons = {}
+            for k in schema_keys:
+                if (schema[k]['singleton'] and
+                        schema[k]['default_value'] in (None, '')):
+                    singletons[k] = sheet.cell(row=schema[k]['row'],
+                        column=schema[k]['col']).value
+            for row in sheet.iter_rows(min_row=first_row, values_only=True):
+                line = {'compilation': self.id}
+                for k in schema_keys:
+                    value = None
+                    default_value = schema[k]['default_value']
+                    if default_value not in (None, ''):
+                        if not create_new_lines:
+                            continue
+                        if default_value.startswith('='):
+                            continue
+                        value = default_value
+                    else:
+                        col = schema[k]['col']
+                        if schema[k]['singleton']:
+                            value = singletons[k]
+                        elif col <= len(row):
+                            value = row[col - 1]
+                        if value is None:
+                            line[k] = None
+                            continue
 
-    def collect_excel(self, create_new_lines=True):
+                    if schema[k]['type'] == 'integer':
+                        line[k] = int(value)
+                    elif schema[k]['type'] == 'float':
+                        line[k] = float(value)
+                    elif schema[k]['type'] == 'numeric':
+                        line[k] = Decimal(str(value))
+                    elif schema[k]['type'] == 'boolean':
+                        line[k] = bool(value)
+                    elif schema[k]['type'] == 'date':
+                        if default_value:
+                            line[k] = str2date(
+                                value, self.interface.language)
+                        else:
+                            if isinstance(value, datetime):
+                                line[k] = value
+                            else:
+                                line[k] = None
+                    elif (schema[k]['type'] == 'many2one' and
+                            default_value):
+                        resource = get_model_resource(
+                            schema[k]['model_name'], value,
+                            schema[k]['field_name'])
+                        line[k] = resource[0].id
+                    else:
+                        line[k] = str(value)
+                yield line
+            book.close()
+
+    def _collect_lines(self, lines, schema, formula_fields,
+            create_new_lines=True):
+        '''
+        Store the lines read from the origin files. Lines are processed in
+        chunks: notebook lines and existing compilation lines are looked up
+        once per chunk and the chunk is written in bulk
+        '''
         pool = Pool()
-        Origin = pool.get('lims.interface.compilation.origin')
         Data = pool.get('lims.interface.data')
         NotebookLine = pool.get('lims.notebook.line')
 
-        data_create = []
-        data_write = []
-
-        schema, formula_fields = self._get_schema()
         schema_keys = list(schema.keys())
-        first_row = self.interface.first_row
-        with Transaction().set_context(
-                lims_interface_table=self.table):
-            imported_files = []
-            for origin in self.origins:
-                if origin.imported:
+        f_fields = sorted(formula_fields.items(),
+            key=lambda x: x[1]['evaluation_order'])
+        asts = {}
+        for field in f_fields:
+            asts[field[0]] = self._get_formula_ast(field)
+
+        # Lines created by this collection are not updated by later lines
+        created_ids = set()
+        chunk_size = Transaction().database.IN_MAX
+        lines = iter(lines)
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                break
+
+            for line in chunk:
+                for field in f_fields:
+                    line[field[0]] = self._get_formula_value(field, line,
+                        asts[field[0]])
+
+            nl_ids = self._get_notebook_lines(chunk)
+            notebook_lines = {nl.id: nl for nl in NotebookLine.browse(
+                    list(set(i for i in nl_ids if i)))}
+            for line, nl_id in zip(chunk, nl_ids):
+                line['notebook_line'] = nl_id
+                if not nl_id:
                     continue
-                filedata = io.BytesIO(origin.origin_file)
-                book = load_workbook(filename=filedata, data_only=True)
-                sheet = book.active
-                max_row = sheet.max_row + 1
-                if first_row <= max_row:
-                    for i in range(first_row, max_row):
-                        line = {'compilation': self.id}
-                        for k in schema_keys:
+                nl = notebook_lines[nl_id]
+                for k in schema_keys:
+                    default_value = schema[k]['default_value']
+                    if (default_value not in (None, '') and
+                            default_value.startswith('=')):
+                        path = default_value[1:].split('.')
+                        field = path.pop(0)
+                        try:
+                            value = getattr(nl, field)
+                            while path:
+                                field = path.pop(0)
+                                value = getattr(value, field)
+                        except AttributeError:
                             value = None
-                            default_value = schema[k]['default_value']
-                            if default_value not in (None, ''):
-                                if not create_new_lines:
-                                    continue
-                                if default_value.startswith('='):
-                                    continue
-                                value = default_value
-                            else:
-                                col = schema[k]['col']
-                                row = i
-                                if schema[k]['singleton']:
-                                    row = schema[k]['row']
-                                value = sheet.cell(row=row, column=col).value
-                                if value is None:
-                                    line[k] = None
-                                    continue
-
-                            if schema[k]['type'] == 'integer':
-                                line[k] = int(value)
-                            elif schema[k]['type'] == 'float':
-                                line[k] = float(value)
-                            elif schema[k]['type'] == 'numeric':
-                                line[k] = Decimal(str(value))
-                            elif schema[k]['type'] == 'boolean':
-                                line[k] = bool(value)
-                            elif schema[k]['type'] == 'date':
-                                if default_value:
-                                    line[k] = str2date(
-                                        value, self.interface.language)
-                                else:
-                                    if isinstance(value, datetime):
-                                        line[k] = value
-                                    else:
-                                        line[k] = None
-                            elif (schema[k]['type'] == 'many2one' and
-                                    default_value):
-                                resource = get_model_resource(
-                                    schema[k]['model_name'], value,
-                                    schema[k]['field_name'])
-                                line[k] = resource[0].id
-                            else:
-                                line[k] = str(value)
-
-                        f_fields = sorted(formula_fields.items(),
-                            key=lambda x: x[1]['evaluation_order'])
-                        for field in f_fields:
-                            line[field[0]] = self._get_formula_value(
-                                field, line)
-
-                        line['notebook_line'] = self._get_notebook_line(line)
-                        if (line['notebook_line']):
-                            nl = NotebookLine(line['notebook_line'])
-                            for k in schema_keys:
-                                default_value = schema[k]['default_value']
-                                if (default_value not in (None, '') and
-                                        default_value.startswith('=')):
-                                    path = default_value[1:].split('.')
-                                    field = path.pop(0)
-                                    try:
-                                        value = getattr(nl, field)
-                                        while path:
-                                            field = path.pop(0)
-                                            value = getattr(value, field)
-                                    except AttributeError:
-                                        value = None
-                                    line[k] = value
-                        line_id = self._get_compilation_line_id(line)
-                        if line_id:
-                            line['id'] = line_id
-                            data_write.append(line)
-                        else:
-                            data_create.append(line)
-                imported_files.append(origin)
-
-            if imported_files:
-                Origin.write(imported_files, {'imported': True})
+                        line[k] = value
+
+            data_create = []
+            data_write = []
+            line_ids = self._get_compilation_line_ids(chunk,
+                exclude=created_ids)
+            for line, line_id in zip(chunk, line_ids):
+                if line_id:
+                    del line['notebook_line']
+                    del line['compilation']
+                    data_write.extend(([Data(line_id)], line))
+                else:
+                    data_create.append(line)
 
             if data_create and create_new_lines:
-                Data.create(data_create)
-            for data in data_write:
-                data_line = Data(data['id'])
-                del data['id']
-                del data['notebook_line']
-                del data['compilation']
-                Data.write([data_line], data)
+                created_ids.update(d.id for d in Data.create(data_create))
+            if data_write:
+                Data.write(*data_write)
 
     def collect_txt(self, create_new_lines=True):
         return
@@ -1899,9 +1895,13 @@ class Compilation(Workflow, ModelSQL, ModelView):
                     }
         return schema, formula_fields
 
-    def _get_formula_value(self, field, line):
+    def _get_formula_ast(self, field):
         parser = formulas.Parser()
-        ast = parser.ast(field[1]['formula'])[1].compile()
+        return parser.ast(field[1]['formula'])[1].compile()
+
+    def _get_formula_value(self, field, line, ast=None):
+        if ast is None:
+            ast = self._get_formula_ast(field)
         inputs = (' '.join([x for x in ast.inputs])).lower().split()
         inputs = [line[x] for x in inputs]
         try:
@@ -1921,80 +1921,139 @@ class Compilation(Workflow, ModelSQL, ModelView):
                     value = None
         return value
 
-    def _get_notebook_line(self, line):
+    @staticmethod
+    def _get_repetition_key(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
+    def _get_notebook_lines(self, lines):
+        '''
+        Return the id of the notebook line of each line (or None), looking
+        them up with a single search keyed on fraction number, analysis
+        and repetition
+        '''
         pool = Pool()
         NotebookLine = pool.get('lims.notebook.line')
 
+        res = [None] * len(lines)
         fraction_field = self.interface.fraction_field
         analysis_field = self.interface.analysis_field
         repetition_field = self.interface.repetition_field
         if not fraction_field or not analysis_field or not repetition_field:
-            return None
+            return res
+        method_field = self.interface.method_field
 
-        fraction_value = line.get(fraction_field.alias)
-        analysis_value = line.get(analysis_field.alias)
-        repetition_value = line.get(repetition_field.alias)
-        if (fraction_value is None or
-                analysis_value is None or
-                repetition_value is None):
-            return None
+        keys = {}
+        for i, line in enumerate(lines):
+            fraction_value = line.get(fraction_field.alias)
+            analysis_value = line.get(analysis_field.alias)
+            repetition_value = line.get(repetition_field.alias)
+            if (fraction_value is None or
+                    analysis_value is None or
+                    repetition_value is None):
+                continue
+            method_value = None
+            if method_field:
+                method_value = line.get(method_field.alias)
+                if method_value is not None:
+                    method_value = method_value.split(' - ')[0]
+            keys[i] = (str(fraction_value), analysis_value.split(' - ')[0],
+                self._get_repetition_key(repetition_value), method_value)
+        if not keys:
+            return res
+
+        candidates = defaultdict(list)
+        for nl in NotebookLine.search([
+                ('notebook.fraction.number', 'in',
+                    list(set(k[0] for k in keys.values()))),
+                ('analysis.code', 'in',
+                    list(set(k[1] for k in keys.values()))),
+                ('analysis.automatic_acquisition', '=', True),
+                ('repetition', 'in',
+                    list(set(k[2] for k in keys.values()))),
+                ('annulled', '=', False),
+                ]):
+            candidates[(nl.notebook.fraction.number, nl.analysis.code,
+                nl.repetition)].append(nl)
 
-        clause = [
-            ('notebook.fraction.number', '=', fraction_value),
-            ('analysis.code', '=', analysis_value.split(' - ')[0]),
-            ('analysis.automatic_acquisition', '=', True),
-            ('repetition', '=', repetition_value),
-            ('annulled', '=', False),
-            ]
-        method_field = self.interface.method_field
-        if method_field:
-            method_value = line.get(method_field.alias)
-            if method_value is not None:
-                clause.append(
-                    ('method.code', '=', method_value.split(' - ')[0]))
-
-        nb_line = NotebookLine.search(clause)
-        if nb_line:
-            return nb_line[0].id
-        return None
+        for i, (fraction, analysis, repetition, method) in keys.items():
+            for nl in candidates[(fraction, analysis, repetition)]:
+                if method is not None and (
+                        not nl.method or nl.method.code != method):
+                    continue
+                res[i] = nl.id
+                break
+        return res
 
-    def _get_compilation_line_id(self, line):
+    def _get_compilation_line_ids(self, lines, exclude=None):
+        '''
+        Return the id of the existing compilation line of each line (or
+        None), matched by notebook line or else by the fraction, analysis
+        and repetition columns
+        '''
         pool = Pool()
         Data = pool.get('lims.interface.data')
 
-        clause = [('compilation', '=', line['compilation'])]
-        if line.get('notebook_line'):
-            clause.append(('notebook_line', '=', line['notebook_line']))
+        res = [None] * len(lines)
+        exclude = exclude or set()
+
+        def search_lines(clause):
+            ids = [d.id for d in Data.search([
+                        ('compilation', '=', self.id),
+                        clause,
+                        ]) if d.id not in exclude]
+            rows = {r['id']: r for r in Data.read(ids)}
+            return [rows[i] for i in ids]
+
+        nl_ids = set(line['notebook_line'] for line in lines
+            if line.get('notebook_line'))
+        if nl_ids:
+            existing = {}
+            for row in search_lines(('notebook_line', 'in', list(nl_ids))):
+                existing.setdefault(row['notebook_line'], row['id'])
+            for i, line in enumerate(lines):
+                if line.get('notebook_line'):
+                    res[i] = existing.get(line['notebook_line'])
 
-        else:
-            sub_clause = [('id', '=', -1)]
-            fraction_field = self.interface.fraction_field
-            analysis_field = self.interface.analysis_field
-            repetition_field = self.interface.repetition_field
-            if fraction_field and analysis_field and repetition_field:
-
-                fraction_value = line.get(fraction_field.alias)
-                analysis_value = line.get(analysis_field.alias)
-                repetition_value = line.get(repetition_field.alias)
-
-                if (fraction_value is not None and
-                        analysis_value is not None and
-                        repetition_value is not None):
-                    sub_clause = [
-                        (fraction_field.alias, '=', fraction_value),
-                        (analysis_field.alias, '=', analysis_value),
-                        (repetition_field.alias, '=', repetition_value),
-                        ]
-                    method_field = self.interface.method_field
-                    if method_field:
-                        method_value = line.get(method_field.alias)
-                        if method_value is not None:
-                            sub_clause.append(
-                                (method_field.alias, '=', method_value))
-
-            clause.extend(sub_clause)
-        line = Data.search(clause)
-        return line and line[0].id or None
+        fraction_field = self.interface.fraction_field
+        analysis_field = self.interface.analysis_field
+        repetition_field = self.interface.repetition_field
+        if not fraction_field or not analysis_field or not repetition_field:
+            return res
+        method_field = self.interface.method_field
+
+        keys = {}
+        for i, line in enumerate(lines):
+            if line.get('notebook_line'):
+                continue
+            key = (line.get(fraction_field.alias),
+                line.get(analysis_field.alias),
+                line.get(repetition_field.alias))
+            if None in key:
+                continue
+            keys[i] = key
+        if not keys:
+            return res
+
+        candidates = defaultdict(list)
+        for row in search_lines((fraction_field.alias, 'in',
+                    list(set(k[0] for k in keys.values())))):
+            candidates[(row[fraction_field.alias],
+                row[analysis_field.alias],
+                row[repetition_field.alias])].append(row)
+        for i, key in keys.items():
+            method_value = None
+            if method_field:
+                method_value = lines[i].get(method_field.alias)
+            for row in candidates[key]:
+                if (method_value is not None and
+                        row[method_field.alias] != method_value):
+                    continue
+                res[i] = row['id']
+                break
+        return res
 
     @classmethod
     @ModelView.button
@@ -2,15 +2,76 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import unittest
+from unittest.mock import patch
+from sql import Table as SqlTable
 
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
 
 
 class LimsTestCase(ModuleTestCase):
     'Test lims_interface module'
     module = 'lims_interface'
 
+    @with_transaction()
+    def test_update_formulas(self):
+        'Test formula columns update'
+        pool = Pool()
+        Table = pool.get('lims.interface.table')
+        Data = pool.get('lims.interface.data')
+        cursor = Transaction().connection.cursor()
+
+        table, = Table.create([{
+                    'name': 'lims_interface_test_formulas',
+                    'fields_': [('create', [{
+                                    'name': 'value',
+                                    'string': 'Value',
+                                    'type': 'integer',
+                                    }, {
+                                    'name': 'half',
+                                    'string': 'Half',
+                                    'type': 'integer',
+                                    'formula': '=value / 2',
+                                    'inputs': 'value',
+                                    }, {
+                                    'name': 'double',
+                                    'string': 'Double',
+                                    'type': 'float',
+                                    'formula': '=value * 2',
+                                    'inputs': 'value',
+                                    }, {
+                                    'name': 'inverse',
+                                    'string': 'Inverse',
+                                    'type': 'float',
+                                    'formula': '=1 / value',
+                                    'inputs': 'value',
+                                    }])],
+                    }])
+        table.create_table()
+
+        sql_table = SqlTable(table.name)
+        cursor.execute(*sql_table.insert(
+                [sql_table.value, sql_table.inverse],
+                values=[[8, 3.0], [9, 3.0], [0, 3.0]],
+                returning=[sql_table.id, sql_table.value]))
+        records = [Data(id_, value=value) for id_, value in cursor]
+
+        with patch.object(Data, 'get_table', return_value=table), \
+                patch.object(Data, 'get_interface', return_value=None):
+            Data.update_formulas(records)
+
+        cursor.execute(*sql_table.select(sql_table.value, sql_table.half,
+                sql_table.double, sql_table.inverse,
+                order_by=[sql_table.value.asc]))
+        self.assertEqual(cursor.fetchall(), [
+                # Division by zero is not computed, the stored value is kept
+                (0, 0, 0.0, 3.0),
+                (8, 4, 16.0, 0.125),
+                (9, 5, 18.0, 1 / 9),
+                ])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -0,0 +1,333 @@
+# This file is part of lims_planning_automatic module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from datetime import date
+from dateutil.relativedelta import relativedelta
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+
+
+class PlanningEngine(object):
+    '''
+    Automatic Planning Engine
+
+    Plan the pending analysis of all the laboratories with automatic
+    planning at once: pending lines, technician qualifications and controls
+    are loaded once for the whole run and the planifications and their
+    details are created in bulk.
+    '''
+
+    def __init__(self, entries=None, tests=None):
+        self.entries = entries
+        self.tests = tests
+
+    def run(self):
+        Date = Pool().get('ir.date')
+
+        self.today = Date.today()
+        laboratories, analyses = self._get_analyses_to_plan()
+        if not laboratories:
+            return []
+        planned_services = self._get_planned_services(analyses)
+        lines = self._get_pending_lines(planned_services)
+        planifications = self._create_planifications(laboratories, analyses,
+            planned_services, lines)
+        if planifications:
+            self._qualify_technicians(planifications, lines)
+            self._confirm(planifications)
+        return planifications
+
+    def _get_analyses_to_plan(self):
+        '''
+        Return the laboratories to plan, by id, and the analysis to plan
+        in each one of them
+        '''
+        pool = Pool()
+        EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
+        Laboratory = pool.get('lims.laboratory')
+
+        laboratories = dict((l.id, l) for l in Laboratory.search([
+            ('automatic_planning', '=', True),
+            ('default_laboratory_professional', '!=', None),
+            ]))
+        if not laboratories:
+            return {}, {}
+
+        clause = [
+            ('laboratory', 'in', list(laboratories.keys())),
+            ('plannable', '=', True),
+            ('state', '=', 'unplanned'),
+            ]
+        if self.entries:
+            clause.append(('entry', 'in', [e.id for e in self.entries]))
+        if self.tests:
+            clause.append(('sample', 'in',
+                [t.sample.id for t in self.tests]))
+
+        analyses = {}
+        for detail in EntryDetailAnalysis.search_read(clause,
+                fields_names=['laboratory', 'analysis']):
+            analyses.setdefault(detail['laboratory'], set()).add(
+                detail['analysis'])
+        laboratories = dict((k, v) for k, v in laboratories.items()
+            if k in analyses)
+        analyses = dict((k, sorted(v)) for k, v in analyses.items())
+        return laboratories, analyses
+
+    def _get_planned_services(self, analyses):
+        '''
+        Return, for each laboratory, the planification analysis (itself or
+        a set/group) in which each analysis is planned
+        '''
+        Analysis = Pool().get('lims.analysis')
+
+        all_analyses = set()
+        for analysis_ids in analyses.values():
+            all_analyses.update(analysis_ids)
+        included_analysis = Analysis.get_included_analysis_analysis_multi(
+            list(all_analyses))
+
+        planned_services = {}
+        for laboratory_id, analysis_ids in analyses.items():
+            lab_services = planned_services.setdefault(laboratory_id, {})
+            for analysis_id in analysis_ids:
+                lab_services.setdefault(analysis_id, analysis_id)
+                for included_id in included_analysis[analysis_id]:
+                    lab_services.setdefault(included_id, analysis_id)
+        return planned_services
+
+    def _get_pending_lines(self, planned_services):
+        '''
+        Return, for each laboratory, the pending notebook lines to plan as
+        a list of (notebook line, fraction, service analysis,
+        planned service, method)
+        '''
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Planification = pool.get('lims.planification')
+        PlanificationServiceDetail = pool.get(
+            'lims.planification.service_detail')
+        PlanificationDetail = pool.get('lims.planification.detail')
+        NotebookLine = pool.get('lims.notebook.line')
+        Notebook = pool.get('lims.notebook')
+        EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
+        Service = pool.get('lims.service')
+        Analysis = pool.get('lims.analysis')
+
+        all_analyses = set()
+        for lab_services in planned_services.values():
+            all_analyses.update(lab_services.keys())
+
+        with Transaction().set_user(0):
+            cursor.execute('SELECT nl.id, nl.laboratory, nb.fraction, '
+                    'srv.analysis, ad.analysis, nl.method '
+                'FROM "' + NotebookLine._table + '" nl '
+                    'INNER JOIN "' + Analysis._table + '" nla '
+                    'ON nla.id = nl.analysis '
+                    'INNER JOIN "' + Notebook._table + '" nb '
+                    'ON nb.id = nl.notebook '
+                    'INNER JOIN "' + EntryDetailAnalysis._table + '" ad '
+                    'ON ad.id = nl.analysis_detail '
+                    'INNER JOIN "' + Service._table + '" srv '
+                    'ON srv.id = nl.service '
+                'WHERE ad.plannable = TRUE '
+                    'AND nl.start_date IS NULL '
+                    'AND nl.annulled = FALSE '
+                    'AND nl.laboratory = ANY(%s) '
+                    'AND nla.behavior != \'internal_relation\' '
+                    'AND ad.analysis = ANY(%s) '
+                    'AND NOT EXISTS ('
+                        'SELECT 1 '
+                        'FROM "' + PlanificationServiceDetail._table +
+                            '" psd '
+                            'INNER JOIN "' + PlanificationDetail._table +
+                            '" pd ON pd.id = psd.detail '
+                            'INNER JOIN "' + Planification._table + '" p '
+                            'ON p.id = pd.planification '
+                        'WHERE psd.notebook_line = nl.id '
+                            'AND p.state = \'preplanned\') '
+                'ORDER BY nb.fraction ASC, srv.analysis ASC, nl.id ASC',
+                (list(planned_services.keys()), list(all_analyses)))
+
+            lines = {}
+            for nl_id, laboratory_id, fraction_id, service_analysis_id, \
+                    analysis_id, method_id in cursor:
+                planned_service = planned_services[laboratory_id].get(
+                    analysis_id)
+                if not planned_service:
+                    continue
+                lines.setdefault(laboratory_id, []).append((nl_id,
+                    fraction_id, service_analysis_id, planned_service,
+                    method_id))
+        return lines
+
+    def _get_urgent_services(self, keys):
+        '''
+        Return the (fraction, analysis) keys whose service is urgent
+        '''
+        Service = Pool().get('lims.service')
+
+        fraction_ids = list(set(k[0] for k in keys))
+        analysis_ids = list(set(k[1] for k in keys))
+        urgent = {}
+        for sub_fractions in grouped_slice(fraction_ids):
+            for service in Service.search_read([
+                    ('fraction', 'in', list(sub_fractions)),
+                    ('analysis', 'in', analysis_ids),
+                    ], fields_names=['fraction', 'analysis', 'urgent']):
+                urgent.setdefault((service['fraction'], service['analysis']),
+                    service['urgent'])
+        return set(k for k in keys if urgent.get(k))
+
+    def _create_planifications(self, laboratories, analyses,
+            planned_services, lines):
+        '''
+        Create one pre-planned planification for each laboratory with
+        pending lines, with the laboratory default professional as the
+        responsible of all its services
+        '''
+        pool = Pool()
+        Planification = pool.get('lims.planification')
+        PlanificationDetail = pool.get('lims.planification.detail')
+
+        laboratory_ids = [l_id for l_id in laboratories if lines.get(l_id)]
+        if not laboratory_ids:
+            return []
+
+        planifications = Planification.create([{
+            'automatic': True,
+            'laboratory': l_id,
+            'start_date': self.today,
+            'analysis': [('add', analyses[l_id])],
+            'technicians': [('create', [{
+                'laboratory_professional': (
+                    laboratories[l_id].default_laboratory_professional.id),
+                }])],
+            } for l_id in laboratory_ids])
+
+        urgent_services = self._get_urgent_services(set((line[1], line[2])
+            for l_id in laboratory_ids for line in lines[l_id]))
+
+        to_create = []
+        for planification in planifications:
+            laboratory = laboratories[planification.laboratory.id]
+            professional_id = laboratory.default_laboratory_professional.id
+            details = {}
+            for nl_id, fraction_id, service_analysis_id, planned_service, \
+                    _ in lines[laboratory.id]:
+                details.setdefault((fraction_id, service_analysis_id),
+                    []).append({
+                        'notebook_line': nl_id,
+                        'planned_service': planned_service,
+                        'staff_responsible': [('add', [professional_id])],
+                        })
+            for key, service_details in details.items():
+                to_create.append({
+                    'planification': planification.id,
+                    'fraction': key[0],
+                    'service_analysis': key[1],
+                    'urgent': key in urgent_services,
+                    'details': [('create', service_details)],
+                    })
+        PlanificationDetail.create(to_create)
+
+        Planification.preplan(planifications)
+        return planifications
+
+    def _get_controls(self, planifications):
+        '''
+        Return the requalification controls of each planification
+        '''
+        PlanificationFraction = Pool().get('lims.planification-fraction')
+
+        controls = {}
+        for p_control in PlanificationFraction.search([
+                ('planification', 'in', [p.id for p in planifications]),
+                ('fraction.type.requalify', '=', True),
+                ]):
+            controls.setdefault(p_control.planification.id, set()).add(
+                p_control.fraction.id)
+        return controls
+
+    def _qualify_technicians(self, planifications, lines):
+        '''
+        Register the execution of the planned methods in the qualification
+        history of the technicians, as the technicians qualification wizard
+        does without user interaction: only when the technician is
+        qualified for all the planned methods and the qualification has not
+        expired
+        '''
+        pool = Pool()
+        LabProfessionalMethod = pool.get('lims.lab.professional.method')
+        LabProfessionalMethodRequalification = pool.get(
+            'lims.lab.professional.method.requalification')
+
+        methods = {}
+        for planification in planifications:
+            methods[planification.id] = set(line[4]
+                for line in lines[planification.laboratory.id] if line[4])
+        professional_ids = set(p.technicians[0].laboratory_professional.id
+            for p in planifications)
+        method_ids = set()
+        for planification_methods in methods.values():
+            method_ids.update(planification_methods)
+        if not method_ids:
+            return
+
+        qualifications = {}
+        for qualification in LabProfessionalMethod.search([
+                ('professional', 'in', list(professional_ids)),
+                ('method', 'in', list(method_ids)),
+                ('type', '=', 'preparation'),
+                ]):
+            qualifications.setdefault((qualification.professional.id,
+                qualification.method.id), qualification)
+        controls = self._get_controls(planifications)
+
+        to_create = []
+        for planification in planifications:
+            professional_id = (
+                planification.technicians[0].laboratory_professional.id)
+            planification_qualifications = [qualifications.get(
+                    (professional_id, m_id))
+                for m_id in methods[planification.id]]
+            if not all(q and q.state in ('qualified', 'requalified')
+                    for q in planification_qualifications):
+                continue
+            planification_controls = [{'control': f_id}
+                for f_id in controls.get(planification.id, [])]
+            for qualification in planification_qualifications:
+                deadline = self.today - relativedelta(
+                    months=qualification.method.requalification_months)
+                last_execution = max([r.last_execution_date
+                        for r in qualification.requalification_history
+                        if r.last_execution_date] or [date.min])
+                if last_execution < deadline:
+                    continue
+                # The default professional is the only technician of the
+                # planification, so there are no supervisors
+                to_create.append({
+                    'professional_method': qualification.id,
+                    'type': ('qualification'
+                        if qualification.state == 'qualified'
+                        else 'requalification'),
+                    'date': self.today,
+                    'last_execution_date': planification.start_date,
+                    'controls': [('create', planification_controls)],
+                    })
+        if to_create:
+            LabProfessionalMethodRequalification.create(to_create)
+
+    def _confirm(self, planifications):
+        Planification = Pool().get('lims.planification')
+
+        Planification.write(planifications, {
+            'state': 'confirmed',
+            'wizard_executed': False,
+            })
+        for planification in planifications:
+            planification.pre_update_laboratory_notebook()
+            planification.update_analysis_detail()
+        Planification.__queue__.do_confirm(planifications)
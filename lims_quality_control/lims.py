@@ -354,10 +354,6 @@ class EntryDetailAnalysis(metaclass=PoolMeta):
         cursor = Transaction().connection.cursor()
         pool = Pool()
         Typification = pool.get('lims.typification')
-        Method = pool.get('lims.lab.method')
-        WaitingTime = pool.get('lims.lab.method.results_waiting')
-        AnalysisLaboratory = pool.get('lims.analysis-laboratory')
-        ProductType = pool.get('lims.product.type')
         Notebook = pool.get('lims.notebook')
         NotebookLine = pool.get('lims.notebook.line')
         Company = pool.get('company.company')
@@ -369,6 +365,9 @@ class EntryDetailAnalysis(metaclass=PoolMeta):
 
         lines_to_create = []
 
+        waiting_times = cls._get_results_estimated_waiting(details)
+        departments = cls._get_departments(details, fraction)
+
         template_id = None
         if Transaction().context.get('template'):
             template_id = Transaction().context.get('template')
@@ -420,40 +419,6 @@ class EntryDetailAnalysis(metaclass=PoolMeta):
                 scientific_notation = False
                 report = False
 
-            results_estimated_waiting = None
-            cursor.execute('SELECT results_estimated_waiting '
-                'FROM "' + WaitingTime._table + '" '
-                'WHERE method = %s '
-                    'AND party = %s',
-                (detail.method.id, detail.party.id))
-            res = cursor.fetchone()
-            if res:
-                results_estimated_waiting = res[0]
-            else:
-                cursor.execute('SELECT results_estimated_waiting '
-                    'FROM "' + Method._table + '" '
-                    'WHERE id = %s', (detail.method.id,))
-                res = cursor.fetchone()
-                if res:
-                    results_estimated_waiting = res[0]
-
-            department = None
-            cursor.execute('SELECT department '
-                'FROM "' + AnalysisLaboratory._table + '" '
-                'WHERE analysis = %s '
-                    'AND laboratory = %s',
-                    (detail.analysis.id, detail.laboratory.id))
-            res = cursor.fetchone()
-            if res and res[0]:
-                department = res[0]
-            else:
-                cursor.execute('SELECT department '
-                    'FROM "' + ProductType._table + '" '
-                    'WHERE id = %s', (fraction.product_type.id,))
-                res = cursor.fetchone()
-                if res and res[0]:
-                    department = res[0]
-
             for i in range(0, repetitions + 1):
                 notebook_line = {
                     'notebook': notebook.id,
@@ -478,8 +443,8 @@ class EntryDetailAnalysis(metaclass=PoolMeta):
                     'significant_digits': significant_digits,
                     'scientific_notation': scientific_notation,
                     'report': report,
-                    'results_estimated_waiting': results_estimated_waiting,
-                    'department': department,
+                    'results_estimated_waiting': waiting_times[detail.id],
+                    'department': departments[detail.id],
                     }
                 if template_id and t:
                     notebook_line['typification'] = t.id
@@ -1,11 +1,16 @@
 # This file is part of lims_report_html module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from threading import Lock
 
 from weasyprint import HTML, CSS
+from trytond.cache import LRUDict
 
 
 class PdfGenerator:
+    # Laid out header and footer bodies, shared by the reports of the process
+    _overlays = LRUDict(32)
+    _overlays_lock = Lock()
 
     def __init__(self, main_html, header_html=None, footer_html=None,
             base_url=None, side_margin=2, extra_vertical_margin=30,
@@ -28,14 +33,12 @@ class PdfGenerator:
 
     def render_html(self):
         if self.header_html:
-            header_body, header_height = self._compute_overlay_element(
-                'header')
+            header_body, header_height = self._get_overlay_element('header')
         else:
             header_body, header_height = None, 0
 
         if self.footer_html:
-            footer_body, footer_height = self._compute_overlay_element(
-                'footer')
+            footer_body, footer_height = self._get_overlay_element('footer')
         else:
             footer_body, footer_height = None, 0
 
@@ -63,6 +66,21 @@ class PdfGenerator:
 
         return main_doc
 
+    def _get_overlay_element(self, element: str):
+        '''
+        Return the laid out body and height of the element, rendering
+        each distinct header or footer only once
+        '''
+        key = (element, getattr(self, '{}_html'.format(element)),
+            self.base_url, self.page_orientation, tuple(self.stylesheets))
+        with self._overlays_lock:
+            overlay = self._overlays.get(key)
+        if overlay is None:
+            overlay = self._compute_overlay_element(element)
+            with self._overlays_lock:
+                self._overlays[key] = overlay
+        return overlay
+
     def _compute_overlay_element(self, element: str):
         overlay_layout = (
             '@page {size: A4 %s; margin: 0;}' % self.page_orientation +
@@ -5,7 +5,6 @@ import os
 import operator
 from mimetypes import guess_type as mime_guess_type
 from binascii import b2a_base64
-from functools import partial
 from decimal import Decimal
 from datetime import date, datetime
 from lxml import html as lxml_html
@@ -14,6 +13,7 @@ from babel.support import Translations as BabelTranslations
 from jinja2 import contextfilter, Markup
 from jinja2 import Environment, FunctionLoader
 from io import BytesIO
+from threading import Lock
 from PyPDF2 import PdfFileMerger
 from PyPDF2.utils import PdfReadError
 
@@ -24,6 +24,7 @@ from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.tools import file_open
+from trytond.cache import Cache, LRUDict
 from .generator import PdfGenerator
 
 
@@ -424,6 +425,12 @@ class ResultsReportVersionDetailSample(metaclass=PoolMeta):
 
 class ResultReport(metaclass=PoolMeta):
     __name__ = 'lims.result_report'
+    _environments = LRUDict(64)
+    _stylesheets = LRUDict(256)
+    _sections = LRUDict(32)
+    _resources_lock = Lock()
+    _attachment_cache = Cache('lims.result_report.attachment',
+        size_limit=256, context=False)
 
     @classmethod
     def execute(cls, ids, data):
@@ -572,15 +579,17 @@ class ResultReport(metaclass=PoolMeta):
         if record.previous_sections or record.following_sections:
             merger = PdfFileMerger(strict=False)
             # Previous Sections
-            for section in record.previous_sections:
-                filedata = BytesIO(section.data)
+            if record.previous_sections:
+                filedata = BytesIO(cls.get_sections_pdf(
+                    record.previous_sections))
                 merger.append(filedata)
             # Results Report
             filedata = BytesIO(document)
             merger.append(filedata)
             # Following Sections
-            for section in record.following_sections:
-                filedata = BytesIO(section.data)
+            if record.following_sections:
+                filedata = BytesIO(cls.get_sections_pdf(
+                    record.following_sections))
                 merger.append(filedata)
             output = BytesIO()
             merger.write(output)
@@ -588,6 +597,34 @@ class ResultReport(metaclass=PoolMeta):
 
         return 'pdf', document
 
+    @classmethod
+    def get_sections_pdf(cls, sections):
+        '''
+        Return the sections merged in a single PDF. As the files are stored
+        by content, the result is kept by the ids of their files
+        '''
+        key = tuple(s.data_id for s in sections)
+        if None in key:
+            key = None
+        else:
+            with cls._resources_lock:
+                document = cls._sections.get(key)
+            if document is not None:
+                return document
+
+        merger = PdfFileMerger(strict=False)
+        for section in sections:
+            filedata = BytesIO(section.data)
+            merger.append(filedata)
+        output = BytesIO()
+        merger.write(output)
+        document = output.getvalue()
+
+        if key is not None:
+            with cls._resources_lock:
+                cls._sections[key] = document
+        return document
+
     @classmethod
     def get_results_report_template(cls, action, detail_id):
         ResultsDetail = Pool().get('lims.results_report.version.detail')
@@ -624,7 +661,7 @@ class ResultReport(metaclass=PoolMeta):
         with Transaction().set_context(locale=locale):
             env = cls.get_results_report_environment()
 
-        report_template = env.from_string(template_string)
+        report_template = cls.get_compiled_template(env, template_string)
         context = cls.get_context(records, [], data)
         context.update({
             'report': action,
@@ -638,6 +675,21 @@ class ResultReport(metaclass=PoolMeta):
 
     @classmethod
     def get_results_report_environment(cls):
+        '''
+        Return the environment of the locale and translations of the
+        context. It is built once per process and keeps the templates
+        compiled in it
+        '''
+        context = Transaction().context
+        locale = context.get('locale').split('_')[0]
+        template = context.get('template')
+        key = (locale, template and int(template),
+            context.get('default_translations'))
+        with cls._resources_lock:
+            env = cls._environments.get(key)
+        if env is not None:
+            return env
+
         extensions = ['jinja2.ext.i18n', 'jinja2.ext.autoescape',
             'jinja2.ext.with_', 'jinja2.ext.loopcontrols', 'jinja2.ext.do']
         env = Environment(extensions=extensions,
@@ -645,11 +697,28 @@ class ResultReport(metaclass=PoolMeta):
 
         env.filters.update(cls.get_results_report_filters())
 
-        locale = Transaction().context.get('locale').split('_')[0]
         translations = TemplateTranslations(locale)
         env.install_gettext_translations(translations)
+        env.compiled_templates = LRUDict(256)
+
+        with cls._resources_lock:
+            cls._environments[key] = env
         return env
 
+    @classmethod
+    def get_compiled_template(cls, env, template_string):
+        compiled_templates = getattr(env, 'compiled_templates', None)
+        if compiled_templates is None:
+            return env.from_string(template_string)
+
+        with cls._resources_lock:
+            template = compiled_templates.get(template_string)
+        if template is None:
+            template = env.from_string(template_string)
+            with cls._resources_lock:
+                compiled_templates[template_string] = template
+        return template
+
     @classmethod
     def get_results_report_filters(cls):
         Lang = Pool().get('ir.lang')
@@ -659,10 +728,18 @@ class ResultReport(metaclass=PoolMeta):
             with file_open(os.path.join(module, path)) as f:
                 return 'file://%s' % f.name
 
+        def get_lang():
+            locale = Transaction().context.get('locale').split('_')[0]
+            return Lang.get(locale or 'en')
+
         def render(value, digits=2, lang=None, filename=None):
             if value is None or value == '':
                 return ''
 
+            if lang is None and isinstance(value,
+                    (float, Decimal, int, date)):
+                lang = get_lang()
+
             if isinstance(value, (float, Decimal)):
                 return lang.format('%.*f', (digits, value), grouping=True)
 
@@ -697,7 +774,8 @@ class ResultReport(metaclass=PoolMeta):
 
         @contextfilter
         def subrender(context, value, subobj=None):
-            _template = context.eval_ctx.environment.from_string(value)
+            _template = cls.get_compiled_template(
+                context.eval_ctx.environment, value)
             if subobj:
                 new_context = {'subobj': subobj}
                 new_context.update(context)
@@ -708,25 +786,55 @@ class ResultReport(metaclass=PoolMeta):
                 result = Markup(result)
             return result
 
-        locale = Transaction().context.get('locale').split('_')[0]
-        lang, = Lang.search([('code', '=', locale or 'en')])
-
         return {
             'modulepath': module_path,
-            'render': partial(render, lang=lang),
+            'render': render,
             'subrender': subrender,
             }
 
     @classmethod
-    def parse_images(cls, template_string):
+    def get_attachments_data(cls, attachment_ids):
+        '''
+        Return a dict with the data of the attachments, kept in a cache
+        until they are modified
+        '''
+        cursor = Transaction().connection.cursor()
         Attachment = Pool().get('ir.attachment')
+
+        res = {}
+        if not attachment_ids:
+            return res
+        cursor.execute('SELECT id, COALESCE(write_date, create_date) '
+            'FROM "' + Attachment._table + '" '
+            'WHERE id = ANY(%s)',
+            (list(set(attachment_ids)),))
+        to_read = []
+        for attachment_id, timestamp in cursor.fetchall():
+            key = (attachment_id, timestamp)
+            data = cls._attachment_cache.get(key)
+            if data is None:
+                to_read.append(attachment_id)
+            else:
+                res[attachment_id] = data
+        if to_read:
+            for attachment in Attachment.browse(to_read):
+                data = attachment.data
+                res[attachment.id] = data
+                cls._attachment_cache.set((attachment.id,
+                    attachment.write_date or attachment.create_date), data)
+        return res
+
+    @classmethod
+    def parse_images(cls, template_string):
         root = lxml_html.fromstring(template_string)
+        images = cls.get_attachments_data([int(elem.attrib['id'])
+            for elem in root.iter('img') if 'id' in elem.attrib])
         for elem in root.iter('img'):
             # get image from attachments
             if 'id' in elem.attrib:
-                img = Attachment.search([('id', '=', int(elem.attrib['id']))])
-                if img:
-                    elem.attrib['src'] = cls.get_image(img[0].data)
+                img = images.get(int(elem.attrib['id']))
+                if img is not None:
+                    elem.attrib['src'] = cls.get_image(img)
             # get image from TinyMCE widget
             elif 'data-mce-src' in elem.attrib:
                 elem.attrib['src'] = elem.attrib['data-mce-src']
@@ -753,17 +861,18 @@ class ResultReport(metaclass=PoolMeta):
 
     @classmethod
     def parse_stylesheets(cls, template_string):
-        Attachment = Pool().get('ir.attachment')
-        root = lxml_html.fromstring(template_string)
-        res = []
-        # get stylesheets from attachments
-        elems = root.xpath("//div[@id='tryton_styles_container']/div")
-        for elem in elems:
-            css = Attachment.search([('id', '=', int(elem.attrib['id']))])
-            if not css:
-                continue
-            res.append(css[0].data)
-        return res
+        with cls._resources_lock:
+            stylesheet_ids = cls._stylesheets.get(template_string)
+        if stylesheet_ids is None:
+            root = lxml_html.fromstring(template_string)
+            # get stylesheets from attachments
+            elems = root.xpath("//div[@id='tryton_styles_container']/div")
+            stylesheet_ids = [int(elem.attrib['id']) for elem in elems]
+            with cls._resources_lock:
+                cls._stylesheets[template_string] = stylesheet_ids
+
+        stylesheets = cls.get_attachments_data(stylesheet_ids)
+        return [stylesheets[i] for i in stylesheet_ids if i in stylesheets]
 
 
 class TemplateTranslations:
@@ -789,7 +898,8 @@ class TemplateTranslations:
                     dirname=default_translations, locales=[lang])
                 self.cache[lang] = self.current
         else:
-            self.template = context.get('template', -1)
+            template = context.get('template', -1)
+            self.template = template and int(template)
 
     def ugettext(self, message):
         ReportTemplate = Pool().get('lims.result_report.template')
@@ -99,12 +99,14 @@ class SampleSaleLine(ModelSQL):
 class Service(metaclass=PoolMeta):
     __name__ = 'lims.service'
 
-    def get_invoice_line(self):
-        invoice_line = super().get_invoice_line()
-        if not invoice_line:
-            return
-        if self.sample.sale_lines:
-            for sale_line in self.sample.sale_lines:
-                if sale_line.product.id == self.analysis.product.id:
+    @classmethod
+    def get_invoice_lines(cls, services):
+        invoice_lines = super().get_invoice_lines(services)
+        for service in services:
+            invoice_line = invoice_lines.get(service.id)
+            if not invoice_line:
+                continue
+            for sale_line in service.sample.sale_lines:
+                if sale_line.product.id == service.analysis.product.id:
                     invoice_line['unit_price'] = sale_line.unit_price
-        return invoice_line
+        return invoice_lines